@@ -0,0 +1,147 @@
+import os, threading, time
+import metrics
+from model_registry import BASE_MODEL, _load_pretrained, model_fingerprint
+
+# PEFT's name for "no adapter" in a mixed batch
+BASE_ADAPTER = "__base__"
+
+# --- Several LoRA adapters on one base model ---
+# The base weights are loaded once and every adapter (same format as
+# qwen-lora-json) is attached to it by name; an extra adapter costs only its
+# own LoRA matrices. Batches whose rows all use one adapter switch the active
+# adapter (a flag flip) and run as usual; mixed batches pass PEFT one adapter
+# name per row, and each LoRA layer applies the right delta to each row.
+#
+# Activating an adapter and PEFT's per-row hooks both change shared module
+# state, so generation, streaming, loading and unloading all take one lock.
+# It is a plain Lock, not an RLock: a stream holds it across yields, which
+# the API may resume on a different thread.
+class AdapterPool:
+    def __init__(self, base_model=BASE_MODEL, dtype=None, device="cpu"):
+        self.base_model = base_model
+        self.dtype = dtype
+        self.device = device
+        self.tokenizer = None
+        self.model = None
+        self.adapters = {}   # name -> {"path", "fingerprint", "bytes", "load_s"}
+        self.active = None
+        self._lock = threading.Lock()
+        self.switches = 0
+        self.switch_s = 0.0
+
+    def _ensure_base(self):
+        if self.model is None:
+            self.tokenizer, self.model = _load_pretrained(self.base_model, None, self.dtype, self.device, merge=False)
+
+    def __contains__(self, name):
+        return name == BASE_ADAPTER or name in self.adapters
+
+    def load(self, name, path):
+        # Loading a name that is already registered replaces it (hot reload)
+        if name == BASE_ADAPTER:
+            raise ValueError(f"{BASE_ADAPTER!r} is reserved for the bare base model")
+        if not os.path.isfile(os.path.join(path, "adapter_config.json")):
+            raise FileNotFoundError(f"No adapter_config.json in {path}")
+        from peft import PeftModel
+        with self._lock:
+            self._ensure_base()
+            start = time.perf_counter()
+            if name in self.adapters:
+                self._delete(name)
+            if isinstance(self.model, PeftModel):
+                self.model.load_adapter(path, adapter_name=name)
+            else:
+                self.model = PeftModel.from_pretrained(self.model, path, adapter_name=name)
+                self.active = name
+            self.model.eval()
+            load_s = time.perf_counter() - start
+            self.adapters[name] = {
+                "path": os.path.abspath(path),
+                "fingerprint": model_fingerprint(self.base_model, path),
+                "bytes": self._adapter_bytes(name),
+                "load_s": load_s,
+            }
+        print(f"🧩 Loaded adapter {name} from {path} in {1000 * load_s:.0f} ms "
+              f"({self.adapters[name]['bytes'] / 2**20:.2f} MB)")
+        return self.adapters[name]
+
+    def unload(self, name):
+        with self._lock:
+            if name not in self.adapters:
+                raise KeyError(name)
+            self._delete(name)
+        print(f"🧩 Unloaded adapter {name}")
+
+    def _delete(self, name):
+        if len(self.adapters) == 1:
+            # A PeftModel with no adapter left cannot generate: strip the
+            # LoRA layers and keep the plain base model
+            self.model = self.model.unload()
+        else:
+            self.model.delete_adapter(name)
+        del self.adapters[name]
+        if self.active == name:
+            # PEFT falls back to another adapter (or none); re-activate explicitly next time
+            self.active = None
+
+    def _adapter_bytes(self, name):
+        marker = f".{name}."
+        return sum(p.numel() * p.element_size() for n, p in self.model.named_parameters() if marker in n)
+
+    def _activate(self, name):
+        # -> context manager the generate call runs in
+        from contextlib import nullcontext
+        if name == BASE_ADAPTER:
+            return self.model.disable_adapter() if self.adapters else nullcontext()
+        if name != self.active:
+            start = time.perf_counter()
+            self.model.set_adapter(name)
+            elapsed = time.perf_counter() - start
+            self.active = name
+            self.switches += 1
+            self.switch_s += elapsed
+            metrics.observe("adapter_switch", elapsed)
+        return nullcontext()
+
+    def _check(self, names):
+        unknown = sorted({n for n in names if n not in self})
+        if unknown:
+            raise KeyError(f"Unknown adapter(s): {', '.join(unknown)}")
+
+    def generate(self, prompts, adapters, max_new_tokens=128, batch_size=8, constraint=None, **generate_kwargs):
+        # adapters: one name per prompt (BASE_ADAPTER for the bare model)
+        from inference import generate_batch
+        self._check(adapters)
+        with self._lock:
+            if len(set(adapters)) == 1:
+                with self._activate(adapters[0]):
+                    return generate_batch(self.tokenizer, self.model, prompts, max_new_tokens=max_new_tokens,
+                                          batch_size=batch_size, constraint=constraint, **generate_kwargs)
+            return generate_batch(self.tokenizer, self.model, prompts, max_new_tokens=max_new_tokens,
+                                  batch_size=batch_size, constraint=constraint, adapter_names=list(adapters),
+                                  **generate_kwargs)
+
+    def stream(self, prompt, adapter, max_new_tokens=128, constraint=None, **generate_kwargs):
+        # inference.stream_generate with `adapter` active; the pool stays
+        # locked until the stream is exhausted or closed
+        from inference import stream_generate
+        self._check([adapter])
+        self._lock.acquire()
+        try:
+            with self._activate(adapter):
+                yield from stream_generate(self.tokenizer, self.model, prompt, max_new_tokens=max_new_tokens,
+                                           constraint=constraint, **generate_kwargs)
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        return {
+            "adapters": len(self.adapters),
+            "adapter_bytes": sum(a["bytes"] for a in self.adapters.values()),
+            "switches": self.switches,
+            "avg_switch_ms": 1000 * self.switch_s / self.switches if self.switches else 0.0,
+        }
+
+    def describe(self):
+        return {"base_model": self.base_model, "active": self.active, **self.stats(),
+                "loaded": {name: dict(info) for name, info in self.adapters.items()}}
@@ -1,24 +1,41 @@
-import os, json, base64
-from transformers import AutoModelForCausalLM, AutoTokenizer
-from email.mime.text import MIMEText
-from googleapiclient.discovery import build
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
+import os, json, codecs, threading
+import metrics
 from pydantic import BaseModel, EmailStr, ValidationError
 from typing import Literal
-from peft import PeftModel   # ✅ added for LoRA
-
-SCOPES = ['https://www.googleapis.com/auth/gmail.send']
+from model_registry import get_model, model_fingerprint, supports_kv_reuse, BACKEND
+from mail_transport import send_email
+from contact_store import ContactStore
+from fast_path import FastPathParser
+from parse_cache import ParseCache, PARSE_CACHE, contacts_version
 
 # --- Load Qwen with LoRA adapter ---
 model_name = "Qwen/Qwen3-0.6B"
 adapter_dir = "./qwen-lora-json"   # path to your trained adapter
+# CONSTRAINED_DECODING=1 only lets the model emit tokens that keep the output a
+# valid EmailRequest/ContactUpdate object, and stops as soon as it closes
+CONSTRAINED_DECODING = os.environ.get("CONSTRAINED_DECODING", "0") == "1"
+# PREFIX_CACHE=0 disables reusing the prompt prefix's KV cache for single parses
+PREFIX_CACHE = os.environ.get("PREFIX_CACHE", "1") == "1"
+prefix_cache = None   # inference.PrefixCache, built on the first model parse
+# JSON_EARLY_STOP=0 lets free decoding run on after the first "}" (all that
+# extract_json reads) until max_new_tokens
+JSON_EARLY_STOP = os.environ.get("JSON_EARLY_STOP", "1") == "1"
+# FAST_PATH=0 sends every request to the model, even the templated phrasings
+FAST_PATH = os.environ.get("FAST_PATH", "1") == "1"
+fast_path = FastPathParser()
+# Several LoRA adapters on one shared base model (see adapter_pool.py):
+# ADAPTERS="team_a=./lora-a,zh=./lora-zh" registers them by name next to the
+# default one (adapter_dir); requests then pick one with `adapter`. Setting
+# ADAPTERS turns MULTI_ADAPTER on; MULTI_ADAPTER=1 alone serves the default
+# adapter from the pool so others can be loaded at runtime.
+ADAPTERS = os.environ.get("ADAPTERS", "")
+MULTI_ADAPTER = os.environ.get("MULTI_ADAPTER", "1" if ADAPTERS else "0") == "1"
+DEFAULT_ADAPTER = "default"
+adapter_pool = None
 
-tokenizer = AutoTokenizer.from_pretrained(model_name, use_fast=True)
-base_model = AutoModelForCausalLM.from_pretrained(model_name)
-model = PeftModel.from_pretrained(base_model, adapter_dir)
-model.eval()
+# Loaded lazily on the first parse through the shared model registry; torch,
+# transformers and the inference helpers are only imported on that path, so
+# contact updates and structured JSON never pay for them
 
 # --- Pydantic Schemas ---
 class EmailRequest(BaseModel):
@@ -33,6 +50,44 @@ class ContactUpdate(BaseModel):
     name: str
     email: EmailStr
 
+# Validated model parses, keyed by instruction + weights + contacts version
+parse_cache = ParseCache((EmailRequest, ContactUpdate))
+_fingerprints = {}
+# Part of the cache fingerprint: bumped when receiver resolution changes, so
+# parses resolved the old way (v1 used fuzzy matches) are never served
+RESOLUTION_VERSION = 2
+
+def cache_fingerprint(constrained, adapter=None):
+    # The loaded weights never change within a process, so stat the adapter once.
+    # Pool adapters can be reloaded, so their fingerprint is taken at load time.
+    if MULTI_ADAPTER:
+        info = get_adapter_pool().adapters.get(adapter or DEFAULT_ADAPTER)
+        weights = info["fingerprint"] if info else f"missing:{adapter}"
+        return weights + f":{BACKEND}:r{RESOLUTION_VERSION}" + (":json" if constrained else "")
+    if constrained not in _fingerprints:
+        _fingerprints[constrained] = (model_fingerprint(model_name, adapter_dir) + f":{BACKEND}:r{RESOLUTION_VERSION}"
+                                      + (":json" if constrained else ""))
+    return _fingerprints[constrained]
+
+_pool_lock = threading.Lock()
+
+def get_adapter_pool():
+    # Built on first use: the base model plus the default and ADAPTERS adapters
+    global adapter_pool
+    with _pool_lock:
+        if adapter_pool is None:
+            from adapter_pool import AdapterPool
+            if BACKEND not in ("eager", "bf16"):
+                raise ValueError(f"MULTI_ADAPTER needs unmerged LoRA weights; QWEN_BACKEND={BACKEND} merges them")
+            pool = AdapterPool(model_name, dtype="bfloat16" if BACKEND == "bf16" else None)
+            if adapter_dir and os.path.isdir(adapter_dir):
+                pool.load(DEFAULT_ADAPTER, adapter_dir)
+            for entry in filter(None, (e.strip() for e in ADAPTERS.split(","))):
+                name, _, path = entry.partition("=")
+                pool.load(name.strip(), path.strip())
+            adapter_pool = pool
+    return adapter_pool
+
 # --- Helper: Extract JSON block ---
 def extract_json(text: str):
     text += " "
@@ -48,31 +103,74 @@ def extract_json(text: str):
     return None
 
 # --- Parsing unified request ---
-def parse_request(user_input: str, contacts: dict):
-    prompt = f"""
+# The instructions come first and the request last, so the prefix is identical
+# across calls and its KV cache can be reused. The address book is not in the
+# prompt: the model names the receiver and resolve_receiver() looks it up.
+def build_prompt_prefix():
+    return f"""
     Give me ONLY EXACTLY one JSON object. No explanations, no quotes, no markdown fences, no extra text.
-    You have access to the following contacts: {contacts}
-    Request: "{user_input}"
     If you give me anything other than JSON, my program to read your output:
     extract_json(text: str) would fail, so output only JSON object base on the Request:
     Case1: If it's a contact update: {{"type":"update","action":"add/update/delete","name":"...","email":"..."}}
     Example output: {{"type":"update","action":"add","name":"Jim","email":"s110467student@gmail.com"}}
-    Case2: If it's an email: {{"type":"email","receiver":"<actual email address>","subject":"...","body":"..."}}
-    Example output: {{"type":"email","receiver":"stonetsai96@gmail.com","subject":"hello","body":"hi"}}
+    Case2: If it's an email: {{"type":"email","receiver":"<contact name or email address>","subject":"...","body":"..."}}
+    Example output: {{"type":"email","receiver":"alice","subject":"hello","body":"hi"}}
+"""
+
+def build_prompt_suffix(user_input: str):
+    return f"""    Request: "{user_input}"
     """
 
-    inputs = tokenizer(prompt, return_tensors="pt")
-    outputs = model.generate(**inputs, max_new_tokens=200)
-    generated_tokens = outputs[0][inputs["input_ids"].shape[1]:]
-    text = tokenizer.decode(generated_tokens, skip_special_tokens=True).strip()
+def build_prompt(user_input: str):
+    return build_prompt_prefix() + build_prompt_suffix(user_input)
 
+# --- Receiver resolution against the address book ---
+# Only exact or case/width-folded names are resolved. Anything else stays a
+# bare name, fails EmailRequest validation and is never sent: the closest
+# contacts are only printed as suggestions.
+def lookup_contact(contacts, name: str):
+    if hasattr(contacts, "resolve"):
+        return contacts.resolve(name)
+    # Plain dict: exact, then case-insensitive match
+    if name in contacts:
+        return name, contacts[name]
+    for key, email in contacts.items():
+        if key.casefold() == name.casefold():
+            return key, email
+    return None
+
+def suggest_contacts(contacts, name: str):
+    return contacts.suggest(name) if hasattr(contacts, "suggest") else []
+
+def resolve_receiver(parsed_json: dict, contacts, quiet=False):
+    receiver = parsed_json.get("receiver")
+    if parsed_json.get("type") != "email" or not isinstance(receiver, str) or "@" in receiver:
+        return parsed_json
+    match = lookup_contact(contacts, receiver) if contacts is not None else None
+    if match is None:
+        if not quiet:
+            suggestions = suggest_contacts(contacts, receiver) if contacts is not None else []
+            hint = f" (did you mean {', '.join(name for name, _ in suggestions)}?)" if suggestions else ""
+            print(f"❌ Cannot find contact {receiver}{hint}")
+        return parsed_json
+    if not quiet:
+        print(f"📇 Resolved receiver {receiver} -> {match[0]} <{match[1]}>")
+    return {**parsed_json, "receiver": match[1]}
+
+def validate_output(text: str, contacts=None):
     print("=== Raw AI output ===")
     print(text)
 
-    parsed_json = extract_json(text)
+    with metrics.span("extract_json"):
+        parsed_json = extract_json(text)
     if not parsed_json:
         print("⚠️ No valid JSON found")
         return None
+    with metrics.span("validate"):
+        return validate_json(parsed_json, contacts)
+
+def validate_json(parsed_json: dict, contacts=None, quiet=False):
+    parsed_json = resolve_receiver(parsed_json, contacts, quiet)
 
     # Try validating against each schema
     try:
@@ -85,35 +183,228 @@ def parse_request(user_input: str, contacts: dict):
     except ValidationError:
         pass
 
-    print("⚠️ Validation failed for both schemas")
+    if not quiet:
+        print("⚠️ Validation failed for both schemas")
     return None
 
-# --- Gmail API setup ---
-def get_gmail_service():
-    creds = None
-    if os.path.exists('token.json'):
-        creds = Credentials.from_authorized_user_file('token.json', SCOPES)
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
+def parse_request(user_input: str, contacts: dict, constrained=None):
+    return parse_requests([user_input], contacts, batch_size=1, constrained=constrained)[0]
+
+def fast_parse(user_input: str, contacts: dict):
+    # Templated phrasings, parsed without the model; None means "ask the model"
+    with metrics.span("fast_path"):
+        parsed = fast_path.parse(user_input, lambda d: validate_json(d, contacts, quiet=True), contacts)
+    if parsed is not None:
+        metrics.inc("parse_requests_total", source="fast_path")
+    return parsed
+
+# --- Schema-constrained decoding ---
+_json_decoding = {}
+
+def json_decoding(tokenizer):
+    # Built once per tokenizer: caches token bytes across calls
+    decoding = _json_decoding.get(id(tokenizer))
+    if decoding is None:
+        from json_constraints import JsonSchemaDecoding
+        decoding = JsonSchemaDecoding(tokenizer, EmailRequest, ContactUpdate)
+        _json_decoding[id(tokenizer)] = decoding
+    return decoding
+
+_json_early_stop = {}
+
+def json_early_stop(tokenizer):
+    stop = _json_early_stop.get(id(tokenizer))
+    if stop is None:
+        from json_constraints import JsonEarlyStop
+        stop = JsonEarlyStop(tokenizer)
+        _json_early_stop[id(tokenizer)] = stop
+    return stop
+
+def decoding_for(tokenizer, constrained):
+    if constrained:
+        return json_decoding(tokenizer)
+    return json_early_stop(tokenizer) if JSON_EARLY_STOP else None
+
+# --- Parsing many requests in batched generate() calls ---
+def parse_requests(user_inputs: list, contacts: dict, batch_size=None, constrained=None,
+                   use_fast_path=None, adapters=None):
+    # adapters: optional adapter name per request (None = default adapter)
+    if adapters is None:
+        adapters = [None] * len(user_inputs)
+    if use_fast_path is None:
+        use_fast_path = FAST_PATH
+    results = [fast_parse(u, contacts) if use_fast_path else None for u in user_inputs]
+    pending = [i for i, r in enumerate(results) if r is None]
+    if PARSE_CACHE and pending:
+        # Repeated instructions skip tokenization and generation entirely
+        if constrained is None:
+            constrained = CONSTRAINED_DECODING
+        version = contacts_version(contacts)
+        with metrics.span("cache_lookup"):
+            keys = {i: parse_cache.key(user_inputs[i], cache_fingerprint(constrained, adapters[i])) for i in pending}
+            for i in pending:
+                results[i] = parse_cache.get(keys[i], version)
+        hits = [i for i in pending if results[i] is not None]
+        metrics.inc("parse_requests_total", len(hits), source="cache")
+        pending = [i for i in pending if results[i] is None]
+    if pending:
+        if PARSE_CACHE:
+            # Identical instructions within one batch are generated once
+            first = {}
+            for i in pending:
+                first.setdefault(keys[i], i)
+            unique = list(first.values())
         else:
-            flow = InstalledAppFlow.from_client_secrets_file('credentials.json', SCOPES)
-            creds = flow.run_local_server(port=0)
-        with open('token.json', 'w') as token:
-            token.write(creds.to_json())
-    return build('gmail', 'v1', credentials=creds)
-
-def send_email(to_address, subject, body_text):
-    print(f"to_address: {to_address}, subject: {subject}, body_text: {body_text}")
-    service = get_gmail_service()
-    message = MIMEText(body_text)
-    message['to'] = to_address
-    message['from'] = "stonetsai96@gmail.com"
-    message['subject'] = subject
-    raw = base64.urlsafe_b64encode(message.as_bytes()).decode()
-    body = {'raw': raw}
-    service.users().messages().send(userId="me", body=body).execute()
-    print(f"✅ Email sent to {to_address}")
+            unique = pending
+        parsed = model_parse_requests([user_inputs[i] for i in unique], contacts, batch_size, constrained,
+                                      [adapters[i] for i in unique])
+        for i, p in zip(unique, parsed):
+            results[i] = p
+            if PARSE_CACHE:
+                parse_cache.put(keys[i], version, p)
+        if PARSE_CACHE:
+            by_key = {keys[i]: results[i] for i in unique}
+            for i in pending:
+                results[i] = by_key[keys[i]]
+        metrics.inc("parse_requests_total", len(pending), source="model")
+        metrics.inc("parse_failures_total", sum(results[i] is None for i in pending))
+    return results
+
+def model_parse_requests(user_inputs: list, contacts: dict, batch_size=None, constrained=None, adapters=None):
+    global prefix_cache
+    from inference import generate_batch, PrefixCache, DEFAULT_BATCH_SIZE
+    if batch_size is None:
+        batch_size = DEFAULT_BATCH_SIZE
+    if constrained is None:
+        constrained = CONSTRAINED_DECODING
+    if MULTI_ADAPTER:
+        return pool_parse_requests(user_inputs, contacts, batch_size, constrained, adapters)
+    if any(a not in (None, DEFAULT_ADAPTER) for a in adapters or []):
+        print("❌ Named adapters need MULTI_ADAPTER=1")
+        ok = [i for i, a in enumerate(adapters) if a in (None, DEFAULT_ADAPTER)]
+        results = [None] * len(user_inputs)
+        if ok:
+            parsed = model_parse_requests([user_inputs[i] for i in ok], contacts, batch_size, constrained)
+            for i, p in zip(ok, parsed):
+                results[i] = p
+        return results
+    if prefix_cache is None:
+        prefix_cache = PrefixCache()
+    with metrics.span("model_load"):
+        tokenizer, model = get_model(model_name, adapter_dir)
+    constraint = decoding_for(tokenizer, constrained)
+    if PREFIX_CACHE and batch_size == 1 and supports_kv_reuse(model):
+        # Sequential path: only the request suffix is prefilled on each call
+        generations = prefix_cache.generate(
+            tokenizer, model, build_prompt_prefix(),
+            [build_prompt_suffix(user_input) for user_input in user_inputs],
+            max_new_tokens=200,
+            constraint=constraint
+        )
+    else:
+        prompts = [build_prompt(user_input) for user_input in user_inputs]
+        generations = generate_batch(
+            tokenizer, model, prompts,
+            max_new_tokens=200,
+            batch_size=batch_size,
+            constraint=constraint
+        )
+    return [validate_output(g.text, contacts) for g in generations]
+
+def pool_parse_requests(user_inputs: list, contacts: dict, batch_size, constrained, adapters=None):
+    # Same as the single-model path, on the shared adapter pool. No prefix
+    # KV cache here: the LoRA deltas change the keys and values per adapter.
+    pool = get_adapter_pool()
+    names = [a or DEFAULT_ADAPTER for a in adapters or [None] * len(user_inputs)]
+    known = [i for i, n in enumerate(names) if n in pool]
+    for n in sorted({n for n in names if n not in pool}):
+        print(f"❌ Unknown adapter {n}")
+    results = [None] * len(user_inputs)
+    if known:
+        generations = pool.generate([build_prompt(user_inputs[i]) for i in known], [names[i] for i in known],
+                                    max_new_tokens=200, batch_size=batch_size,
+                                    constraint=decoding_for(pool.tokenizer, constrained))
+        for i, g in zip(known, generations):
+            results[i] = validate_output(g.text, contacts)
+    return results
+
+# --- Streaming parse ---
+# Yields event dicts while the model is still generating:
+#   {"event": "delta", "text": ...}          decoded output so far, chunk by chunk
+#   {"event": "field", "key": ..., "value": ...}  a JSON field has closed
+#   {"event": "result", "parsed": ...}       validated EmailRequest/ContactUpdate
+#   {"event": "error", "detail": ...}
+# Generation stops the moment the object closes, and is aborted as soon as the
+# output can no longer become a JSON object, or when `cancel` (a
+# threading.Event, e.g. set on client disconnect) is set.
+def stream_parse_request(user_input: str, contacts, constrained=None, max_new_tokens=200, cancel=None,
+                         adapter=None):
+    if FAST_PATH:
+        parsed = fast_parse(user_input, contacts)
+        if parsed is not None:
+            yield {"event": "result", "parsed": parsed}
+            return
+    if constrained is None:
+        constrained = CONSTRAINED_DECODING
+    from json_constraints import JsonObjectValidator
+    from inference import stream_generate
+    if MULTI_ADAPTER:
+        pool = get_adapter_pool()
+        adapter = adapter or DEFAULT_ADAPTER
+        if adapter not in pool:
+            yield {"event": "error", "detail": f"Unknown adapter {adapter}"}
+            return
+        tokenizer = pool.tokenizer
+        tokens = pool.stream(build_prompt(user_input), adapter, max_new_tokens=max_new_tokens,
+                             constraint=json_decoding(tokenizer) if constrained else None)
+    elif adapter not in (None, DEFAULT_ADAPTER):
+        yield {"event": "error", "detail": "Named adapters need MULTI_ADAPTER=1"}
+        return
+    else:
+        tokenizer, model = get_model(model_name, adapter_dir)
+        tokens = stream_generate(tokenizer, model, build_prompt(user_input), max_new_tokens=max_new_tokens,
+                                 constraint=json_decoding(tokenizer) if constrained else None)
+    token_bytes = json_early_stop(tokenizer).token_bytes
+    validator = JsonObjectValidator()
+    # Tokens can split a multi-byte character; only whole characters are sent
+    decoder = codecs.getincrementaldecoder("utf-8")("replace")
+    try:
+        for ids in tokens:
+            if cancel is not None and cancel.is_set():
+                return
+            for token_id in ids:
+                data = token_bytes(token_id)
+                if not data:
+                    continue
+                delta = decoder.decode(data)
+                if delta:
+                    yield {"event": "delta", "text": delta}
+                seen = len(validator.fields)
+                validator.feed(data)
+                for key in list(validator.fields)[seen:]:
+                    yield {"event": "field", "key": key, "value": validator.fields[key]}
+                if validator.complete or validator.failed:
+                    break
+            if validator.complete or validator.failed:
+                break
+    finally:
+        tokens.close()
+    metrics.inc("parse_requests_total", source="stream")
+    if validator.failed:
+        metrics.inc("parse_failures_total")
+        yield {"event": "error", "detail": "Output stopped being a JSON object; generation aborted"}
+        return
+    if not validator.complete:
+        metrics.inc("parse_failures_total")
+        yield {"event": "error", "detail": "Generation ended before the JSON object was complete"}
+        return
+    with metrics.span("validate"):
+        parsed = validate_json(validator.fields, contacts)
+    if parsed is None:
+        metrics.inc("parse_failures_total")
+        yield {"event": "error", "detail": "JSON did not match EmailRequest or ContactUpdate"}
+        return
+    yield {"event": "result", "parsed": parsed}
 
 # --- Contact management ---
 def update_contacts(contacts: dict, update: dict):
@@ -140,6 +431,9 @@ def update_contacts(contacts: dict, update: dict):
     else:
         print("❌ Unknown action")
 
+    if PARSE_CACHE:
+        # Cached parses resolved receivers against the old address book
+        parse_cache.purge_stale(contacts_version(contacts))
     return contacts
 
 # --- Dispatcher ---
@@ -155,11 +449,12 @@ def handle_request(parsed, contacts):
 
 # --- Main ---
 if __name__ == "__main__":
-    contacts = {
+    # Persisted in contacts.db; the defaults only seed an empty address book
+    contacts = ContactStore(seed={
         "bob": "f74144765@gs.ncku.edu.tw",
         "alice": "stonetsai96@gmail.com",
         "me": "stonetsai96@gmail.com"
-    }
+    })
     while True:    
         print("Tell me your request (either update contact OR send email), Typing quit would end the program.")
         user_input = input().strip()
@@ -1,73 +1,47 @@
-import os, json, base64, re
-from transformers import AutoModelForCausalLM, AutoTokenizer
-from email.mime.text import MIMEText
-from googleapiclient.discovery import build
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-
-SCOPES = ['https://www.googleapis.com/auth/gmail.send']
+import json, re
+from model_registry import get_model
+from mail_transport import send_email
+from contact_store import ContactStore
 
 # 1. Load Qwen locally
 model_name = "Qwen/Qwen3-0.6B"
-tokenizer = AutoTokenizer.from_pretrained(model_name)
-model = AutoModelForCausalLM.from_pretrained(model_name)
 
-def parse_email_request(user_input: str):
-    prompt = f"""
+def build_prompt(user_input: str):
+    return f"""
     You are an assistant that outputs ONLY valid JSON.
     Keys: receiver, subject, body.
     Request: "{user_input}"
     Example: {{"receiver": "Bob", "subject": "nice to meet you", "body": "I am your coworker now!"}}
     """
 
-    inputs = tokenizer(prompt, return_tensors="pt")
-    outputs = model.generate(**inputs, max_new_tokens=200)
+def extract_json(text: str):
+    # Regex to extract JSON object; None when there is none or it does not parse
+    match = re.search(r"\{.*\}", text, re.DOTALL)
+    if not match:
+        return None
+    try:
+        return json.loads(match.group(0))
+    except Exception:
+        return None
 
-    # Slice off the prompt length to get only new tokens
-    generated_tokens = outputs[0][inputs["input_ids"].shape[1]:]
-    text = tokenizer.decode(generated_tokens, skip_special_tokens=True).strip()
+def parse_email_request(user_input: str):
+    from inference import generate_batch
+    tokenizer, model = get_model(model_name, adapter_dir=None)
+    # Only the new tokens after the prompt are decoded
+    text = generate_batch(tokenizer, model, [build_prompt(user_input)], max_new_tokens=200, batch_size=1)[0].text
 
-    # Regex to extract JSON object
-    match = re.search(r"\{.*\}", text, re.DOTALL)
-    if match:
-        try:
-            return json.loads(match.group(0))
-        except Exception as e:
-            print("⚠️ JSON parse failed:", e)
-            print("Raw output:", text)
-            return {"receiver": None, "subject": "Unparsed", "body": text}
+    parsed = extract_json(text)
+    if parsed is not None:
+        return parsed
+    if re.search(r"\{.*\}", text, re.DOTALL):
+        print("⚠️ JSON parse failed")
+        print("Raw output:", text)
     else:
         print("⚠️ No JSON found, raw output was:")
         print(text)
-        return {"receiver": None, "subject": "Unparsed", "body": text}
-
-# 2. Gmail API setup
-def get_gmail_service():
-    creds = None
-    if os.path.exists('token.json'):
-        creds = Credentials.from_authorized_user_file('token.json', SCOPES)
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
-        else:
-            flow = InstalledAppFlow.from_client_secrets_file('credentials.json', SCOPES)
-            creds = flow.run_local_server(port=0)
-        with open('token.json', 'w') as token:
-            token.write(creds.to_json())
-    return build('gmail', 'v1', credentials=creds)
+    return {"receiver": None, "subject": "Unparsed", "body": text}
 
-def send_email(to_address, subject, body_text):
-    print(f"to_address: {to_address}, subject: {subject}, body_text: {body_text}")
-    service = get_gmail_service()
-    message = MIMEText(body_text)
-    message['to'] = to_address
-    message['from'] = "stonetsai96@gmail.com"
-    message['subject'] = subject
-    raw = base64.urlsafe_b64encode(message.as_bytes()).decode()
-    body = {'raw': raw}
-    service.users().messages().send(userId="me", body=body).execute()
-    print(f"✅ Email sent to {to_address}")
+# 2. Gmail API setup: see mail_transport.send_email
 
 # 3. Combine everything
 if __name__ == "__main__":
@@ -75,8 +49,8 @@ if __name__ == "__main__":
     user_input = input().strip()
     parsed = parse_email_request(user_input)
 
-    # Map receiver name to actual email
-    contacts = {
+    # Map receiver name to actual email (exact or case/width-folded match only)
+    contacts = ContactStore(":memory:", seed={
         "王士豪": "shyhhau@gmail.com",
         "郭耀煌": "kuoyh@ismp.csie.ncku.edu.tw",
         "謝孫源": "hsiehsy@mail.ncku.edu.tw",
@@ -119,11 +93,13 @@ if __name__ == "__main__":
         "郭軒安": "hsuanankuo@gs.ncku.edu.tw",
         "李信杰": "jielee@mail.ncku.edu.tw",
         "張瑞紘": "changrh@ncku.edu.tw"
-    }
-
+    })
 
-    to_address = contacts.get(parsed.get("receiver"))
+    match = contacts.resolve(parsed.get("receiver") or "")
+    to_address = match[1] if match else None
     if not to_address:
-        print("❌ Failing to send email, cannot find whom to send to!")
+        suggestions = contacts.suggest(parsed.get("receiver") or "")
+        hint = f" Did you mean {', '.join(name for name, _ in suggestions)}?" if suggestions else ""
+        print("❌ Failing to send email, cannot find whom to send to!" + hint)
     else:
         send_email(to_address, parsed.get("subject", "No Subject"), parsed.get("body", ""))
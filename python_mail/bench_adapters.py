@@ -0,0 +1,101 @@
+import argparse, os, time
+# bench_parse also switches metrics off (METRICS=0) unless asked for
+from bench_parse import load_instructions, percentile
+
+def rss_mb():
+    import psutil
+    return psutil.Process().memory_info().rss / 2**20
+
+def param_mb(model):
+    return sum(p.numel() * p.element_size() for p in model.parameters()) / 2**20
+
+def timed_ms(fn, repeat):
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - start)
+    return 1000 * percentile(latencies, 50), 1000 * percentile(latencies, 95)
+
+# --- N adapters on one base vs N full model copies ---
+def bench_adapters(paths, count, n, batch_size, max_new_tokens, repeat, base_model, dtype):
+    from adapter_pool import AdapterPool
+    import ai_and_send_mail as parser
+    # Fewer adapter directories than --count: the same weights under several names
+    names = [f"a{i}" for i in range(count)]
+    sources = [paths[i % len(paths)] for i in range(count)]
+    prompts = [parser.build_prompt(t) for t in load_instructions(n=n)][:batch_size]
+
+    before_mb = rss_mb()
+    pool = AdapterPool(base_model, dtype=dtype)
+    start = time.perf_counter()
+    pool._ensure_base()
+    base_load_s = time.perf_counter() - start
+    base_rss_mb = rss_mb() - before_mb
+    base_param_mb = param_mb(pool.model)
+    print(f"🧱 Base {base_model}: {base_param_mb:.0f} MB of weights, +{base_rss_mb:.0f} MB RSS, "
+          f"loaded in {base_load_s:.2f}s")
+
+    print(f"{'adapter':<8} {'load ms':>8} {'weights MB':>11} {'RSS MB':>8}")
+    for name, path in zip(names, sources):
+        mark = rss_mb()
+        info = pool.load(name, path)
+        print(f"{name:<8} {1000 * info['load_s']:8.1f} {info['bytes'] / 2**20:11.2f} {rss_mb() - mark:8.1f}")
+    adapters_mb = sum(a["bytes"] for a in pool.adapters.values()) / 2**20
+
+    # Switching: alternate between two adapters so every call really switches
+    if count > 1:
+        pool._activate(names[0])
+        latencies = []
+        for i in range(max(repeat, 50)):
+            start = time.perf_counter()
+            pool._activate(names[1 - i % 2])
+            latencies.append(time.perf_counter() - start)
+        p50, p95 = 1000 * percentile(latencies, 50), 1000 * percentile(latencies, 95)
+        print(f"🔀 set_adapter switch: p50 {p50:.3f} ms  p95 {p95:.3f} ms")
+
+    # One batch: every row on one adapter, rows spread over all adapters
+    # (one generate with per-row adapter names), and the same spread run as
+    # one sub-batch per adapter
+    mixed = [names[i % count] for i in range(len(prompts))]
+    def grouped():
+        for name in dict.fromkeys(mixed):
+            rows = [p for p, a in zip(prompts, mixed) if a == name]
+            pool.generate(rows, [name] * len(rows), max_new_tokens=max_new_tokens, batch_size=len(rows))
+    runs = {
+        "same adapter": lambda: pool.generate(prompts, [names[0]] * len(prompts), max_new_tokens=max_new_tokens,
+                                              batch_size=len(prompts)),
+        "mixed (adapter_names)": lambda: pool.generate(prompts, mixed, max_new_tokens=max_new_tokens,
+                                                       batch_size=len(prompts)),
+        "grouped per adapter": grouped,
+    }
+    runs["same adapter"]()   # warm-up
+    print(f"{'batch of ' + str(len(prompts)):<24} {'p50 ms':>9} {'p95 ms':>9}")
+    for label, fn in runs.items():
+        p50, p95 = timed_ms(fn, repeat)
+        print(f"{label:<24} {p50:9.1f} {p95:9.1f}")
+
+    start = time.perf_counter()
+    for name in names:
+        pool.unload(name)
+    print(f"🗑️  Unloaded {count} adapters in {1000 * (time.perf_counter() - start):.1f} ms")
+
+    shared = base_param_mb + adapters_mb
+    copies = count * base_param_mb + adapters_mb
+    print(f"📦 {count} adapters on one base: {shared:.0f} MB of weights vs {copies:.0f} MB "
+          f"for {count} full model copies ({copies / shared:.1f}x)")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Memory, load, switch and batch cost of several LoRA adapters on one base")
+    parser.add_argument("--adapters", nargs="+", default=["./qwen-lora-json"],
+                        help="adapter directories; reused round-robin up to --count")
+    parser.add_argument("--count", type=int, default=4, help="number of named adapters to load")
+    parser.add_argument("--n", type=int, default=8, help="dataset instructions to draw prompts from")
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--base-model", default="Qwen/Qwen3-0.6B")
+    parser.add_argument("--dtype", choices=["float32", "bfloat16"], default="float32")
+    args = parser.parse_args()
+    bench_adapters(args.adapters, args.count, args.n, args.batch_size, args.max_new_tokens, args.repeat,
+                   args.base_model, None if args.dtype == "float32" else args.dtype)
@@ -0,0 +1,61 @@
+import argparse, os, random, tempfile, time
+from contact_store import ContactStore
+
+SYLLABLES = ["an", "bo", "chen", "da", "el", "fu", "gi", "hao", "li", "ming", "na", "or", "pei", "qi",
+             "ro", "shu", "ta", "wei", "xin", "ya", "zhi"]
+SURNAMES = "王李張劉陳楊黃趙吳周徐孫馬朱胡郭何林羅高鄭謝蔡許蘇"
+GIVEN = "士豪耀煌孫源震杰中平勝富同益宗憲崇明裕民響亮榮先培殷大和文鈺燕光銓清宏章"
+
+def random_name(rng):
+    if rng.random() < 0.5:
+        return "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))).capitalize() + \
+            " " + "".join(rng.choice(SYLLABLES) for _ in range(2)).capitalize()
+    return rng.choice(SURNAMES) + "".join(rng.choice(GIVEN) for _ in range(rng.randint(1, 2)))
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+def timed_each(fn, args):
+    latencies = []
+    for a in args:
+        start = time.perf_counter()
+        fn(a)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+def report(label, latencies):
+    print(f"  {label:<20} p50 {1e6 * percentile(latencies, 50):9.1f} us  p95 {1e6 * percentile(latencies, 95):9.1f} us")
+
+def typo(name, rng):
+    i = rng.randrange(len(name))
+    return name[:i] + name[i + 1:] if len(name) > 2 else name
+
+# --- Lookup/write latency at a given address-book size ---
+def bench_size(n, queries, seed=0):
+    rng = random.Random(seed)
+    names = list({random_name(rng) for _ in range(n * 2)})[:n]
+    with tempfile.TemporaryDirectory() as tmp:
+        store = ContactStore(os.path.join(tmp, "contacts.db"))
+        start = time.perf_counter()
+        store.add_many((name, f"user{i}@example.com") for i, name in enumerate(names))
+        load_s = time.perf_counter() - start
+
+        sample = [rng.choice(names) for _ in range(queries)]
+        print(f"{len(names)} contacts (bulk load {load_s:.2f}s, {len(names) / load_s:.0f} rows/s)")
+        report("exact", timed_each(store.resolve, sample))
+        report("case-folded", timed_each(store.resolve, [s.upper() for s in sample]))
+        report("suggest (1 char off)", timed_each(store.suggest, [typo(s, rng) for s in sample]))
+        report("dict lookup", timed_each(store.__getitem__, sample))
+        report("add", timed_each(lambda i: store.__setitem__(f"new contact {i}", "new@example.com"), range(queries)))
+        report("update", timed_each(lambda s: store.__setitem__(s, "changed@example.com"), sample[:queries // 2]))
+        report("delete", timed_each(store.__delitem__, [f"new contact {i}" for i in range(queries)]))
+        store.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="ContactStore lookup and write benchmarks")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000])
+    parser.add_argument("--queries", type=int, default=500)
+    args = parser.parse_args()
+    for n in args.sizes:
+        bench_size(n, args.queries)
@@ -0,0 +1,290 @@
+import argparse, json, os, random, re, tempfile, threading, time, uuid
+import httplib2
+from googleapiclient.discovery import build
+from google.oauth2.credentials import Credentials
+from google_auth_httplib2 import AuthorizedHttp
+from mail_transport import GmailTransport, SmtpTransport, SCOPES, build_message, build_mime
+
+# --- Stubbed Gmail HTTP layer ---
+# Stands in for httplib2.Http: answers messages.send and /batch requests
+# locally after an optional simulated round-trip latency, so only client-side
+# overhead is measured. throttle_rate makes that share of sends answer 429.
+class MockGmailHttp:
+    def __init__(self, latency=0.0, throttle_rate=0.0, seed=0):
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.requests = 0
+        self.messages = 0
+        self.throttled = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _send_one(self):
+        with self._lock:
+            if self._rng.random() < self.throttle_rate:
+                self.throttled += 1
+                return 429, {"error": {"code": 429, "message": "Rate Limit Exceeded"}}
+            self.messages += 1
+        return 200, {"id": uuid.uuid4().hex[:16], "labelIds": ["SENT"]}
+
+    def request(self, uri, method="GET", body=None, headers=None, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.requests += 1
+        if uri.rstrip("/").endswith("/batch") or "/batch/" in uri:
+            return self._batch(body)
+        status, payload = self._send_one()
+        return (httplib2.Response({"status": str(status), "content-type": "application/json"}),
+                json.dumps(payload).encode())
+
+    def _batch(self, body):
+        boundary = "mock_batch_boundary"
+        parts = []
+        for content_id in re.findall(r"Content-ID: <([^>]+)>", body):
+            status, payload = self._send_one()
+            reason = "OK" if status == 200 else "Too Many Requests"
+            parts.append(
+                f"--{boundary}\r\nContent-Type: application/http\r\n"
+                f"Content-ID: <response-{content_id}>\r\n\r\n"
+                f"HTTP/1.1 {status} {reason}\r\nContent-Type: application/json\r\n\r\n"
+                f"{json.dumps(payload)}\r\n"
+            )
+        content = "".join(parts) + f"--{boundary}--\r\n"
+        headers = {"status": "200", "content-type": f"multipart/mixed; boundary={boundary}"}
+        return httplib2.Response(headers), content.encode()
+
+def write_fake_token(directory):
+    # A still-valid access token, so neither path ever goes to Google
+    path = os.path.join(directory, "token.json")
+    with open(path, "w") as f:
+        json.dump({"token": "fake-access-token", "refresh_token": "fake-refresh-token",
+                   "client_id": "fake", "client_secret": "fake", "scopes": SCOPES,
+                   "expiry": "2099-01-01T00:00:00Z"}, f)
+    return path
+
+def report(label, n, seconds):
+    print(f"{label:<28} {n:>6} msgs  {seconds:8.3f}s  {1000 * seconds / n:8.3f} ms/msg  {n / seconds:9.1f} msgs/sec")
+
+# --- Per-send rebuild (old send_email) vs cached transport ---
+def bench_transport(n, latency):
+    with tempfile.TemporaryDirectory() as tmp:
+        token_file = write_fake_token(tmp)
+        mock = MockGmailHttp(latency)
+
+        def legacy_send(i):
+            # What every send_email used to do: read token.json, build the client
+            creds = Credentials.from_authorized_user_file(token_file, SCOPES)
+            service = build('gmail', 'v1', http=AuthorizedHttp(creds, http=mock), static_discovery=True)
+            body = build_message(f"user{i}@example.com", "Benchmark", "hello")
+            service.users().messages().send(userId="me", body=body).execute()
+
+        transport = GmailTransport(token_file=token_file, http_factory=lambda: mock)
+        transport.send("warmup@example.com", "Benchmark", "hello")
+
+        start = time.perf_counter()
+        for i in range(n):
+            legacy_send(i)
+        legacy_s = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for i in range(n):
+            transport.send(f"user{i}@example.com", "Benchmark", "hello")
+        cached_s = time.perf_counter() - start
+
+    report("rebuild per send", n, legacy_s)
+    report("cached transport", n, cached_s)
+    print(f"speedup: {legacy_s / cached_s:.2f}x")
+
+# --- One send per request vs Gmail batch requests ---
+def bench_bulk(n, latency, throttle_rate):
+    with tempfile.TemporaryDirectory() as tmp:
+        token_file = write_fake_token(tmp)
+        messages = [(f"user{i}@example.com", "Benchmark", f"hello #{i}") for i in range(n)]
+
+        mock = MockGmailHttp(latency)
+        transport = GmailTransport(token_file=token_file, http_factory=lambda: mock)
+        start = time.perf_counter()
+        for to_address, subject, body_text in messages:
+            transport.send(to_address, subject, body_text)
+        single_s = time.perf_counter() - start
+        single_trips = mock.requests
+
+        mock = MockGmailHttp(latency, throttle_rate)
+        transport = GmailTransport(token_file=token_file, http_factory=lambda: mock)
+        start = time.perf_counter()
+        # Backoff sleeps are skipped so the number reflects transport cost only
+        results = transport.send_bulk(messages, sleep=lambda s: None)
+        bulk_s = time.perf_counter() - start
+
+    delivered = sum(1 for r in results if r["ok"])
+    report(f"messages.send x{n} ({single_trips} trips)", n, single_s)
+    report(f"send_bulk ({mock.requests} trips)", n, bulk_s)
+    print(f"delivered {delivered}/{n}, throttled responses {mock.throttled}, "
+          f"max attempts {max(r['attempts'] for r in results)}")
+    print(f"speedup: {single_s / bulk_s:.2f}x")
+
+# --- Local SMTP sink (aiosmtpd) ---
+# Accepts and counts every message after an optional per-message delay;
+# throttle_rate makes that share of messages answer 451 (try again later).
+class SinkHandler:
+    def __init__(self, latency=0.0, throttle_rate=0.0, seed=0):
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.messages = 0
+        self.throttled = 0
+        self.sessions = 0
+        self._rng = random.Random(seed)
+
+    async def handle_EHLO(self, server, session, envelope, hostname, responses):
+        self.sessions += 1
+        session.host_name = hostname
+        return responses
+
+    async def handle_DATA(self, server, session, envelope):
+        if self.latency:
+            import asyncio
+            await asyncio.sleep(self.latency)
+        if self._rng.random() < self.throttle_rate:
+            self.throttled += 1
+            return "451 4.7.1 Try again later"
+        self.messages += 1
+        return "250 OK"
+
+def smtp_sink(handler, port):
+    from aiosmtpd.controller import Controller
+    controller = Controller(handler, hostname="127.0.0.1", port=port)
+    controller.start()
+    return controller
+
+# --- New connection per message vs pooled persistent connections ---
+def bench_smtp(n, latency, throttle_rate, port, pool_sizes):
+    import smtplib
+    messages = [(f"user{i}@example.com", "Benchmark", f"hello #{i}") for i in range(n)]
+    handler = SinkHandler(latency)
+    controller = smtp_sink(handler, port)
+    try:
+        start = time.perf_counter()
+        for to_address, subject, body_text in messages:
+            # Connect, EHLO, send, QUIT for every message
+            with smtplib.SMTP("127.0.0.1", port) as smtp:
+                smtp.send_message(build_mime(to_address, subject, body_text))
+        report(f"smtplib, {handler.sessions} conns", n, time.perf_counter() - start)
+
+        transport = SmtpTransport("127.0.0.1", port, tls="none", pool_size=1)
+        start = time.perf_counter()
+        for to_address, subject, body_text in messages:
+            transport.send(to_address, subject, body_text)
+        report(f"pooled send(), {transport.connects} conns", n, time.perf_counter() - start)
+        transport.close()
+
+        for pool_size in pool_sizes:
+            handler.throttle_rate = throttle_rate
+            handler.throttled = 0
+            transport = SmtpTransport("127.0.0.1", port, tls="none", pool_size=pool_size)
+            start = time.perf_counter()
+            results = transport.send_bulk(messages, sleep=lambda s: None)
+            seconds = time.perf_counter() - start
+            delivered = sum(1 for r in results if r["ok"])
+            report(f"send_bulk x{pool_size}, {transport.connects} conns", n, seconds)
+            if throttle_rate:
+                print(f"   delivered {delivered}/{n}, throttled {handler.throttled}, "
+                      f"max attempts {max(r['attempts'] for r in results)}")
+            transport.close()
+    finally:
+        controller.stop()
+
+# --- Durable outbox against a quota-enforcing mock ---
+# Accepts `quota` messages per second (bursts of up to `quota`); anything
+# beyond answers 429 with a Retry-After, and error_rate of sends get a 503.
+class QuotaTransport:
+    def __init__(self, quota, error_rate=0.0, latency=0.0, seed=0):
+        self.quota = quota
+        self.error_rate = error_rate
+        self.latency = latency
+        self.tokens = float(quota)
+        self.updated = time.monotonic()
+        self.delivered = 0
+        self.throttled = 0
+        self.errors = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def send_bulk(self, messages, max_attempts=1):
+        if self.latency:
+            time.sleep(self.latency)
+        results = []
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.quota, self.tokens + (now - self.updated) * self.quota)
+            self.updated = now
+            for to_address, _, _ in messages:
+                if self.tokens < 1:
+                    self.throttled += 1
+                    results.append({"to": to_address, "ok": False, "error": "429 Rate Limit Exceeded",
+                                    "retryable": True, "retry_after": 1.0, "throttled": True})
+                elif self._rng.random() < self.error_rate:
+                    self.errors += 1
+                    results.append({"to": to_address, "ok": False, "error": "503 Backend Error",
+                                    "retryable": True, "retry_after": None})
+                else:
+                    self.tokens -= 1
+                    self.delivered += 1
+                    results.append({"to": to_address, "ok": True, "id": uuid.uuid4().hex[:16], "error": None})
+        return results
+
+def bench_outbox(n, quota, error_rate, latency, interactive_every=20):
+    import asyncio
+    from mail_outbox import DurableOutbox
+
+    async def run(rate):
+        with tempfile.TemporaryDirectory() as tmp:
+            transport = QuotaTransport(quota, error_rate, latency)
+            outbox = DurableOutbox(transport.send_bulk, path=os.path.join(tmp, "outbox.db"), rate=rate,
+                                   burst=max(1, int(quota)), maxsize=n + 1)
+            await outbox.start()
+            start = time.perf_counter()
+            bulk_ids = outbox.submit_many([(f"user{i}@example.com", "Campaign", f"hello #{i}") for i in range(n)])
+            # Interactive mail keeps arriving while the bulk job drains
+            interactive = []
+            while True:
+                depth = outbox.metrics()
+                if depth["queue_depth"] == 0 and depth["sending"] == 0:
+                    break
+                if len(interactive) < n // interactive_every:
+                    interactive.append(outbox.submit("boss@example.com", "Now", "interactive"))
+                await asyncio.sleep(0.05)
+            seconds = time.perf_counter() - start
+            waits = [s["sent_at"] - s["queued_at"] for s in map(outbox.status, interactive) if s["state"] == "sent"]
+            final = outbox.metrics()
+            await outbox.stop()
+        label = f"rate {rate:g}/s" if rate else "unpaced"
+        report(f"outbox {label}", final["sent"], seconds)
+        print(f"   sent {final['sent']}, failed {final['failed']}, 429s {transport.throttled}, "
+              f"503s {transport.errors}, interactive p50 wait "
+              f"{1000 * sorted(waits)[len(waits) // 2] if waits else float('nan'):.0f} ms")
+        return bulk_ids
+
+    asyncio.run(run(0))
+    asyncio.run(run(quota))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mail transport benchmarks against a stubbed Gmail HTTP layer or a local SMTP sink")
+    parser.add_argument("--n", type=int, default=200, help="messages per run")
+    parser.add_argument("--latency", type=float, default=0.0, help="simulated round-trip seconds")
+    parser.add_argument("--mode", choices=["transport", "bulk", "smtp", "outbox"], default="transport")
+    parser.add_argument("--throttle-rate", type=float, default=0.0,
+                        help="share of sends answered with 429 (bulk) or 451 (smtp)")
+    parser.add_argument("--smtp-port", type=int, default=8025, help="port for the local aiosmtpd sink")
+    parser.add_argument("--pool-sizes", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("--quota", type=float, default=50, help="messages/sec the mock accepts (outbox)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of sends answered with 503 (outbox)")
+    args = parser.parse_args()
+    if args.mode == "bulk":
+        bench_bulk(args.n, args.latency, args.throttle_rate)
+    elif args.mode == "outbox":
+        bench_outbox(args.n, args.quota, args.error_rate, args.latency)
+    elif args.mode == "smtp":
+        bench_smtp(args.n, args.latency, args.throttle_rate, args.smtp_port, args.pool_sizes)
+    else:
+        bench_transport(args.n, args.latency)
@@ -0,0 +1,142 @@
+import argparse, json, os, time
+
+# Spans and counters off unless asked for (METRICS=1): nothing but the
+# measured code on the clock
+os.environ.setdefault("METRICS", "0")
+
+DATA_FILE = "dataset.jsonl"
+
+def load_instructions(path=DATA_FILE, n=32):
+    instructions = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            instructions.append(json.loads(line)["instruction"])
+            if len(instructions) >= n:
+                break
+    return instructions
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+def report(label, n, seconds):
+    print(f"{label:<28} {n:>5} instr  {seconds:8.2f}s  {n / seconds:8.2f} instr/sec")
+
+def parser_pair(pipeline):
+    # Returns (one, many): the per-call entry point and its batched counterpart
+    if pipeline == "lora":
+        from infer_qwen_loar import generate_output, generate_outputs
+        return generate_output, lambda ts, batch_size: generate_outputs(ts, batch_size=batch_size)
+    from ai_and_send_mail import parse_request, parse_requests
+    contacts = {"bob": "f74144765@gs.ncku.edu.tw", "alice": "stonetsai96@gmail.com"}
+    return (lambda t: parse_request(t, contacts),
+            lambda ts, batch_size: parse_requests(ts, contacts, batch_size=batch_size))
+
+# --- Per-call loop vs one batched generate() ---
+def bench_batching(instructions, batch_size, pipeline):
+    one, many = parser_pair(pipeline)
+    # Warm up so the model load is not billed to either side
+    one(instructions[0])
+
+    _, loop_s = timed(lambda: [one(t) for t in instructions])
+    _, batch_s = timed(lambda: many(instructions, batch_size))
+    report("per-call loop", len(instructions), loop_s)
+    report(f"batched (batch_size={batch_size})", len(instructions), batch_s)
+    print(f"speedup: {loop_s / batch_s:.2f}x")
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+# --- Free decoding vs schema-constrained decoding (parse_request path) ---
+def bench_constrained(instructions):
+    from model_registry import get_model
+    from inference import generate_batch
+    import ai_and_send_mail as parser
+    contacts = {"bob": "f74144765@gs.ncku.edu.tw", "alice": "stonetsai96@gmail.com"}
+    tokenizer, model = get_model(parser.model_name, parser.adapter_dir)
+    decoding = parser.json_decoding(tokenizer)
+
+    for label, constraint in [("free decoding", None), ("constrained", decoding)]:
+        latencies, tokens, valid = [], [], 0
+        for t in instructions:
+            start = time.perf_counter()
+            g = generate_batch(tokenizer, model, [parser.build_prompt(t)],
+                               max_new_tokens=200, batch_size=1, constraint=constraint)[0]
+            valid += parser.validate_output(g.text, contacts) is not None
+            latencies.append(time.perf_counter() - start)
+            tokens.append(g.new_tokens)
+        print(f"{label:<14} tokens/request {sum(tokens) / len(tokens):6.1f}  "
+              f"p50 {1000 * percentile(latencies, 50):8.1f} ms  p95 {1000 * percentile(latencies, 95):8.1f} ms  "
+              f"valid {valid}/{len(instructions)}")
+
+# --- Time to first token: full prefill vs reused prefix KV cache ---
+def bench_prefix(instructions):
+    from model_registry import get_model
+    from inference import generate_batch, PrefixCache
+    import ai_and_send_mail as parser
+    tokenizer, model = get_model(parser.model_name, parser.adapter_dir)
+    cache = PrefixCache()
+    prefix = parser.build_prompt_prefix()
+
+    # max_new_tokens=1 makes each call's latency its time to first token
+    _, build_s = timed(lambda: cache.generate(tokenizer, model, prefix, [parser.build_prompt_suffix("warmup")], max_new_tokens=1))
+    full, cached = [], []
+    for t in instructions:
+        _, s = timed(lambda: generate_batch(tokenizer, model, [parser.build_prompt(t)], max_new_tokens=1, batch_size=1))
+        full.append(s)
+        _, s = timed(lambda: cache.generate(tokenizer, model, prefix, [parser.build_prompt_suffix(t)], max_new_tokens=1))
+        cached.append(s)
+
+    print(f"prefix tokens: {len(tokenizer(prefix)['input_ids'])}, initial prefix build {1000 * build_s:.1f} ms")
+    for label, values in [("full prefill", full), ("prefix cache", cached)]:
+        print(f"{label:<14} TTFT p50 {1000 * percentile(values, 50):8.1f} ms  p95 {1000 * percentile(values, 95):8.1f} ms")
+    print(f"speedup (p50): {percentile(full, 50) / percentile(cached, 50):.2f}x")
+
+# --- Plain greedy vs prompt-lookup decoding (infer_qwen_loar prompt) ---
+def bench_lookup(instructions, max_new_tokens=128):
+    from model_registry import get_model
+    from inference import generate_batch, PromptLookupDecoder
+    import infer_qwen_loar as lora
+    tokenizer, model = get_model(lora.BASE_MODEL, lora.ADAPTER_DIR)
+    prompts = [lora.build_prompt(t) for t in instructions]
+    decoder = PromptLookupDecoder()
+    generate_batch(tokenizer, model, prompts[:1], max_new_tokens=8, batch_size=1)   # warm-up
+
+    greedy, lookup, same, tokens = [], [], 0, 0
+    for p in prompts:
+        g, s = timed(lambda: generate_batch(tokenizer, model, [p], max_new_tokens=max_new_tokens,
+                                            batch_size=1, do_sample=False)[0])
+        greedy.append(s)
+        d, s = timed(lambda: decoder.generate(tokenizer, model, [p], max_new_tokens=max_new_tokens)[0])
+        lookup.append(s)
+        same += g.text == d.text
+        tokens += d.new_tokens
+
+    stats = decoder.stats()
+    for label, values in [("greedy", greedy), ("prompt lookup", lookup)]:
+        print(f"{label:<14} p50 {1000 * percentile(values, 50):8.1f} ms  p95 {1000 * percentile(values, 95):8.1f} ms  "
+              f"{tokens / sum(values):7.1f} tokens/sec")
+    print(f"accept rate {stats['accept_rate']:.1%} ({stats['accepted']}/{stats['drafted']} drafted), "
+          f"{stats['tokens_per_pass']:.2f} tokens per forward pass, identical outputs {same}/{len(prompts)}")
+    print(f"speedup: {sum(greedy) / sum(lookup):.2f}x")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Parser throughput benchmarks")
+    parser.add_argument("--n", type=int, default=32, help="number of dataset instructions")
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--pipeline", choices=["lora", "parse"], default="lora",
+                        help="lora: infer_qwen_loar.generate_output, parse: ai_and_send_mail.parse_request")
+    parser.add_argument("--mode", choices=["batching", "constrained", "prefix", "lookup"], default="batching")
+    args = parser.parse_args()
+
+    instructions = load_instructions(n=args.n)
+    if args.mode == "constrained":
+        bench_constrained(instructions)
+    elif args.mode == "prefix":
+        bench_prefix(instructions)
+    elif args.mode == "lookup":
+        bench_lookup(instructions)
+    else:
+        bench_batching(instructions, args.batch_size, args.pipeline)
@@ -0,0 +1,114 @@
+import argparse, json, os, shutil, signal, subprocess, sys, tempfile, threading, time
+from bench_parse import load_instructions, percentile
+
+# Each configuration is a fresh `serve.py` process tree. Memory is summed over
+# the parent and its workers: RSS counts shared weight pages once per process,
+# PSS splits them between the processes sharing them (what the box really pays).
+def tree_memory_mb(pid):
+    import psutil
+    root = psutil.Process(pid)
+    procs = [root, *root.children(recursive=True)]
+    rss = pss = 0
+    for p in procs:
+        m = p.memory_full_info()
+        rss += m.rss
+        pss += getattr(m, "pss", m.rss)   # PSS is Linux-only
+    return rss / 2**20, pss / 2**20, len(procs) - 1
+
+def wait_ready(url, proc, workers, timeout):
+    # Every worker answers /readyz on its own; require a run of successes
+    # long enough that all of them have most likely been asked
+    import httpx
+    deadline = time.time() + timeout
+    streak = 0
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"serve.py exited with {proc.returncode}")
+        try:
+            ok = httpx.get(url + "/readyz", timeout=5).status_code == 200
+        except httpx.HTTPError:
+            ok = False
+        streak = streak + 1 if ok else 0
+        if streak >= 4 * workers:
+            return
+        time.sleep(0.05 if ok else 0.5)
+    raise RuntimeError("workers not ready in time")
+
+def load_test(url, texts, requests, concurrency):
+    import httpx
+    latencies, statuses = [], {}
+    lock = threading.Lock()
+    counter = iter(range(requests))
+
+    def client():
+        with httpx.Client(base_url=url, timeout=300) as http:
+            for i in counter:
+                start = time.perf_counter()
+                status = http.post("/parse_and_dispatch", json={"text": texts[i % len(texts)]}).status_code
+                with lock:
+                    latencies.append(time.perf_counter() - start)
+                    statuses[status] = statuses.get(status, 0) + 1
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time.perf_counter() - start, latencies, statuses
+
+def run(load, workers, args, texts, port):
+    cmd = [sys.executable, "serve.py", "--port", str(port), "--workers", str(workers), "--load", load,
+           "--threads", str(args.threads), "--base-model", args.base_model, "--adapter-dir", args.adapter_dir]
+    with tempfile.TemporaryDirectory() as tmp:
+        # Model-only parsing, a fake mail transport and a throwaway address book
+        env = {**os.environ, "MAIL_TRANSPORT": "fake", "FAST_PATH": "0", "PARSE_CACHE": "0", "METRICS": "0",
+               "CONTACTS_DB": os.path.join(tmp, "contacts.db")}
+        if os.path.exists("contacts.db"):
+            shutil.copy("contacts.db", env["CONTACTS_DB"])
+        proc = subprocess.Popen(cmd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            url = f"http://127.0.0.1:{port}"
+            wait_ready(url, proc, workers, args.timeout)
+            load_test(url, texts, 2 * workers, workers)   # warm-up: first request per worker
+            rss_mb, pss_mb, children = tree_memory_mb(proc.pid)
+            seconds, latencies, statuses = load_test(url, texts, args.requests, args.concurrency or 2 * workers)
+        finally:
+            proc.send_signal(signal.SIGTERM)
+            try:
+                proc.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+    return {"load": load, "workers": children, "rss_mb": rss_mb, "pss_mb": pss_mb,
+            "throughput": args.requests / seconds, "p50_ms": 1000 * percentile(latencies, 50),
+            "p95_ms": 1000 * percentile(latencies, 95), "statuses": statuses}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Total memory and aggregate throughput of serve.py as workers scale")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--load", nargs="+", choices=["parent", "worker"], default=["parent", "worker"],
+                        help="parent: pre-fork shared weights; worker: one copy per worker")
+    parser.add_argument("--threads", type=int, default=0, help="torch threads per worker, 0 = cores / workers")
+    parser.add_argument("--requests", type=int, default=64)
+    parser.add_argument("--concurrency", type=int, default=0, help="client threads, 0 = 2 per worker")
+    parser.add_argument("--n", type=int, default=32, help="dataset instructions to cycle through")
+    parser.add_argument("--base-model", default="Qwen/Qwen3-0.6B")
+    parser.add_argument("--adapter-dir", default="./qwen-lora-json")
+    parser.add_argument("--port", type=int, default=8791)
+    parser.add_argument("--timeout", type=float, default=600, help="seconds to wait for the workers to load")
+    parser.add_argument("--json", action="store_true", help="also print each result as JSON")
+    args = parser.parse_args()
+
+    texts = load_instructions(n=args.n)
+    print(f"{'load':<7} {'workers':>7} {'RSS MB':>8} {'PSS MB':>8} {'req/s':>7} {'p50 ms':>8} {'p95 ms':>8}  statuses")
+    for load in args.load:
+        for workers in args.workers:
+            try:
+                r = run(load, workers, args, texts, args.port)
+            except RuntimeError as e:
+                print(f"❌ {load} x{workers}: {e}")
+                continue
+            print(f"{r['load']:<7} {r['workers']:>7} {r['rss_mb']:8.0f} {r['pss_mb']:8.0f} {r['throughput']:7.2f} "
+                  f"{r['p50_ms']:8.1f} {r['p95_ms']:8.1f}  {r['statuses']}")
+            if args.json:
+                print(json.dumps(r))
@@ -0,0 +1,87 @@
+import argparse, json, os, re, statistics, subprocess, sys, tempfile
+
+# Each snippet runs in a fresh interpreter and reports seconds since the
+# process was created, so interpreter start-up and imports are included.
+PRELUDE = """
+import json, sys, time, psutil
+def done(**extra):
+    elapsed = time.time() - psutil.Process().create_time()
+    print("STARTUP " + json.dumps({"seconds": elapsed, "torch": "torch" in sys.modules,
+                                   "google": "googleapiclient" in sys.modules, **extra}), flush=True)
+"""
+
+PATHS = {
+    "cli import": """
+import ai_and_send_mail
+done()
+""",
+    "api: contact update": """
+from fastapi.testclient import TestClient
+import local_dispatcher
+with TestClient(local_dispatcher.app) as client:
+    r = client.post("/dispatcher_and_send_mail",
+                    json={"type": "update", "action": "add", "name": "zed", "email": "zed@example.com"})
+    done(status=r.status_code)
+""",
+    "api: structured email": """
+from fastapi.testclient import TestClient
+import local_dispatcher
+with TestClient(local_dispatcher.app) as client:
+    r = client.post("/dispatcher_and_send_mail",
+                    json={"type": "email", "receiver": "zed@example.com", "subject": "hi", "body": "hello"})
+    done(status=r.status_code)
+""",
+    "api: templated parse": """
+from fastapi.testclient import TestClient
+import local_dispatcher
+with TestClient(local_dispatcher.app) as client:
+    r = client.post("/parse_and_dispatch", json={"text": "Add zed with email zed@example.com"})
+    done(status=r.status_code)
+""",
+    "model ready": """
+import ai_and_send_mail
+from model_registry import get_model
+get_model(BASE_MODEL, ADAPTER_DIR)
+done()
+""",
+}
+
+def run(snippet, env, base_model, adapter_dir):
+    code = PRELUDE + snippet.replace("BASE_MODEL", repr(base_model)).replace("ADAPTER_DIR", repr(adapter_dir))
+    proc = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, env=env)
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1])
+    # Background threads (e.g. the outbox sending) print too, possibly mid-line
+    return json.loads(re.search(r"STARTUP (\{[^{}]*\})", proc.stdout).group(1))
+
+def report(label, results):
+    seconds = [r["seconds"] for r in results]
+    last = results[-1]
+    extra = f"  status {last['status']}" if "status" in last else ""
+    print(f"{label:<28} median {statistics.median(seconds):6.2f}s  min {min(seconds):6.2f}s  "
+          f"torch {'yes' if last['torch'] else 'no ':<3}  google {'yes' if last['google'] else 'no '}{extra}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cold-start time per entry path, each in a fresh process")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--base-model", default="Qwen/Qwen3-0.6B")
+    parser.add_argument("--adapter-dir", default="./qwen-lora-json")
+    parser.add_argument("--paths", nargs="+", choices=list(PATHS), default=list(PATHS))
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # Throwaway address book and fake mail; no model preload, so the API
+        # paths show what a request costs before the model is in memory
+        env = {**os.environ, "CONTACTS_DB": os.path.join(tmp, "contacts.db"),
+               "MAIL_TRANSPORT": "fake", "MODEL_PRELOAD": "0"}
+        for label in args.paths:
+            try:
+                report(label, [run(PATHS[label], env, args.base_model, args.adapter_dir) for _ in range(args.repeat)])
+            except RuntimeError as e:
+                print(f"❌ {label}: {e}")
+            if label == "model ready":
+                # Same load from a merged safetensors snapshot (first run writes it)
+                snap_env = {**env, "QWEN_SNAPSHOT_DIR": os.path.join(tmp, "snapshot")}
+                run(PATHS[label], snap_env, args.base_model, args.adapter_dir)
+                report("model ready (snapshot)",
+                       [run(PATHS[label], snap_env, args.base_model, args.adapter_dir) for _ in range(args.repeat)])
@@ -0,0 +1,48 @@
+import argparse, json, os, re, subprocess, sys, tempfile
+
+# Each configuration trains for a fixed number of steps in a fresh process,
+# so peak RSS is its own. Flags are passed straight to train_qwen_lora.py.
+CONFIGS = {
+    "legacy fp32": ["--pipeline", "legacy", "--precision", "fp32", "--no-gradient-checkpointing"],
+    "cached fp32": ["--precision", "fp32", "--no-gradient-checkpointing"],
+    "cached fp32 + ckpt": ["--precision", "fp32", "--gradient-checkpointing"],
+    "cached bf16": ["--precision", "bf16", "--no-gradient-checkpointing"],
+    "cached bf16 + ckpt": ["--precision", "bf16", "--gradient-checkpointing"],
+}
+
+def run(flags, common, output_dir):
+    proc = subprocess.run([sys.executable, "train_qwen_lora.py", "--output-dir", output_dir, *common, *flags],
+                          capture_output=True, text=True)
+    match = re.search(r"^TRAIN_STATS (.*)$", proc.stdout, re.MULTILINE)
+    if proc.returncode != 0 or match is None:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else "no stats")
+    return json.loads(match.group(1))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Training throughput and memory per configuration (CPU)")
+    parser.add_argument("--configs", nargs="+", choices=list(CONFIGS), default=list(CONFIGS))
+    parser.add_argument("--steps", type=int, default=20)
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--grad-accum", type=int, default=2)
+    parser.add_argument("--threads", type=int, default=0)
+    parser.add_argument("--base-model", default="Qwen/Qwen3-0.6B")
+    parser.add_argument("--data", default="dataset.jsonl")
+    parser.add_argument("--eval-samples", type=int, default=0, help="also score held-out JSON accuracy")
+    args = parser.parse_args()
+
+    common = ["--profile", "cpu", "--base-model", args.base_model, "--data", args.data,
+              "--max-steps", str(args.steps), "--batch-size", str(args.batch_size),
+              "--grad-accum", str(args.grad_accum), "--threads", str(args.threads),
+              "--save-steps", str(args.steps), "--eval-samples", str(args.eval_samples)]
+    print(f"{'config':<20} {'samples/s':>10} {'tokens/s':>9} {'padding':>8} {'peak RSS MB':>12} {'JSON valid':>11}")
+    for label in args.configs:
+        with tempfile.TemporaryDirectory() as tmp:
+            try:
+                r = run(CONFIGS[label], common, os.path.join(tmp, "out"))
+            except RuntimeError as e:
+                print(f"❌ {label}: {e}")
+                continue
+        valid = f"{r['eval_json_valid']:.1%}" if "eval_json_valid" in r else "-"
+        rss = f"{r['peak_rss_mb']:.0f}" if "peak_rss_mb" in r else "-"   # not reported on Windows
+        print(f"{label:<20} {r['samples_per_sec']:10.2f} {r['tokens_per_sec']:9.1f} {r['padding_ratio']:8.1%} "
+              f"{rss:>12} {valid:>11}")
@@ -0,0 +1,234 @@
+import os, sqlite3, threading, time, unicodedata, difflib
+from collections.abc import MutableMapping
+
+CONTACTS_DB = os.environ.get("CONTACTS_DB", "contacts.db")
+# Minimum similarity (0-1) for a fuzzy name match to be suggested
+FUZZY_CUTOFF = 0.6
+# Fuzzy matches returned by suggest()
+FUZZY_SUGGESTIONS = 3
+# Candidates pulled from the n-gram index before scoring
+FUZZY_CANDIDATES = 50
+# Only the rarest query grams are looked up, so common ones ("an", "^王")
+# never force a scan of a large share of the address book
+FUZZY_GRAMS = 6
+# How long a keyed edit's result is kept for replay, as the outbox keeps sent rows
+APPLIED_KEY_RETENTION_S = 7 * 86400
+
+def fold(name: str):
+    # Case-folded, width-normalised (NFKC), whitespace-collapsed form of a name
+    return " ".join(unicodedata.normalize("NFKC", name).casefold().split())
+
+def is_cjk(ch):
+    return unicodedata.east_asian_width(ch) in ("W", "F") and ch.isalpha()
+
+def name_grams(folded: str):
+    # Boundary-marked bigrams work for Latin names; CJK names are only 2-4
+    # characters, so each ideograph is indexed on its own as well
+    padded = f"^{folded}$"
+    grams = {padded[i:i + 2] for i in range(len(padded) - 1)}
+    grams.update(ch for ch in folded if is_cjk(ch))
+    return grams
+
+# --- SQLite-backed address book ---
+# Behaves like the old contacts dict (name -> email), so update_contacts and
+# the dispatchers keep working, but every write is a B-tree upsert that
+# persists across restarts. resolve() adds folded lookups; fuzzy matches are
+# only ever suggest()ed, never used to address mail.
+class ContactStore(MutableMapping):
+    def __init__(self, path=CONTACTS_DB, seed=None):
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.RLock()
+        with self._lock, self._conn:
+            if path != ":memory:":
+                self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript("""
+                CREATE TABLE IF NOT EXISTS contacts (
+                    name   TEXT PRIMARY KEY,
+                    email  TEXT NOT NULL,
+                    folded TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS contacts_folded ON contacts(folded);
+                CREATE TABLE IF NOT EXISTS contact_grams (
+                    gram TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    PRIMARY KEY (gram, name)
+                ) WITHOUT ROWID;
+                CREATE INDEX IF NOT EXISTS contact_grams_name ON contact_grams(name);
+                CREATE TABLE IF NOT EXISTS gram_df (
+                    gram TEXT PRIMARY KEY,
+                    df   INTEGER NOT NULL
+                ) WITHOUT ROWID;
+                CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL);
+                INSERT OR IGNORE INTO meta VALUES ('version', 0);
+                CREATE TABLE IF NOT EXISTS applied_keys (
+                    key        TEXT PRIMARY KEY,
+                    error      TEXT,
+                    applied_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS applied_keys_at ON applied_keys(applied_at);
+            """)
+        if seed and len(self) == 0:
+            self.add_many(seed.items())
+
+    # --- Writes ---
+    def _put(self, name, email):
+        folded = fold(name)
+        exists = self._conn.execute("SELECT 1 FROM contacts WHERE name = ?", (name,)).fetchone()
+        self._conn.execute(
+            "INSERT INTO contacts(name, email, folded) VALUES (?, ?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET email = excluded.email",
+            (name, email, folded))
+        if exists is None:
+            # The name (and so its grams) never changes on update, only the email
+            grams = list(name_grams(folded))
+            self._conn.executemany("INSERT INTO contact_grams(gram, name) VALUES (?, ?)",
+                                   [(g, name) for g in grams])
+            self._conn.executemany("INSERT INTO gram_df(gram, df) VALUES (?, 1) "
+                                   "ON CONFLICT(gram) DO UPDATE SET df = df + 1", [(g,) for g in grams])
+
+    def _remove(self, name):
+        grams = self._conn.execute("SELECT gram FROM contact_grams WHERE name = ?", (name,)).fetchall()
+        self._conn.execute("DELETE FROM contact_grams WHERE name = ?", (name,))
+        self._conn.executemany("UPDATE gram_df SET df = df - 1 WHERE gram = ?", grams)
+
+    def _bump_version(self):
+        self._conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'version'")
+
+    def __setitem__(self, name, email):
+        with self._lock, self._conn:
+            self._put(name, email)
+            self._bump_version()
+
+    def __delitem__(self, name):
+        with self._lock, self._conn:
+            if self._conn.execute("DELETE FROM contacts WHERE name = ?", (name,)).rowcount == 0:
+                raise KeyError(name)
+            self._remove(name)
+            self._bump_version()
+
+    def add_many(self, items):
+        # One transaction for many (name, email) pairs
+        with self._lock, self._conn:
+            for name, email in items:
+                self._put(name, email)
+            self._bump_version()
+
+    def apply_updates(self, updates, keys=None):
+        # One transaction for many (action, name, email) edits, applied in
+        # order with update_contacts' rules -> None or an error per edit.
+        # An edit with an idempotency key already seen is not applied again:
+        # its stored result is returned instead.
+        errors = []
+        changed = False
+        now = time.time()
+        with self._lock, self._conn:
+            if keys:
+                self._conn.execute("DELETE FROM applied_keys WHERE applied_at < ?", (now - APPLIED_KEY_RETENTION_S,))
+            for i, (action, name, email) in enumerate(updates):
+                key = keys[i] if keys else None
+                seen = key is not None and self._conn.execute(
+                    "SELECT error FROM applied_keys WHERE key = ?", (key,)).fetchone()
+                if seen:
+                    errors.append(seen[0])
+                    continue
+                if action == "add" or (action == "update" and name in self):
+                    self._put(name, email)
+                    errors.append(None)
+                    changed = True
+                elif action == "delete" and self._conn.execute(
+                        "DELETE FROM contacts WHERE name = ?", (name,)).rowcount:
+                    self._remove(name)
+                    errors.append(None)
+                    changed = True
+                elif action in ("update", "delete"):
+                    errors.append(f"{name} not found")
+                else:
+                    errors.append(f"unknown action {action!r}")
+                if key is not None:
+                    self._conn.execute("INSERT INTO applied_keys(key, error, applied_at) VALUES (?, ?, ?)",
+                                       (key, errors[-1], now))
+            if changed:
+                self._bump_version()
+        return errors
+
+    # --- Reads ---
+    def __getitem__(self, name):
+        with self._lock:
+            row = self._conn.execute("SELECT email FROM contacts WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            raise KeyError(name)
+        return row[0]
+
+    def __contains__(self, name):
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM contacts WHERE name = ?", (name,)).fetchone() is not None
+
+    def __iter__(self):
+        with self._lock:
+            names = [row[0] for row in self._conn.execute("SELECT name FROM contacts ORDER BY name")]
+        return iter(names)
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM contacts").fetchone()[0]
+
+    def __repr__(self):
+        return f"ContactStore({self.path!r}, {len(self)} contacts)"
+
+    @property
+    def version(self):
+        # Bumped on every write; lets caches tell address-book states apart
+        with self._lock:
+            return self._conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()[0]
+
+    def resolve(self, query: str):
+        # Exact name, then case/width-folded name. Returns (name, email) or None.
+        if not query:
+            return None
+        with self._lock:
+            row = self._conn.execute("SELECT name, email FROM contacts WHERE name = ?", (query,)).fetchone()
+            if row is None:
+                row = self._conn.execute("SELECT name, email FROM contacts WHERE folded = ? LIMIT 1",
+                                         (fold(query),)).fetchone()
+        return row
+
+    def suggest(self, query: str, limit=FUZZY_SUGGESTIONS):
+        # Closest fuzzy matches, best first: [(name, email)]. For "did you
+        # mean" prompts only; a typo must not silently pick someone else.
+        if not query:
+            return []
+        folded = fold(query)
+        grams = list(name_grams(folded))
+        if not grams:
+            return []
+        with self._lock:
+            known = self._conn.execute(
+                f"SELECT gram FROM gram_df WHERE gram IN ({','.join('?' * len(grams))}) AND df > 0 "
+                f"ORDER BY df LIMIT ?", (*grams, FUZZY_GRAMS)).fetchall()
+            grams = [g for (g,) in known]
+            if not grams:
+                return []
+            candidates = self._conn.execute(
+                f"SELECT c.name, c.email, c.folded FROM contacts c JOIN ("
+                f"  SELECT name, COUNT(*) AS shared FROM contact_grams"
+                f"  WHERE gram IN ({','.join('?' * len(grams))})"
+                f"  GROUP BY name ORDER BY shared DESC LIMIT ?"
+                f") g ON g.name = c.name",
+                (*grams, FUZZY_CANDIDATES)).fetchall()
+        scored = [(difflib.SequenceMatcher(None, folded, candidate).ratio(), name, email)
+                  for name, email, candidate in candidates]
+        scored = sorted((s for s in scored if s[0] >= FUZZY_CUTOFF), key=lambda s: -s[0])
+        return [(name, email) for _, name, email in scored[:limit]]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def reopen(self):
+        # A forked worker (serve.py) must not share its parent's connection:
+        # SQLite locks and file offsets are per process
+        if self.path == ":memory:":
+            return
+        with self._lock:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
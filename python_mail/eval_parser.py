@@ -0,0 +1,245 @@
+import argparse, datetime, json, os, subprocess, sys, time
+from bench_parse import percentile
+from generate_dataset import open_input, receiver_name
+
+# Accuracy metrics are compared in absolute points, the rest relatively
+ACCURACY = ("exact_match", "json_valid", "field_accuracy")
+COMPARED = ACCURACY + ("new_tokens_per_request", "p50_ms", "p95_ms", "p99_ms", "throughput_per_sec")
+
+# --- Corpus ---
+def load_corpus(path, split="all", eval_fraction=0.05, limit=None):
+    # split="heldout" is the tail train_qwen_lora.py keeps out of training
+    with open_input(path) as f:
+        examples = [json.loads(line) for line in f if line.strip()]
+    if split == "heldout":
+        examples = examples[len(examples) - int(len(examples) * eval_fraction):]
+    return examples[:limit] if limit else examples
+
+# --- Parsers under test ---
+# Each takes a batch of instructions plus the address book for that batch,
+# and returns one raw dict (None when no JSON came out) per instruction.
+def basic_parser(args):
+    import ai_send_mail_basic as basic
+    from inference import generate_batch
+    from model_registry import get_model
+    basic.model_name = args.base_model or basic.model_name
+    tokenizer, model = get_model(basic.model_name, adapter_dir=None)
+
+    def parse(instructions, contacts):
+        generations = generate_batch(tokenizer, model, [basic.build_prompt(t) for t in instructions],
+                                     max_new_tokens=200, batch_size=len(instructions))
+        outputs = [basic.extract_json(g.text) for g in generations]
+        # The base prompt only knows emails: it never says which kind it is
+        return [{"type": "email", **o} if isinstance(o, dict) else None for o in outputs]
+    return parse
+
+def lora_parser(args):
+    import infer_qwen_loar as lora
+    from model_registry import get_model
+    lora.BASE_MODEL = args.base_model or lora.BASE_MODEL
+    lora.ADAPTER_DIR = args.adapter_dir or lora.ADAPTER_DIR
+    get_model(lora.BASE_MODEL, lora.ADAPTER_DIR)
+
+    def parse(instructions, contacts):
+        outputs = lora.generate_outputs(instructions, batch_size=len(instructions))
+        return [None if "error" in o else o for o in outputs]
+    return parse
+
+def unified_parser(args):
+    import ai_and_send_mail as parser
+    parser.model_name = args.base_model or parser.model_name
+    parser.adapter_dir = args.adapter_dir or parser.adapter_dir
+    # A warm parse cache would hide the model; --cache measures it on purpose
+    parser.PARSE_CACHE = args.cache
+    # The fast path may answer the warm-up request, so load the model here
+    parser.model_parse_requests(["Email bob: hello"], {"bob": "bob@example.com"}, batch_size=1)
+
+    def parse(instructions, contacts):
+        results = parser.parse_requests(instructions, contacts, batch_size=len(instructions),
+                                        use_fast_path=not args.no_fast_path)
+        return [r.dict() if r is not None else None for r in results]
+    return parse
+
+PARSERS = {"basic": basic_parser, "lora": lora_parser, "parse": unified_parser}
+
+# --- Scoring ---
+def address_book(example):
+    # The contact the instruction names is assumed to be in the address book:
+    # an email goes to that contact's address, and a contact being deleted is
+    # stored under the email in the output
+    expected = example["output"]
+    if expected["type"] == "email" and "@" in expected["receiver"]:
+        return {receiver_name(example): expected["receiver"]}
+    if expected["type"] == "update":
+        return {expected["name"]: expected["email"]}
+    return {}
+
+def field_matches(key, value, expected, example):
+    if key == "receiver" and isinstance(value, str) and "@" not in value:
+        # Unresolved name, as the basic and LoRA prompts return it
+        return value.casefold() == receiver_name(example).casefold()
+    return value == expected
+
+def score(output, example):
+    # -> {field: matched} over the expected fields; empty when not a JSON object
+    if not isinstance(output, dict):
+        return {}
+    return {k: field_matches(k, output.get(k), v, example) for k, v in example["output"].items()}
+
+def batches(examples, batch_size):
+    # Requests in one batch share an address book, so a batch never mixes
+    # two different addresses for the same contact name
+    batch, book = [], {}
+    for ex in examples:
+        entry = address_book(ex)
+        if len(batch) == batch_size or any(book.get(k, v) != v for k, v in entry.items()):
+            yield batch, book
+            batch, book = [], {}
+        batch.append(ex)
+        book.update(entry)
+    if batch:
+        yield batch, book
+
+# --- Replay ---
+def evaluate(parse, examples, batch_size=1, max_failures=20):
+    from inference import generation_stats
+    latencies, failures = [], []
+    valid = exact = 0
+    per_field = {}
+    before = generation_stats()
+    start = time.perf_counter()
+    for batch, book in batches(examples, batch_size):
+        t0 = time.perf_counter()
+        outputs = parse([ex["instruction"] for ex in batch], book)
+        # Every request in a batch waits for the whole batch
+        latencies.extend([time.perf_counter() - t0] * len(batch))
+        for ex, out in zip(batch, outputs):
+            fields = score(out, ex)
+            valid += bool(fields)
+            exact += bool(fields) and all(fields.values())
+            for k, ok in fields.items() if fields else ((k, False) for k in ex["output"]):
+                hit, total = per_field.get(k, (0, 0))
+                per_field[k] = (hit + ok, total + 1)
+            if not (fields and all(fields.values())) and len(failures) < max_failures:
+                failures.append({"instruction": ex["instruction"], "expected": ex["output"], "output": out})
+    seconds = time.perf_counter() - start
+    after = generation_stats()
+    n = len(examples)
+    new_tokens = after["new_tokens"] - before["new_tokens"]
+    hits = sum(h for h, _ in per_field.values())
+    total = sum(t for _, t in per_field.values())
+    metrics = {
+        "n": n,
+        "exact_match": exact / n,
+        "json_valid": valid / n,
+        "field_accuracy": hits / total if total else 0.0,
+        "generations": after["generations"] - before["generations"],
+        "new_tokens": new_tokens,
+        "new_tokens_per_request": new_tokens / n,
+        "prompt_tokens_per_request": (after["prompt_tokens"] - before["prompt_tokens"]) / n,
+        "p50_ms": 1000 * percentile(latencies, 50),
+        "p95_ms": 1000 * percentile(latencies, 95),
+        "p99_ms": 1000 * percentile(latencies, 99),
+        "seconds": seconds,
+        "throughput_per_sec": n / seconds,
+        "tokens_per_sec": new_tokens / seconds,
+    }
+    return metrics, {k: hit / total for k, (hit, total) in sorted(per_field.items())}, failures
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def print_report(result):
+    m = result["metrics"]
+    print(f"📊 {result['parser']} on {result['corpus']} ({m['n']} examples, commit {result['commit']})")
+    print(f"   exact match {m['exact_match']:.1%}  JSON valid {m['json_valid']:.1%}  "
+          f"field accuracy {m['field_accuracy']:.1%}")
+    print("   per field: " + ", ".join(f"{k} {v:.1%}" for k, v in result["per_field"].items()))
+    print(f"   latency p50 {m['p50_ms']:.1f} ms  p95 {m['p95_ms']:.1f} ms  p99 {m['p99_ms']:.1f} ms  "
+          f"throughput {m['throughput_per_sec']:.2f}/s")
+    print(f"   {m['generations']} model generations, {m['new_tokens_per_request']:.1f} new tokens/request, "
+          f"{m['tokens_per_sec']:.1f} tokens/sec")
+
+# --- Comparing two result files ---
+def compare(baseline, current, tolerance=0.01, latency_tolerance=0.10):
+    # Accuracy may drop by `tolerance` (absolute), latency and tokens may
+    # grow by `latency_tolerance` (relative), before it counts as a regression
+    regressions = []
+    print(f"{'metric':<26} {'baseline':>12} {'current':>12} {'change':>10}")
+    for key in COMPARED:
+        old, new = baseline["metrics"].get(key), current["metrics"].get(key)
+        if old is None or new is None:
+            continue
+        if key in ACCURACY:
+            change = new - old
+            worse = -change > tolerance
+        else:
+            change = (new - old) / old if old else 0.0
+            # Throughput is the one non-accuracy metric where higher is better
+            worse = (-change if key == "throughput_per_sec" else change) > latency_tolerance
+        print(f"{key:<26} {old:12.3f} {new:12.3f} {change:+10.1%}{'  ❌' if worse else ''}")
+        if worse:
+            regressions.append(key)
+    print(f"❌ Regressed: {', '.join(regressions)}" if regressions else "✅ No regressions")
+    return regressions
+
+def load_result(path):
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay a JSONL corpus through a parser: accuracy, validity, tokens, latency")
+    parser.add_argument("--parser", choices=list(PARSERS), default="parse",
+                        help="basic: ai_send_mail_basic prompt, lora: infer_qwen_loar, parse: ai_and_send_mail.parse_requests")
+    parser.add_argument("--data", default="dataset.jsonl", help=".jsonl, .jsonl.gz or .jsonl.zst")
+    parser.add_argument("--split", choices=["all", "heldout"], default="all")
+    parser.add_argument("--eval-fraction", type=float, default=0.05, help="size of the held-out tail, as in training")
+    parser.add_argument("--limit", type=int, default=None)
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--base-model", default=None)
+    parser.add_argument("--adapter-dir", default=None)
+    parser.add_argument("--no-fast-path", action="store_true", help="parse: send every request to the model")
+    parser.add_argument("--cache", action="store_true", help="parse: keep the parse cache on")
+    parser.add_argument("--out", default="eval-results.json")
+    parser.add_argument("--max-failures", type=int, default=20, help="mismatches kept in the result file")
+    parser.add_argument("--baseline", help="result file of an earlier run to compare against")
+    parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "CURRENT"), help="only compare two result files")
+    parser.add_argument("--tolerance", type=float, default=0.01)
+    parser.add_argument("--latency-tolerance", type=float, default=0.10)
+    args = parser.parse_args()
+
+    if args.compare:
+        regressions = compare(*map(load_result, args.compare), args.tolerance, args.latency_tolerance)
+        sys.exit(1 if regressions else 0)
+
+    examples = load_corpus(args.data, args.split, args.eval_fraction, args.limit)
+    if args.parser == "basic":
+        # The base prompt only handles emails
+        examples = [ex for ex in examples if ex["output"]["type"] == "email"]
+    parse = PARSERS[args.parser](args)
+    # Warm-up: model load and first-call overheads are not billed to the run
+    parse([examples[0]["instruction"]], address_book(examples[0]))
+
+    metrics, per_field, failures = evaluate(parse, examples, args.batch_size, args.max_failures)
+    result = {
+        "parser": args.parser,
+        "corpus": args.data,
+        "split": args.split,
+        "commit": git_commit(),
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "config": {k: v for k, v in vars(args).items()
+                   if k in ("batch_size", "limit", "base_model", "adapter_dir", "no_fast_path", "cache")},
+        "metrics": metrics,
+        "per_field": per_field,
+        "failures": failures,
+    }
+    print_report(result)
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print("💾 Results written to", args.out)
+    if args.baseline:
+        sys.exit(1 if compare(load_result(args.baseline), result, args.tolerance, args.latency_tolerance) else 0)
@@ -0,0 +1,63 @@
+import base64, random, threading, time, uuid
+from email import message_from_bytes
+
+# --- Local fake of the Gmail API client ---
+# Mirrors service.users().messages().send(userId=..., body=...).execute() so it
+# can stand in for the Gmail service (GmailTransport(service=...)) in tests,
+# benchmarks and dry runs.
+class FakeGmailService:
+    def __init__(self, latency=0.0, failure_rate=0.0, seed=None):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.sent = []
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def send(self, userId, body):
+        return _FakeSend(self, body)
+
+    def new_batch_http_request(self, callback=None):
+        return _FakeBatch(callback)
+
+    def _deliver(self, body):
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            if self._rng.random() < self.failure_rate:
+                raise RuntimeError("fake Gmail transport: injected failure")
+            message = message_from_bytes(base64.urlsafe_b64decode(body["raw"]))
+            record = {"id": uuid.uuid4().hex[:16], "to": message["to"], "from": message["from"],
+                      "subject": message["subject"], "body": message.get_payload(decode=True).decode()}
+            self.sent.append(record)
+        return {"id": record["id"], "labelIds": ["SENT"]}
+
+class _FakeSend:
+    def __init__(self, service, body):
+        self.service = service
+        self.body = body
+
+    def execute(self):
+        return self.service._deliver(self.body)
+
+class _FakeBatch:
+    def __init__(self, callback):
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, callback=None, request_id=None):
+        self.requests.append((request_id or str(len(self.requests)), request, callback or self.callback))
+
+    def execute(self):
+        for request_id, request, callback in self.requests:
+            try:
+                response, exception = request.execute(), None
+            except Exception as e:
+                response, exception = None, e
+            if callback:
+                callback(request_id, response, exception)
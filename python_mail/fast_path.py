@@ -0,0 +1,139 @@
+import re, json, sys, time
+from contact_store import fold
+
+# --- Rule-based parser for the common phrasings ---
+# Covers the templates in generate_dataset.py (and a few close variants) with
+# plain regexes, so those requests never reach model.generate. Anything that
+# does not match cleanly returns None and goes to the model as before.
+EMAIL = r"[\w.+-]+@[\w-]+(?:\.[\w-]+)+"
+NAME = r"[^\s'’,:]+(?:\s+[^\s'’,:]+){0,3}?"
+END = r"\s*[.!]?\s*$"
+# Words kept in a subject derived from the body
+SUBJECT_WORDS = 6
+
+PATTERNS = [
+    ("add", re.compile(
+        rf"^(?:add|create|save)\s+(?:new\s+)?(?:contact\s+)?(?P<name>{NAME})\s*"
+        rf"(?:,\s*|with\s+|as\s+)?(?:(?:the\s+)?e-?mail(?:\s+address)?\s*(?:is\s+|:\s*|=\s*)?)?"
+        rf"<?(?P<email>{EMAIL})>?{END}", re.I)),
+    ("update", re.compile(
+        rf"^(?:update|change|set)\s+(?P<name>{NAME})(?:'s|’s)\s+e-?mail(?:\s+address)?\s+(?:to|as|=)\s+"
+        rf"(?P<email>{EMAIL}){END}", re.I)),
+    ("update", re.compile(
+        rf"^(?:update|change|set)\s+(?:the\s+)?e-?mail(?:\s+address)?\s+(?:of|for)\s+(?P<name>{NAME})\s+(?:to|as)\s+"
+        rf"(?P<email>{EMAIL}){END}", re.I)),
+    ("delete", re.compile(
+        rf"^(?:delete|remove)\s+(?:contact\s+)?(?P<name>{NAME})(?:\s+from\s+(?:my\s+|the\s+)?contacts)?{END}", re.I)),
+    ("email", re.compile(
+        rf"^(?:send|write)\s+(?P<name>{NAME}|{EMAIL})\s+an?\s+e-?mail\s+(?:saying|that\s+says)\s*:?\s+(?P<body>.+?)\s*$", re.I)),
+    ("email", re.compile(
+        rf"^(?:send|write)\s+an?\s+e-?mail\s+to\s+(?P<name>{NAME}|{EMAIL})\s*(?:saying|that\s+says|:)\s*:?\s*(?P<body>.+?)\s*$", re.I)),
+    ("email", re.compile(
+        rf"^e-?mail\s+(?P<name>{NAME}|{EMAIL})\s*:\s*(?P<body>.+?)\s*$", re.I)),
+]
+
+def subject_from_body(body: str):
+    # The templates carry no subject; use the opening words of the body
+    first = re.split(r"(?<=[.!?])\s", body, maxsplit=1)[0].rstrip(".!?")
+    words = first.split()
+    subject = " ".join(words[:SUBJECT_WORDS])
+    return subject + ("..." if len(words) > SUBJECT_WORDS else "")
+
+def known_receiver(name: str, contacts):
+    # A literal address, or a name the address book has exactly or
+    # case/width-folded. Near misses are left to the model (or to fail).
+    if re.fullmatch(EMAIL, name):
+        return True
+    if contacts is None:
+        return False
+    if hasattr(contacts, "resolve"):
+        return contacts.resolve(name) is not None
+    return name in contacts or any(fold(key) == fold(name) for key in contacts)
+
+def match(text: str, contacts=None):
+    # Returns the parsed JSON dict the model would have produced, or None.
+    # A delete carries no email, so it needs the contact to already exist;
+    # an email needs a receiver that resolves without guessing.
+    text = text.strip().strip('"').strip()
+    for kind, pattern in PATTERNS:
+        m = pattern.match(text)
+        if not m:
+            continue
+        name = m.group("name").strip()
+        if kind == "email":
+            if not known_receiver(name, contacts):
+                return None
+            return {"type": "email", "receiver": name, "subject": subject_from_body(m.group("body")),
+                    "body": m.group("body")}
+        if kind == "delete":
+            email = contacts.get(name) if contacts is not None else None
+            if email is None:
+                return None
+            return {"type": "update", "action": "delete", "name": name, "email": email}
+        return {"type": "update", "action": kind, "name": name, "email": m.group("email")}
+    return None
+
+class FastPathParser:
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.rejected = 0        # matched, but failed validation
+        self.seconds = 0.0
+
+    def parse(self, text: str, validate, contacts=None):
+        # validate: parsed dict -> pydantic object or None (receiver resolution included)
+        start = time.perf_counter()
+        parsed_json = match(text, contacts)
+        parsed = validate(parsed_json) if parsed_json is not None else None
+        self.seconds += time.perf_counter() - start
+        if parsed is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            self.rejected += parsed_json is not None
+        return parsed
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "rejected": self.rejected,
+            "hit_rate": self.hits / total if total else 0.0,
+            "avg_us": 1e6 * self.seconds / total if total else 0.0,
+        }
+
+# --- Accuracy against the training set ---
+def check_dataset(path="dataset.jsonl"):
+    from ai_and_send_mail import validate_json
+    from generate_dataset import open_input, receiver_name
+    parser = FastPathParser()
+    correct = 0
+    field_errors = {}
+    with open_input(path) as f:
+        examples = [json.loads(line) for line in f if line.strip()]
+    for ex in examples:
+        expected = ex["output"]
+        # The address book each example assumes: its own name -> email
+        if expected["type"] == "email":
+            contacts = {receiver_name(ex): expected["receiver"]}
+        else:
+            contacts = {expected["name"]: expected["email"]}
+        parsed = parser.parse(ex["instruction"], lambda d: validate_json(d, contacts, quiet=True), contacts)
+        if parsed is None:
+            continue
+        got = parsed.dict()
+        # Subjects in the dataset are random and not derivable from the instruction
+        wrong = [k for k in expected if k != "subject" and got.get(k) != expected[k]]
+        for k in wrong:
+            field_errors[k] = field_errors.get(k, 0) + 1
+        correct += not wrong
+    stats = parser.stats()
+    print(f"📊 {len(examples)} examples: hit rate {stats['hit_rate']:.1%}, "
+          f"accuracy on hits {correct / max(1, stats['hits']):.1%}, {stats['avg_us']:.1f} us/parse")
+    if field_errors:
+        print("⚠️ Field mismatches:", field_errors)
+    return stats
+
+if __name__ == "__main__":
+    check_dataset(*sys.argv[1:2])
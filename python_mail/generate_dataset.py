@@ -1,5 +1,5 @@
-import json
-import random
+import argparse, gzip, hashlib, json, math, os, random, time
+from concurrent.futures import ProcessPoolExecutor
 
 names = ["alice", "bob", "caixintong", "jim", "tom", "susan", "mike", "linda", "kevin", "sarah"]
 domains = ["gs.ncku.edu.tw", "gmail.com", "company.com", "student.ncku.edu.tw", "example.com"]
@@ -18,13 +18,44 @@ bodies = [
 
 actions = ["add", "update", "delete"]
 
-def random_email(name):
-    domain = random.choice(domains)
+# --- Extra vocabulary for large corpora ---
+more_names = ["amy", "brian", "chloe", "daniel", "emma", "frank", "grace", "henry", "ivy", "jack",
+              "karen", "leo", "mia", "nathan", "olivia", "peter", "queenie", "ryan", "sophia", "victor"]
+# Same style as the address book in ai_send_mail_basic.py
+chinese_names = ["王士豪", "郭耀煌", "謝孫源", "連震杰", "楊中平", "梁勝富", "李同益", "吳宗憲",
+                 "蘇文鈺", "陳培殷", "林大和", "張燕光"]
+chinese_surnames = "王李張劉陳楊黃趙吳周徐孫馬朱胡郭何林羅高鄭謝蔡許蘇"
+chinese_given = "士豪耀煌孫源震杰中平勝富同益宗憲崇明裕民響亮榮先培殷大和文鈺燕光銓清宏章"
+more_domains = ["mail.ncku.edu.tw", "csie.ncku.edu.tw", "outlook.com", "yahoo.com.tw", "proton.me"]
+more_bodies = [
+    "The report is due on Friday.", "Lunch is on me today.", "The server is back online.",
+    "Please send me the slides.", "Call me when you land.", "The demo moved to 3pm.",
+    "明天早上十點開會。", "報告請在週五前交。", "謝謝你的幫忙！", "會議改到下週一。"
+]
+times = ["", " at 9am", " at 2pm", " on Monday", " next week", " tomorrow"]
+
+update_templates = {
+    "add": ["Add {name} with email {email}", "Add {name} to my contacts, email {email}",
+            "Create a contact {name} <{email}>", "Save {name}'s email as {email}",
+            "New contact: {name}, {email}", "把{name}加入聯絡人，email 是 {email}"],
+    "update": ["Update {name}'s email to {email}", "Change {name}'s email to {email}",
+               "Set the email of {name} to {email}", "{name} has a new email: {email}",
+               "把{name}的 email 改成 {email}"],
+    "delete": ["Delete {name} from contacts", "Remove {name} from my contacts",
+               "Delete contact {name}", "刪除聯絡人{name}"],
+}
+email_templates = ["Send {name} an email saying {body}", "Send an email to {name} saying {body}",
+                   "Email {name}: {body}", "Write to {name}: {body}", "寄信給{name}，內容是{body}"]
+# Templates that state the subject, so it can be learned instead of guessed
+subject_templates = ["Send {name} an email about {subject}: {body}", "Email {name} with subject {subject}: {body}"]
+
+def random_email(name, rng=random):
+    domain = rng.choice(domains)
     return f"{name}@{domain}"
 
-def make_update_example(name):
-    action = random.choice(actions)
-    email = random_email(name)
+def make_update_example(name, rng=random):
+    action = rng.choice(actions)
+    email = random_email(name, rng)
     instruction = ""
     if action == "add":
         instruction = f"Add {name} with email {email}"
@@ -37,29 +68,192 @@ def make_update_example(name):
         "output": {"type": "update", "action": action, "name": name, "email": email}
     }
 
-def make_email_example(name):
-    email = random_email(name)
-    subject = random.choice(subjects)
-    body = random.choice(bodies)
+def make_email_example(name, rng=random):
+    email = random_email(name, rng)
+    subject = rng.choice(subjects)
+    body = rng.choice(bodies)
     instruction = f"Send {name} an email saying {body}"
     return {
         "instruction": instruction,
-        "output": {"type": "email", "receiver": email, "subject": subject, "body": body}
+        "output": {"type": "email", "receiver": email, "subject": subject, "body": body},
+        "receiver_name": name
     }
 
-def generate_dataset(n=500):
+def generate_dataset(n=500, rng=random):
     dataset = []
     for _ in range(n):
-        name = random.choice(names)
-        if random.random() < 0.5:
-            dataset.append(make_update_example(name))
+        name = rng.choice(names)
+        if rng.random() < 0.5:
+            dataset.append(make_update_example(name, rng))
         else:
-            dataset.append(make_email_example(name))
+            dataset.append(make_email_example(name, rng))
     return dataset
 
+# --- Wider template set ---
+def random_contact(rng):
+    # -> (display name, email); Chinese names get an ASCII mailbox
+    roll = rng.random()
+    if roll < 0.35:
+        name = rng.choice(names + more_names)
+        local = name + (str(rng.randint(1, 999)) if rng.random() < 0.5 else "")
+    elif roll < 0.5:
+        name = rng.choice(names + more_names).capitalize() + " " + rng.choice(more_names).capitalize()
+        local = name.lower().replace(" ", ".")
+    elif roll < 0.6:
+        name = rng.choice(chinese_names)
+        local = f"u{rng.randint(10000, 99999)}"
+    else:
+        name = rng.choice(chinese_surnames) + "".join(rng.choice(chinese_given) for _ in range(rng.randint(1, 2)))
+        local = f"{rng.choice('abcdefghijklmnopqrstuvwxyz')}{rng.randint(10000000, 99999999)}"
+    return name, f"{local}@{rng.choice(domains + more_domains)}"
+
+def make_example(rng):
+    name, email = random_contact(rng)
+    if rng.random() < 0.5:
+        action = rng.choice(actions)
+        instruction = rng.choice(update_templates[action]).format(name=name, email=email)
+        return {"instruction": instruction,
+                "output": {"type": "update", "action": action, "name": name, "email": email}}
+    body = rng.choice(bodies + more_bodies)
+    if body.endswith("."):
+        body = body[:-1] + rng.choice(times) + "."
+    if rng.random() < 0.3:
+        subject = rng.choice(subjects)
+        instruction = rng.choice(subject_templates).format(name=name, subject=subject, body=body)
+    else:
+        subject = rng.choice(subjects)
+        instruction = rng.choice(email_templates).format(name=name, body=body)
+    # The contact's name is kept next to the output (not in it: the output is
+    # the training target), since the address no longer spells it out
+    return {"instruction": instruction,
+            "output": {"type": "email", "receiver": email, "subject": subject, "body": body},
+            "receiver_name": name}
+
+def receiver_name(example):
+    # The contact an email example addresses; corpora written before
+    # receiver_name existed used name@domain addresses
+    return example.get("receiver_name") or example["output"]["receiver"].split("@")[0]
+
+def generate_chunk(args):
+    # Runs in a worker: its RNG depends only on (seed, chunk index), so the
+    # output is identical whatever the number of workers
+    seed, index, size = args
+    rng = random.Random(f"{seed}:{index}")
+    digests, lines = [], []
+    for _ in range(size):
+        ex = make_example(rng)
+        digests.append(hashlib.blake2b(ex["instruction"].encode(), digest_size=16).digest())
+        lines.append(json.dumps(ex, ensure_ascii=False) + "\n")
+    return b"".join(digests), "".join(lines).encode()
+
+# --- Dedupe in bounded memory ---
+# ~1.2 bytes per expected example at a 1% false-positive rate; a false
+# positive only drops an example that happened to collide
+class BloomFilter:
+    def __init__(self, capacity, error_rate=0.01):
+        import numpy as np
+        self.np = np
+        self.m = max(64, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.k = max(1, round(self.m / capacity * math.log(2)))
+        self.bits = np.zeros((self.m + 7) // 8, dtype=np.uint8)
+
+    def _positions(self, digests: bytes):
+        np = self.np
+        h = np.frombuffer(digests, dtype=np.uint64).reshape(-1, 2)
+        i = np.arange(self.k, dtype=np.uint64)
+        return (h[:, :1] + i * h[:, 1:]) % np.uint64(self.m)
+
+    def add_new(self, digests: bytes):
+        # Marks every digest as seen; returns a mask of the ones not seen before
+        # (earlier chunks via the filter, this chunk via exact digests)
+        np = self.np
+        pos = self._positions(digests)
+        byte, mask = pos >> np.uint64(3), (np.uint8(1) << (pos & np.uint64(7)).astype(np.uint8))
+        seen = ((self.bits[byte] & mask) != 0).all(axis=1)
+        new = ~seen
+        in_chunk = set()
+        for row in np.flatnonzero(new):
+            d = digests[16 * row:16 * row + 16]
+            if d in in_chunk:
+                new[row] = False
+            in_chunk.add(d)
+        np.bitwise_or.at(self.bits, byte[new].ravel(), mask[new].ravel())
+        return new
+
+def open_output(path):
+    if path.endswith(".gz"):
+        return gzip.open(path, "wb", compresslevel=6)
+    if path.endswith(".zst"):
+        import zstandard
+        return zstandard.ZstdCompressor(level=3).stream_writer(open(path, "wb"))
+    return open(path, "wb")
+
+def open_input(path):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8")
+    if path.endswith(".zst"):
+        import io, zstandard
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(path, "rb")), encoding="utf-8")
+    return open(path, encoding="utf-8")
+
+def write_corpus(path, n, seed=0, workers=None, chunk_size=10_000, dedupe=True, report_every=5.0):
+    workers = workers or os.cpu_count() or 1
+    bloom = BloomFilter(int(n * 1.2)) if dedupe else None
+    written = dropped = chunks = 0
+    start = last_report = time.perf_counter()
+    # A small corpus needs neither full-size chunks nor a full window of them
+    chunk_size = max(1, min(chunk_size, n))
+    with open_output(path) as out, ProcessPoolExecutor(max_workers=workers) as pool:
+        # Only a small window of chunks is in flight, so memory stays flat
+        window = min(workers * 2, -(-n // chunk_size))
+        pending = [pool.submit(generate_chunk, (seed, i, chunk_size)) for i in range(window)]
+        next_index = window
+        while written < n:
+            digests, data = pending.pop(0).result()
+            chunks += 1
+            lines = data.splitlines(keepends=True)
+            if bloom is not None:
+                keep = bloom.add_new(digests)
+                dropped += len(lines) - int(keep.sum())
+                lines = [line for line, k in zip(lines, keep) if k]
+            lines = lines[:n - written]
+            out.write(b"".join(lines))
+            written += len(lines)
+            if written >= n:
+                break
+            if dedupe and chunks * chunk_size > 5 * n:
+                print(f"⚠️ Templates exhausted: only {written} unique examples after {chunks} chunks")
+                break
+            # Still short of n: keep the window full
+            pending.append(pool.submit(generate_chunk, (seed, next_index, chunk_size)))
+            next_index += 1
+            now = time.perf_counter()
+            if now - last_report >= report_every:
+                print(f"⏳ {written:,}/{n:,} examples, {written / (now - start):,.0f} examples/sec, {dropped:,} duplicates")
+                last_report = now
+        for f in pending:
+            f.cancel()
+    elapsed = time.perf_counter() - start
+    print(f"✅ Generated {path} with {written:,} examples in {elapsed:.1f}s "
+          f"({written / elapsed:,.0f} examples/sec, {os.path.getsize(path) / 2**20:.1f} MB, {dropped:,} duplicates dropped)")
+    return written
+
 if __name__ == "__main__":
-    data = generate_dataset(1000)  # generate 1000 examples
-    with open("dataset.jsonl", "w", encoding="utf-8") as f:
-        for ex in data:
-            f.write(json.dumps(ex, ensure_ascii=False) + "\n")
-    print("✅ Generated dataset.jsonl with", len(data), "examples")
+    parser = argparse.ArgumentParser(description="Synthetic instruction -> JSON dataset")
+    parser.add_argument("--n", type=int, default=1000)
+    parser.add_argument("--out", default="dataset.jsonl", help=".gz / .zst suffix compresses the output")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--chunk-size", type=int, default=10_000)
+    parser.add_argument("--no-dedupe", action="store_true")
+    parser.add_argument("--legacy", action="store_true", help="original 10-name templates, in memory")
+    args = parser.parse_args()
+    if args.legacy:
+        data = generate_dataset(args.n, random.Random(args.seed))
+        with open(args.out, "w", encoding="utf-8") as f:
+            for ex in data:
+                f.write(json.dumps(ex, ensure_ascii=False) + "\n")
+        print("✅ Generated", args.out, "with", len(data), "examples")
+    else:
+        write_corpus(args.out, args.n, seed=args.seed, workers=args.workers,
+                     chunk_size=args.chunk_size, dedupe=not args.no_dedupe)
@@ -1,31 +1,19 @@
-import json
-from transformers import AutoTokenizer, AutoModelForCausalLM
-from peft import PeftModel
+import os, json
+from model_registry import get_model
+from inference import generate_batch, PromptLookupDecoder, DEFAULT_BATCH_SIZE
 
 BASE_MODEL = "Qwen/Qwen3-0.6B"
 ADAPTER_DIR = "./qwen-lora-json"
+# PROMPT_LOOKUP=1 decodes with drafts copied from the instruction (same
+# greedy output, fewer forward passes); it runs one prompt at a time
+PROMPT_LOOKUP = os.environ.get("PROMPT_LOOKUP", "0") == "1"
+lookup_decoder = PromptLookupDecoder()
 
 def build_prompt(instruction: str):
     # Keep the same format the model saw during fine-tuning
     return f"Instruction: {instruction}\nOutput: "
 
-def generate_output(instruction: str, max_new_tokens=128):
-    tokenizer = AutoTokenizer.from_pretrained(BASE_MODEL, use_fast=True)
-    base = AutoModelForCausalLM.from_pretrained(BASE_MODEL)
-    model = PeftModel.from_pretrained(base, ADAPTER_DIR)
-    model.eval()
-
-    prompt = build_prompt(instruction)
-    inputs = tokenizer(prompt, return_tensors="pt")
-    outputs = model.generate(
-        **inputs,
-        max_new_tokens=max_new_tokens,
-        do_sample=False,    # deterministic; set True for sampling
-        temperature=0.0
-    )
-    text = tokenizer.decode(outputs[0], skip_special_tokens=True)
-    # Extract only the generated part after "Output: "
-    gen = text.split("Output: ", 1)[-1].strip()
+def to_json(gen: str):
     # Trim to first {...}
     start = gen.find("{")
     end = gen.find("}")
@@ -37,6 +25,29 @@ def generate_output(instruction: str, max_new_tokens=128):
             return {"raw": gen_json, "error": "JSON parse failed"}
     return {"raw": gen, "error": "No JSON block found"}
 
+def generate_output(instruction: str, max_new_tokens=128):
+    return generate_outputs([instruction], max_new_tokens=max_new_tokens, batch_size=1)[0]
+
+def generate_outputs(instructions: list, max_new_tokens=128, batch_size=DEFAULT_BATCH_SIZE, prompt_lookup=None):
+    # Loaded once per process and shared with every later call
+    tokenizer, model = get_model(BASE_MODEL, ADAPTER_DIR)
+    if prompt_lookup is None:
+        prompt_lookup = PROMPT_LOOKUP
+
+    prompts = [build_prompt(instruction) for instruction in instructions]
+    if prompt_lookup:
+        generations = lookup_decoder.generate(tokenizer, model, prompts, max_new_tokens=max_new_tokens)
+        return [to_json(g.text) for g in generations]
+    generations = generate_batch(
+        tokenizer, model, prompts,
+        max_new_tokens=max_new_tokens,
+        batch_size=batch_size,
+        do_sample=False,    # deterministic; set True for sampling
+        temperature=0.0
+    )
+    # Only the generated part after "Output: " is decoded
+    return [to_json(g.text) for g in generations]
+
 if __name__ == "__main__":
     tests = [
         "Add caixintong with email f74146856@gs.ncku.edu.tw",
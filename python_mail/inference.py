@@ -0,0 +1,349 @@
+import threading, queue, time
+import torch
+import metrics
+from dataclasses import dataclass
+from transformers import DynamicCache, StoppingCriteria, StoppingCriteriaList
+from transformers.generation.streamers import BaseStreamer
+
+DEFAULT_BATCH_SIZE = 8
+
+@dataclass
+class Generation:
+    text: str
+    prompt_tokens: int
+    new_tokens: int
+
+# --- Generation counters ---
+# Process-wide totals over every decoding path in this module; callers such
+# as eval_parser.py snapshot them before and after a parse and diff.
+_stats_lock = threading.Lock()
+_generation_stats = {"generations": 0, "prompt_tokens": 0, "new_tokens": 0}
+
+def record_generations(generations):
+    with _stats_lock:
+        for g in generations:
+            _generation_stats["generations"] += 1
+            _generation_stats["prompt_tokens"] += g.prompt_tokens
+            _generation_stats["new_tokens"] += g.new_tokens
+    metrics.inc("tokens_in_total", sum(g.prompt_tokens for g in generations))
+    metrics.inc("tokens_out_total", sum(g.new_tokens for g in generations))
+    return generations
+
+class StageTimer(BaseStreamer):
+    # Passed to generate() as its streamer: the prompt is pushed before
+    # prefill and the first new token right after it, which splits one
+    # generate() call into its prefill and decode stages
+    def __init__(self):
+        self.marks = []
+
+    def put(self, value):
+        if len(self.marks) < 2:
+            self.marks.append(time.perf_counter())
+
+    def end(self):
+        if len(self.marks) == 2:
+            metrics.observe("prefill", self.marks[1] - self.marks[0])
+            metrics.observe("decode", time.perf_counter() - self.marks[1])
+
+def stage_timer(call_kwargs):
+    if metrics.enabled() and "streamer" not in call_kwargs:
+        call_kwargs["streamer"] = StageTimer()
+    return call_kwargs
+
+def generation_stats():
+    with _stats_lock:
+        return dict(_generation_stats)
+
+def prepare_tokenizer(tokenizer):
+    # Decoder-only models must be left-padded so every row ends at the prompt
+    tokenizer.padding_side = "left"
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    return tokenizer
+
+# --- Length bucketing ---
+def bucket_by_length(lengths, batch_size):
+    # Sort indices by prompt length and cut into batches, so each batch pads
+    # only up to its own longest prompt instead of the global maximum
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    return [order[i:i + batch_size] for i in range(0, len(order), batch_size)]
+
+# --- Batched greedy/sampled generation ---
+def generate_batch(tokenizer, model, prompts, max_new_tokens=128, batch_size=DEFAULT_BATCH_SIZE,
+                   constraint=None, adapter_names=None, **generate_kwargs):
+    # constraint: optional json_constraints.JsonSchemaDecoding; each bucket gets
+    # its own logits processor / stopping criteria state from it.
+    # adapter_names: one PEFT adapter name per prompt, for a mixed-adapter
+    # batch on a PeftModel (see adapter_pool.py); follows the bucketing
+    prepare_tokenizer(tokenizer)
+    with metrics.span("tokenize"):
+        encoded = tokenizer(list(prompts))["input_ids"]
+    results = [None] * len(encoded)
+
+    for bucket in bucket_by_length([len(ids) for ids in encoded], max(1, batch_size)):
+        inputs = tokenizer.pad({"input_ids": [encoded[i] for i in bucket]}, return_tensors="pt")
+        inputs = {k: v.to(model.device) for k, v in inputs.items()}
+        call_kwargs = dict(generate_kwargs)
+        if constraint is not None:
+            call_kwargs.update(constraint.generation_kwargs())
+        if adapter_names is not None:
+            call_kwargs["adapter_names"] = [adapter_names[i] for i in bucket]
+        stage_timer(call_kwargs)
+        with torch.inference_mode():
+            outputs = model.generate(
+                **inputs,
+                max_new_tokens=max_new_tokens,
+                pad_token_id=tokenizer.pad_token_id,
+                **call_kwargs
+            )
+        prompt_len = inputs["input_ids"].shape[1]
+        for row, i in enumerate(bucket):
+            new_tokens = outputs[row][prompt_len:]
+            results[i] = Generation(
+                text=tokenizer.decode(new_tokens, skip_special_tokens=True).strip(),
+                prompt_tokens=len(encoded[i]),
+                new_tokens=int((new_tokens != tokenizer.pad_token_id).sum()),
+            )
+    return record_generations(results)
+
+# --- Token streaming ---
+class TokenQueueStreamer(BaseStreamer):
+    # Hands each step's new token ids to the consumer thread. Unlike
+    # TextIteratorStreamer it does not wait for word boundaries, which JSON
+    # without spaces would never hit.
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.prompt_seen = False
+
+    def put(self, value):
+        if not self.prompt_seen:
+            # generate() first pushes the prompt itself
+            self.prompt_seen = True
+            return
+        self.queue.put(value.reshape(-1).tolist())
+
+    def end(self):
+        self.queue.put(None)
+
+class StopEvent(StoppingCriteria):
+    def __init__(self, event):
+        self.event = event
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.full((input_ids.shape[0],), self.event.is_set(), dtype=torch.bool, device=input_ids.device)
+
+def stream_generate(tokenizer, model, prompt, max_new_tokens=128, constraint=None, **generate_kwargs):
+    # Yields lists of new token ids as they are produced. generate() runs in a
+    # worker thread; closing the generator (or breaking out of the loop)
+    # stops it at the next decoding step.
+    prepare_tokenizer(tokenizer)
+    inputs = tokenizer(prompt, return_tensors="pt")
+    inputs = {k: v.to(model.device) for k, v in inputs.items()}
+    call_kwargs = dict(generate_kwargs)
+    if constraint is not None:
+        call_kwargs.update(constraint.generation_kwargs())
+    stop = threading.Event()
+    criteria = StoppingCriteriaList(call_kwargs.pop("stopping_criteria", []))
+    criteria.append(StopEvent(stop))
+    streamer = TokenQueueStreamer()
+    errors = []
+
+    def run():
+        try:
+            with torch.inference_mode():
+                model.generate(**inputs, max_new_tokens=max_new_tokens, pad_token_id=tokenizer.pad_token_id,
+                               streamer=streamer, stopping_criteria=criteria, **call_kwargs)
+        except Exception as e:
+            errors.append(e)
+            streamer.end()
+
+    worker = threading.Thread(target=run, daemon=True)
+    started = first = time.perf_counter()
+    worker.start()
+    streamed = 0
+    try:
+        while True:
+            ids = streamer.queue.get()
+            if ids is None:
+                break
+            if not streamed:
+                first = time.perf_counter()
+                metrics.observe("prefill", first - started)
+            streamed += len(ids)
+            yield ids
+    finally:
+        stop.set()
+        worker.join()
+        if streamed:
+            metrics.observe("decode", time.perf_counter() - first)
+        record_generations([Generation("", inputs["input_ids"].shape[1], streamed)])
+    if errors:
+        raise errors[0]
+
+# --- Prompt-lookup decoding ---
+# Greedy decoding where the draft tokens come from the prompt itself: the
+# last few generated tokens are looked up in the context, and the tokens that
+# followed them there are proposed as the continuation. One forward pass
+# verifies the whole draft; the longest prefix that matches the model's own
+# argmax is kept, plus the model's token at the first mismatch. The output is
+# the same as plain greedy decoding, in fewer forward passes whenever the
+# model is copying (names, addresses, email bodies, the JSON keys).
+def find_draft(ids, ngram_size, num_draft):
+    # Most recent earlier occurrence of the longest matching tail n-gram
+    for n in range(min(ngram_size, len(ids) - 1), 0, -1):
+        tail = ids[-n:]
+        for start in range(len(ids) - n - 1, -1, -1):
+            if ids[start:start + n] == tail:
+                draft = ids[start + n:start + n + num_draft]
+                if draft:
+                    return draft
+    return []
+
+class PromptLookupDecoder:
+    def __init__(self, ngram_size=3, num_draft=10):
+        self.ngram_size = ngram_size
+        self.num_draft = num_draft
+        self.forward_passes = 0   # decoding passes, prefill not counted
+        self.new_tokens = 0
+        self.drafted = 0
+        self.accepted = 0
+
+    def _generate_one(self, tokenizer, model, prompt, max_new_tokens):
+        ids = tokenizer(prompt)["input_ids"]
+        prompt_len = len(ids)
+        # generate() also stops on the generation config's eos ids (Qwen has several)
+        eos = getattr(getattr(model, "generation_config", None), "eos_token_id", None)
+        stop_ids = {tokenizer.eos_token_id, tokenizer.pad_token_id} - {None}
+        stop_ids.update(eos if isinstance(eos, list) else [eos] if eos is not None else [])
+        cache = DynamicCache()
+        # Invariant: the cache covers every token but the last one
+        if len(ids) > 1:
+            with metrics.span("prefill"):
+                model(input_ids=torch.tensor([ids[:-1]], device=model.device), past_key_values=cache, use_cache=True)
+        decode_start = time.perf_counter()
+        while len(ids) - prompt_len < max_new_tokens:
+            budget = max_new_tokens - (len(ids) - prompt_len)
+            draft = find_draft(ids, self.ngram_size, min(self.num_draft, budget - 1))
+            out = model(input_ids=torch.tensor([[ids[-1]] + draft], device=model.device),
+                        past_key_values=cache, use_cache=True)
+            self.forward_passes += 1
+            predicted = out.logits[0].argmax(-1).tolist()
+            accepted = 0
+            while accepted < len(draft) and predicted[accepted] == draft[accepted]:
+                accepted += 1
+            self.drafted += len(draft)
+            self.accepted += accepted
+            new = draft[:accepted] + [predicted[accepted]]
+            cache.crop(len(ids) + accepted)
+            for token in new:
+                ids.append(token)
+                if token in stop_ids:
+                    break
+            if ids[-1] in stop_ids:
+                break
+        metrics.observe("decode", time.perf_counter() - decode_start)
+        generated = ids[prompt_len:]
+        self.new_tokens += len(generated)
+        return Generation(
+            text=tokenizer.decode(generated, skip_special_tokens=True).strip(),
+            prompt_tokens=prompt_len,
+            new_tokens=len(generated),
+        )
+
+    def generate(self, tokenizer, model, prompts, max_new_tokens=128):
+        # One prompt at a time: acceptance lengths differ per row, so drafts
+        # do not batch
+        prepare_tokenizer(tokenizer)
+        with torch.inference_mode():
+            return record_generations([self._generate_one(tokenizer, model, p, max_new_tokens) for p in prompts])
+
+    def stats(self):
+        return {
+            "forward_passes": self.forward_passes,
+            "new_tokens": self.new_tokens,
+            "drafted": self.drafted,
+            "accepted": self.accepted,
+            "accept_rate": self.accepted / self.drafted if self.drafted else 0.0,
+            "tokens_per_pass": self.new_tokens / self.forward_passes if self.forward_passes else 0.0,
+        }
+
+# --- Prefix KV-cache reuse ---
+# Keeps past_key_values for the most recent static prompt prefix of each model.
+# When the prefix text changes (e.g. the contacts embedded in it), the cache is
+# cropped to the longest common token prefix and only the new tail is encoded.
+class PrefixCache:
+    def __init__(self):
+        self._entries = {}   # id(model) -> {"text", "ids", "cache"}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.encoded_tokens = 0
+
+    def _prepare(self, tokenizer, model, prefix_text):
+        entry = self._entries.get(id(model))
+        if entry is not None and entry["text"] == prefix_text:
+            self.hits += 1
+            return entry
+        self.misses += 1
+        ids = tokenizer(prefix_text)["input_ids"]
+        common = 0
+        if entry is not None:
+            for old, new in zip(entry["ids"], ids):
+                if old != new:
+                    break
+                common += 1
+        # Always re-encode at least the last token so there is something to run
+        common = min(common, len(ids) - 1)
+        cache = entry["cache"] if entry is not None and common > 0 else DynamicCache()
+        cache.crop(common)
+        with torch.inference_mode():
+            model(input_ids=torch.tensor([ids[common:]], device=model.device),
+                  past_key_values=cache, use_cache=True)
+        self.encoded_tokens += len(ids) - common
+        entry = {"text": prefix_text, "ids": ids, "cache": cache}
+        self._entries[id(model)] = entry
+        return entry
+
+    def generate(self, tokenizer, model, prefix_text, suffixes, max_new_tokens=128, constraint=None, **generate_kwargs):
+        # One generate() per suffix; prefill only covers the suffix tokens
+        prepare_tokenizer(tokenizer)
+        results = []
+        with self._lock:
+            with metrics.span("prefix_prefill"):
+                entry = self._prepare(tokenizer, model, prefix_text)
+            prefix_len = len(entry["ids"])
+            for suffix in suffixes:
+                with metrics.span("tokenize"):
+                    suffix_ids = tokenizer(suffix, add_special_tokens=False)["input_ids"]
+                input_ids = torch.tensor([entry["ids"] + suffix_ids], device=model.device)
+                call_kwargs = dict(generate_kwargs)
+                if constraint is not None:
+                    call_kwargs.update(constraint.generation_kwargs())
+                stage_timer(call_kwargs)
+                try:
+                    with torch.inference_mode():
+                        outputs = model.generate(
+                            input_ids=input_ids,
+                            attention_mask=torch.ones_like(input_ids),
+                            past_key_values=entry["cache"],
+                            max_new_tokens=max_new_tokens,
+                            pad_token_id=tokenizer.pad_token_id,
+                            **call_kwargs
+                        )
+                finally:
+                    # generate() appends to the cache in place; drop everything past the prefix
+                    entry["cache"].crop(prefix_len)
+                new_tokens = outputs[0][input_ids.shape[1]:]
+                results.append(Generation(
+                    text=tokenizer.decode(new_tokens, skip_special_tokens=True).strip(),
+                    prompt_tokens=input_ids.shape[1],
+                    new_tokens=int((new_tokens != tokenizer.pad_token_id).sum()),
+                ))
+        return record_generations(results)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "encoded_tokens": self.encoded_tokens}
@@ -0,0 +1,479 @@
+import json, threading
+import torch
+from transformers import LogitsProcessor, LogitsProcessorList, StoppingCriteria, StoppingCriteriaList
+from transformers.models.gpt2.tokenization_gpt2 import bytes_to_unicode
+
+WHITESPACE = b" \t\n\r"
+# Longest run of insignificant whitespace the constrained decoder lets the model emit
+MAX_WHITESPACE_RUN = 2
+# Candidates checked per step before falling back to scanning the whole vocab
+TOP_K = 32
+# Allowed-token masks kept per decoding (one per distinct validator state)
+MASK_CACHE_SIZE = 512
+
+# --- Schema description from the pydantic models ---
+def schema_variants(*models):
+    # One variant per model: {"props": {key: allowed values or None}, "required": set}
+    # Literal fields become enums, everything else is a free string.
+    variants = []
+    for model in models:
+        schema = model.model_json_schema()
+        props = {}
+        for key, prop in schema["properties"].items():
+            if "const" in prop:
+                props[key] = [prop["const"]]
+            elif "enum" in prop:
+                props[key] = list(prop["enum"])
+            else:
+                props[key] = None
+        variants.append({"props": props, "required": set(schema.get("required", props))})
+    return variants
+
+# --- Incremental validator for a flat JSON object of string values ---
+# Consumes UTF-8 bytes and rejects a byte the moment the prefix can no longer
+# become an object that matches at least one variant (discriminated union).
+class SchemaJsonValidator:
+    def __init__(self, variants, max_preamble=0):
+        self.variants = variants
+        self.candidates = tuple(range(len(variants)))
+        # Non-brace bytes skipped before the object starts (what extract_json tolerates)
+        self.max_preamble = max_preamble
+        self.preamble = 0
+        self.state = "start"
+        self.fields = {}
+        self.key = b""
+        self.value = b""
+        self.escape = 0          # 0: none, 1: after backslash, 2-5: inside \uXXXX
+        self.whitespace = 0
+        self.failed = False
+
+    @property
+    def complete(self):
+        return self.state == "done"
+
+    def copy(self):
+        clone = type(self).__new__(type(self))
+        clone.__dict__.update(self.__dict__)
+        clone.fields = dict(self.fields)
+        return clone
+
+    def feed(self, data: bytes):
+        for byte in data:
+            if self.failed or self.state == "done":
+                # Nothing may follow the closing brace
+                self.failed = True
+                return False
+            if not self._step(byte):
+                self.failed = True
+                return False
+        return True
+
+    def accepts(self, data: bytes):
+        return self.copy().feed(data)
+
+    def signature(self):
+        # Two validators with the same signature accept exactly the same bytes
+        # from here on. A free string's content only matters through whether
+        # it is still valid UTF-8 (json.loads checks that when it closes).
+        key = self.key.decode("utf-8", "replace")
+        value = self.value
+        if self.state == "string" and self._allowed_values(key) is None:
+            value = _utf8_tail(value)
+        return (self.state, self.candidates, frozenset(self.fields), self.key, value, self.escape,
+                self.whitespace, self.preamble if self.state == "start" else 0, self.failed)
+
+    def _key_prefix_ok(self, key: bytes):
+        return any(k.encode("utf-8").startswith(key) for k in self._allowed_keys())
+
+    def _key_ok(self, key: str):
+        return key in self._allowed_keys()
+
+    def _allowed_keys(self):
+        keys = set()
+        for i in self.candidates:
+            keys.update(self.variants[i]["props"])
+        return keys - set(self.fields)
+
+    def _allowed_values(self, key):
+        values = set()
+        for i in self.candidates:
+            allowed = self.variants[i]["props"].get(key, [])
+            if allowed is None:
+                return None
+            values.update(allowed)
+        return values
+
+    def _can_close(self):
+        return any(self.variants[i]["required"] <= set(self.fields) for i in self.candidates)
+
+    def _skip_whitespace(self, byte):
+        if byte in WHITESPACE:
+            self.whitespace += 1
+            return self.whitespace <= MAX_WHITESPACE_RUN
+        return None
+
+    def _step(self, byte):
+        state = self.state
+        if state in ("start", "object", "key_start", "colon", "value_start", "after_value"):
+            skipped = self._skip_whitespace(byte)
+            if skipped is not None:
+                return skipped
+            self.whitespace = 0
+        ch = chr(byte)
+
+        if state == "start":
+            if ch != "{":
+                self.preamble += 1
+                return self.preamble <= self.max_preamble
+            self.state = "object"
+        elif state in ("object", "key_start"):
+            if ch == '"':
+                self.key = b""
+                self.state = "key"
+            elif ch == "}" and state == "object" and self._can_close():
+                self.state = "done"
+            else:
+                return False
+        elif state == "key":
+            if ch == '"':
+                if not self._key_ok(self.key.decode("utf-8", "replace")):
+                    return False
+                self.state = "colon"
+            else:
+                self.key += bytes([byte])
+                if not self._key_prefix_ok(self.key):
+                    return False
+        elif state == "colon":
+            if ch != ":":
+                return False
+            self.state = "value_start"
+        elif state == "value_start":
+            if ch != '"':
+                return False
+            self.value = b""
+            self.escape = 0
+            self.state = "string"
+        elif state == "string":
+            return self._string_byte(byte)
+        elif state == "after_value":
+            if ch == ",":
+                if not self._allowed_keys():
+                    return False
+                self.state = "key_start"
+            elif ch == "}" and self._can_close():
+                self.state = "done"
+            else:
+                return False
+        return True
+
+    def _string_byte(self, byte):
+        ch = chr(byte)
+        if self.escape == 1:
+            if ch == "u":
+                self.escape = 2
+            elif ch in '"\\/bfnrt':
+                self.escape = 0
+            else:
+                return False
+        elif self.escape >= 2:
+            if ch not in "0123456789abcdefABCDEF":
+                return False
+            self.escape = 0 if self.escape == 5 else self.escape + 1
+        elif ch == "\\":
+            self.escape = 1
+        elif ch == '"':
+            return self._close_string()
+        elif byte < 0x20:
+            return False
+        self.value += bytes([byte])
+        return self._value_prefix_ok()
+
+    def _value_prefix_ok(self):
+        allowed = self._allowed_values(self.key.decode("utf-8", "replace"))
+        if allowed is None:
+            return True
+        return any(v.encode("utf-8").startswith(self.value) for v in allowed)
+
+    def _close_string(self):
+        key = self.key.decode("utf-8", "replace")
+        try:
+            value = json.loads(b'"' + self.value + b'"')
+        except ValueError:
+            return False
+        allowed = self._allowed_values(key)
+        if allowed is not None and value not in allowed:
+            return False
+        # Keep only the variants this key/value pair is consistent with
+        self.candidates = tuple(
+            i for i in self.candidates
+            if key in self.variants[i]["props"]
+            and (self.variants[i]["props"][key] is None or value in self.variants[i]["props"][key])
+        )
+        if not self.candidates:
+            return False
+        self.fields[key] = value
+        self.state = "after_value"
+        return True
+
+def _utf8_tail(data: bytes):
+    # b"" if data decodes cleanly, the bytes of a character still being
+    # completed, or None once it can never decode
+    try:
+        data.decode("utf-8")
+        return b""
+    except UnicodeDecodeError as e:
+        return data[e.start:] if e.reason == "unexpected end of data" else None
+
+# --- Syntax-only variant for free decoding ---
+# Any keys, no required fields: it only rejects output that can no longer be
+# a flat JSON object, and reports when the object has closed. Unlike the
+# constrained decoder it takes whatever extract_json/json.loads would: any
+# amount of whitespace (pretty-printed output) or chatter before the brace,
+# scalar values and repeated keys (the last one wins). pydantic still has the
+# final say on the fields.
+class JsonObjectValidator(SchemaJsonValidator):
+    def __init__(self):
+        super().__init__([{"props": {}, "required": set()}])
+
+    def _skip_whitespace(self, byte):
+        return True if byte in WHITESPACE else None
+
+    def _step(self, byte):
+        ch = chr(byte)
+        if self.state == "start" and ch != "{" and byte not in WHITESPACE:
+            # A "}" before any "{" is something extract_json cannot get past
+            return ch != "}"
+        if self.state == "value_start" and ch in "-0123456789tfn":
+            self.value = bytes([byte])
+            self.state = "scalar"
+            return True
+        if self.state == "scalar":
+            if ch not in ",}" and byte not in WHITESPACE:
+                self.value += bytes([byte])
+                return True
+            try:
+                value = json.loads(self.value)
+            except ValueError:
+                return False
+            self.fields[self.key.decode("utf-8", "replace")] = value
+            self.state = "after_value"
+            self.whitespace = 0
+        return super()._step(byte)
+
+    def _key_prefix_ok(self, key):
+        return True
+
+    def _key_ok(self, key):
+        return True
+
+    def _allowed_keys(self):
+        return True
+
+    def _allowed_values(self, key):
+        return None
+
+    def _can_close(self):
+        return True
+
+    def _close_string(self):
+        try:
+            value = json.loads(b'"' + self.value + b'"')
+        except ValueError:
+            return False
+        self.fields[self.key.decode("utf-8", "replace")] = value
+        self.state = "after_value"
+        return True
+
+# --- Token id -> raw bytes ---
+class TokenBytes:
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.byte_decoder = {v: k for k, v in bytes_to_unicode().items()}
+        self.special_ids = set(tokenizer.all_special_ids)
+        self._cache = {}
+
+    def __call__(self, token_id):
+        if token_id not in self._cache:
+            if token_id in self.special_ids:
+                data = None
+            else:
+                token = self.tokenizer.convert_ids_to_tokens(token_id)
+                if token is not None and all(c in self.byte_decoder for c in token):
+                    # Byte-level BPE (Qwen, GPT-2): every symbol maps to one byte
+                    data = bytes(self.byte_decoder[c] for c in token)
+                else:
+                    data = self.tokenizer.decode([token_id]).encode("utf-8")
+            self._cache[token_id] = data
+        return self._cache[token_id]
+
+# --- Allowed-token masks per validator state ---
+# The vocabulary sorted by bytes puts tokens that share a prefix next to each
+# other, so the walk reuses the validator state of the shared prefix, and one
+# rejected prefix rules out the whole run of tokens starting with it. Masks are
+# cached by validator signature: a free string field, say, is the same state
+# at every position of every request.
+class TokenMasks:
+    def __init__(self, token_bytes, max_entries=MASK_CACHE_SIZE):
+        self.token_bytes = token_bytes
+        self.max_entries = max_entries
+        self._tokens = None
+        self._vocab_size = None
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def _sorted_tokens(self, vocab_size):
+        if self._vocab_size != vocab_size:
+            tokens = ((self.token_bytes(t), t) for t in range(vocab_size))
+            self._tokens = sorted((data, t) for data, t in tokens if data)
+            self._vocab_size = vocab_size
+        return self._tokens
+
+    def get(self, validator, vocab_size):
+        # -> bool tensor over the vocabulary: True where the token keeps the JSON valid
+        key = (validator.signature(), vocab_size)
+        with self._lock:
+            mask = self._cache.get(key)
+        if mask is None:
+            mask = self._build(validator, vocab_size)
+            with self._lock:
+                self._cache[key] = mask
+                while len(self._cache) > self.max_entries:
+                    self._cache.pop(next(iter(self._cache)))
+        return mask
+
+    def _build(self, validator, vocab_size):
+        allowed = []
+        stack = [validator]   # stack[d]: the validator after the first d bytes of `current`
+        current, dead = b"", None
+        for data, token_id in self._sorted_tokens(vocab_size):
+            if dead is not None and data.startswith(dead):
+                continue
+            n, limit = 0, min(len(current), len(data), len(stack) - 1)
+            while n < limit and current[n] == data[n]:
+                n += 1
+            del stack[n + 1:]
+            current = data
+            for i in range(n, len(data)):
+                state = stack[-1].copy()
+                if not state.feed(data[i:i + 1]):
+                    dead = data[:i + 1]
+                    break
+                stack.append(state)
+            else:
+                allowed.append(token_id)
+        mask = torch.zeros(vocab_size, dtype=torch.bool)
+        mask[allowed] = True
+        return mask
+
+# --- transformers hooks ---
+class JsonSchemaConstraint:
+    # Shared state for one generate() call: one validator per batch row, fed
+    # with every token the model commits to.
+    def __init__(self, token_bytes, variants, eos_token_ids, top_k=TOP_K, make_validator=None, masks=None):
+        self.token_bytes = token_bytes
+        self.variants = variants
+        self.make_validator = make_validator or (lambda: SchemaJsonValidator(variants))
+        self.eos_token_ids = list(eos_token_ids)
+        self.top_k = top_k
+        self.masks = masks or TokenMasks(token_bytes)
+        self.validators = None
+        self.prompt_len = None
+        self.fed = None
+
+    def sync(self, input_ids):
+        if self.validators is None:
+            # First call happens before any token is generated
+            self.prompt_len = input_ids.shape[1]
+            self.validators = [self.make_validator() for _ in range(input_ids.shape[0])]
+            self.fed = [0] * input_ids.shape[0]
+        for row, validator in enumerate(self.validators):
+            generated = input_ids[row, self.prompt_len + self.fed[row]:].tolist()
+            for token_id in generated:
+                if not validator.complete and not validator.failed:
+                    data = self.token_bytes(token_id)
+                    if data is None or not validator.feed(data):
+                        validator.failed = True
+            self.fed[row] += len(generated)
+
+    def allowed_token(self, validator, scores_row):
+        top = torch.topk(scores_row, min(self.top_k, scores_row.shape[-1])).indices.tolist()
+        allowed = [t for t in top if self._accepts(validator, t)]
+        if allowed:
+            return allowed
+        # Nothing in the top-k keeps the JSON valid: best token of the state's mask
+        mask = self.masks.get(validator, scores_row.shape[-1]).to(scores_row.device)
+        if not mask.any():
+            return []
+        return [int(scores_row.masked_fill(~mask, float("-inf")).argmax())]
+
+    def _accepts(self, validator, token_id):
+        data = self.token_bytes(token_id)
+        return bool(data) and validator.accepts(data)
+
+class JsonSchemaLogitsProcessor(LogitsProcessor):
+    def __init__(self, constraint):
+        self.constraint = constraint
+
+    def __call__(self, input_ids, scores):
+        self.constraint.sync(input_ids)
+        mask = torch.full_like(scores, float("-inf"))
+        for row, validator in enumerate(self.constraint.validators):
+            allowed = []
+            if not validator.complete and not validator.failed:
+                allowed = self.constraint.allowed_token(validator, scores[row])
+            if not allowed:
+                # Finished (or hopeless) rows may only end the sequence
+                allowed = self.constraint.eos_token_ids
+            mask[row, allowed] = 0
+        return scores + mask
+
+class JsonCompleteCriteria(StoppingCriteria):
+    # Stops each row the moment its object closes (or can no longer be valid)
+    def __init__(self, constraint):
+        self.constraint = constraint
+
+    def __call__(self, input_ids, scores, **kwargs):
+        self.constraint.sync(input_ids)
+        done = [v.complete or v.failed for v in self.constraint.validators]
+        return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
+
+class JsonSchemaDecoding:
+    # Reusable across calls: generation_kwargs() hands out fresh per-call state
+    def __init__(self, tokenizer, *models, top_k=TOP_K):
+        self.token_bytes = TokenBytes(tokenizer)
+        self.variants = schema_variants(*models)
+        eos = tokenizer.eos_token_id
+        self.eos_token_ids = [t for t in {eos, tokenizer.pad_token_id} if t is not None]
+        self.top_k = top_k
+        self.masks = TokenMasks(self.token_bytes)
+
+    def generation_kwargs(self):
+        constraint = JsonSchemaConstraint(self.token_bytes, self.variants, self.eos_token_ids, self.top_k,
+                                          masks=self.masks)
+        return {
+            "logits_processor": LogitsProcessorList([JsonSchemaLogitsProcessor(constraint)]),
+            "stopping_criteria": StoppingCriteriaList([JsonCompleteCriteria(constraint)]),
+        }
+
+# --- Early stop for free decoding ---
+# extract_json parses from the first "{" to the first "}", so its result is
+# settled once a "}" has been generated: stopping there, and never earlier,
+# cannot change what it returns.
+class FirstClosingBrace:
+    def __init__(self):
+        self.complete = False
+        self.failed = False
+
+    def feed(self, data: bytes):
+        self.complete = self.complete or b"}" in data
+        return True
+
+class JsonEarlyStop:
+    # Free decoding, but each row stops at its first "}" instead of running
+    # on to max_new_tokens
+    def __init__(self, tokenizer):
+        self.token_bytes = TokenBytes(tokenizer)
+
+    def generation_kwargs(self):
+        constraint = JsonSchemaConstraint(self.token_bytes, None, [], make_validator=FirstClosingBrace)
+        return {"stopping_criteria": StoppingCriteriaList([JsonCompleteCriteria(constraint)])}
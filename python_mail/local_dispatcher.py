@@ -1,104 +1,88 @@
-import os, json, base64
-from transformers import AutoModelForCausalLM, AutoTokenizer
-from email.mime.text import MIMEText
-from googleapiclient.discovery import build
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from pydantic import BaseModel, EmailStr, ValidationError, Field
-from typing import Annotated, Literal, Union
-from peft import PeftModel   # ✅ added for LoRA
-from fastapi import FastAPI
+import os, json, threading, time
+from pydantic import BaseModel, Field, TypeAdapter, ValidationError
+from typing import Annotated, Optional, Union
+from fastapi import FastAPI, Header, HTTPException, Request
+from fastapi.responses import JSONResponse, StreamingResponse, PlainTextResponse
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
+from ai_and_send_mail import EmailRequest, ContactUpdate, parse_requests, stream_parse_request, fast_parse, fast_path, FAST_PATH, parse_cache, handle_request
+from micro_batcher import MicroBatcher
+from mail_outbox import Outbox, DurableOutbox, OutboxFull
+from mail_transport import send_email, send_emails_bulk
+from contact_store import ContactStore
+from parse_cache import PARSE_CACHE, contacts_version
+from model_registry import load_in_background, model_status
+import ai_and_send_mail
+import metrics
 
-SCOPES = ['https://www.googleapis.com/auth/gmail.send']
+# Micro-batching knobs for /parse_and_dispatch
+PARSE_MAX_BATCH_SIZE = int(os.environ.get("PARSE_MAX_BATCH_SIZE", "8"))
+PARSE_MAX_WAIT_MS = float(os.environ.get("PARSE_MAX_WAIT_MS", "20"))
+
+# Outbound mail: bounded queue drained by MAIL_SEND_CONCURRENCY send workers.
+# MAIL_TRANSPORT=fake (see mail_transport) swaps Gmail for a local fake.
+MAIL_SEND_CONCURRENCY = int(os.environ.get("MAIL_SEND_CONCURRENCY", "4"))
+MAIL_OUTBOX_SIZE = int(os.environ.get("MAIL_OUTBOX_SIZE", "1000"))
+# MAIL_OUTBOX=durable keeps the queue in SQLite (OUTBOX_DB) so it survives
+# restarts and paces sends; memory is the in-process queue, lost on exit
+MAIL_OUTBOX = os.environ.get("MAIL_OUTBOX", "durable")
+OUTBOX_DB = os.environ.get("OUTBOX_DB", "outbox.db")
+# Sends per second and burst for the durable outbox (per process, 0 = no limit).
+# Gmail allows 250 quota units per user per second and messages.send costs 100.
+MAIL_RATE = float(os.environ.get("MAIL_RATE", "2.5"))
+MAIL_BURST = int(os.environ.get("MAIL_BURST", "10"))
+# Queued emails a send worker hands to the transport in one bulk call
+MAIL_BULK_SIZE = int(os.environ.get("MAIL_BULK_SIZE", "50"))
+# NDJSON lines validated and applied together by the bulk endpoint
+BULK_CHUNK_LINES = int(os.environ.get("BULK_CHUNK_LINES", "500"))
+# MODEL_PRELOAD=0 skips the background load at startup; the model is then
+# loaded by the first natural-language request instead
+MODEL_PRELOAD = os.environ.get("MODEL_PRELOAD", "1") == "1"
 
 
 app = FastAPI()
 
-contacts = {
+# --- Request latency per route ---
+# Plain ASGI rather than @app.middleware("http"): that wrapper stops a
+# streaming response from reading the request body, which the bulk endpoint does
+class RequestTimer:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not metrics.enabled():
+            return await self.app(scope, receive, send)
+        start = time.perf_counter()
+
+        async def timed_send(message):
+            if message["type"] == "http.response.start":
+                # The route template, so /messages/{message_id} is one series
+                route = getattr(scope.get("route"), "path", "unmatched")
+                metrics.registry.observe("http_request_duration_seconds", time.perf_counter() - start,
+                                         route=route, method=scope["method"], status=message["status"])
+            await send(message)
+        await self.app(scope, receive, timed_send)
+
+app.add_middleware(RequestTimer)
+
+# Persisted in contacts.db; the defaults only seed an empty address book
+contacts = ContactStore(seed={
         "bob": "f74144765@gs.ncku.edu.tw",
         "alice": "stonetsai96@gmail.com",
         "me": "stonetsai96@gmail.com"
-    }
+    })
 
 # --- Pydantic Schemas ---
-class EmailRequest(BaseModel):
-    type: Literal["email"]
-    receiver: EmailStr   # must be a full email address now
-    subject: str
-    body: str
-
-class ContactUpdate(BaseModel):
-    type: Literal["update"]
-    action: Literal["add", "update", "delete"]
+# EmailRequest / ContactUpdate are shared with ai_and_send_mail so that
+# parsed results and posted payloads are the same classes
+class ParseRequest(BaseModel):
+    text: str
+    # Named LoRA adapter to parse with (MULTI_ADAPTER); None = the default one
+    adapter: Optional[str] = None
+
+class AdapterLoad(BaseModel):
     name: str
-    email: EmailStr
-
-
-# --- Gmail API setup ---
-def get_gmail_service():
-    creds = None
-    if os.path.exists('token.json'):
-        creds = Credentials.from_authorized_user_file('token.json', SCOPES)
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
-        else:
-            flow = InstalledAppFlow.from_client_secrets_file('credentials.json', SCOPES)
-            creds = flow.run_local_server(port=0)
-        with open('token.json', 'w') as token:
-            token.write(creds.to_json())
-    return build('gmail', 'v1', credentials=creds)
-
-def send_email(to_address, subject, body_text):
-    print(f"to_address: {to_address}, subject: {subject}, body_text: {body_text}")
-    service = get_gmail_service()
-    message = MIMEText(body_text)
-    message['to'] = to_address
-    message['from'] = "stonetsai96@gmail.com"
-    message['subject'] = subject
-    raw = base64.urlsafe_b64encode(message.as_bytes()).decode()
-    body = {'raw': raw}
-    service.users().messages().send(userId="me", body=body).execute()
-    print(f"✅ Email sent to {to_address}")
-
-# --- Contact management ---
-def update_contacts(contacts: dict, update: dict):
-    action = update.get("action")
-    name = update.get("name")
-    email = update.get("email")
-
-    if action == "add":
-        if name and email:
-            contacts[name] = email
-            print(f"✅ Added contact {name} -> {email}")
-    elif action == "update":
-        if name in contacts and email:
-            contacts[name] = email
-            print(f"✅ Updated contact {name} -> {email}")
-        else:
-            print(f"❌ Cannot update, {name} not found")
-    elif action == "delete":
-        if name in contacts:
-            del contacts[name]
-            print(f"✅ Deleted contact {name}")
-        else:
-            print(f"❌ Cannot delete, {name} not found")
-    else:
-        print("❌ Unknown action")
-
-    return contacts
-
-# --- Dispatcher ---
-def handle_request(parsed, contacts):
-    if isinstance(parsed, ContactUpdate):
-        contacts = update_contacts(contacts, parsed.dict())
-
-    elif isinstance(parsed, EmailRequest):
-        send_email(parsed.receiver, parsed.subject, parsed.body)
-
-    else:
-        print("❌ Unknown request type")
+    path: str
+
 
 RequestPayload = Annotated[
     Union[EmailRequest, ContactUpdate],
@@ -106,8 +90,286 @@ RequestPayload = Annotated[
 ]
 
 
-@app.post("/dispatcher_and_send_mail")
+if MAIL_OUTBOX == "durable":
+    # Retries and backoff are the outbox's job, so the transport tries once
+    outbox = DurableOutbox(lambda messages: send_emails_bulk(messages, max_attempts=1), path=OUTBOX_DB,
+                           concurrency=MAIL_SEND_CONCURRENCY, maxsize=MAIL_OUTBOX_SIZE, max_bulk=MAIL_BULK_SIZE,
+                           rate=MAIL_RATE, burst=MAIL_BURST)
+else:
+    outbox = Outbox(send_email, concurrency=MAIL_SEND_CONCURRENCY, maxsize=MAIL_OUTBOX_SIZE,
+                    bulk_send_fn=send_emails_bulk, max_bulk=MAIL_BULK_SIZE)
+
+async def dispatch(request, idempotency_key=None, **extra):
+    # Emails are queued and sent in the background (202 + message id); contact
+    # updates are applied straight away, as a SQLite write on the threadpool.
+    # Repeating an Idempotency-Key returns the original message, not a new one.
+    if isinstance(request, EmailRequest):
+        try:
+            message_id = outbox.submit(request.receiver, request.subject, request.body,
+                                       lane="interactive", idempotency_key=idempotency_key)
+        except OutboxFull as e:
+            raise HTTPException(status_code=503, detail=str(e))
+        state = (outbox.status(message_id) or {}).get("state", "queued")
+        return JSONResponse(status_code=202, content={**extra, "status": state, "message_id": message_id})
+    await run_in_threadpool(handle_request, request, contacts)
+    return JSONResponse(status_code=200, content={**extra, "status": "done"})
+
+@app.on_event("startup")
+async def start_outbox():
+    await outbox.start()
+
+@app.on_event("shutdown")
+async def stop_outbox():
+    await outbox.stop()
+
+# --- Startup / health ---
+# Structured JSON and contact updates are served as soon as the app is up;
+# the model loads on a side thread and /readyz turns 200 once it is in memory
+def start_model_load():
+    if ai_and_send_mail.MULTI_ADAPTER:
+        return load_in_background(loader=ai_and_send_mail.get_adapter_pool)
+    return load_in_background(ai_and_send_mail.model_name, ai_and_send_mail.adapter_dir)
 
-def dispatcher(payload: RequestPayload):
+@app.on_event("startup")
+async def preload_model():
+    # serve.py workers inherit a model the parent loaded before forking
+    if MODEL_PRELOAD and model_status()["state"] != "ready":
+        start_model_load()
+
+@app.get("/healthz")
+def healthz():
+    return {"status": "ok"}
+
+@app.get("/readyz")
+def readyz():
+    status = model_status()
+    ready = status["state"] == "ready" or (not MODEL_PRELOAD and status["state"] != "failed")
+    return JSONResponse(status_code=200 if ready else 503, content={"ready": ready, "model": status})
+
+@app.post("/dispatcher_and_send_mail", status_code=202)
+async def dispatcher(payload: RequestPayload, idempotency_key: Optional[str] = Header(None)):
     print("JSON received!!")
-    handle_request(payload, contacts)
+    return await dispatch(payload, idempotency_key)
+
+# --- Bulk NDJSON ingestion ---
+# One JSON record per line, emails and contact updates mixed. The body is read
+# as it arrives and handled BULK_CHUNK_LINES lines at a time: each chunk's
+# contact updates are one SQLite transaction and its emails one outbox
+# submission. The response streams one JSON result per input line, in order.
+payload_adapter = TypeAdapter(RequestPayload)
+
+async def ndjson_lines(request):
+    # -> (line number, raw line) without holding more than one chunk of the body
+    pending = b""
+    number = 0
+    async for chunk in request.stream():
+        pending += chunk
+        *lines, pending = pending.split(b"\n")
+        for line in lines:
+            number += 1
+            yield number, line
+    if pending:
+        yield number + 1, pending
+
+async def apply_chunk(chunk, idempotency_key=None):
+    # chunk: [(line number, validated record)] -> one result dict per record
+    # A request-level Idempotency-Key covers each line: a retried upload
+    # returns the original results instead of editing or sending twice
+    results = {}
+    updates = [(n, r) for n, r in chunk if isinstance(r, ContactUpdate)]
+    if updates:
+        # The SQLite write runs off the event loop; the outbox queue must not
+        keys = [f"{idempotency_key}:{n}" for n, _ in updates] if idempotency_key else None
+        errors = await run_in_threadpool(contacts.apply_updates, [(r.action, r.name, r.email) for _, r in updates], keys)
+        for (n, r), error in zip(updates, errors):
+            results[n] = {"line": n, "status": "done"} if error is None else \
+                {"line": n, "status": "failed", "error": error}
+        if PARSE_CACHE and any(e is None for e in errors):
+            parse_cache.purge_stale(contacts_version(contacts))
+    emails = [(n, r) for n, r in chunk if isinstance(r, EmailRequest)]
+    if emails:
+        keys = [f"{idempotency_key}:{n}" for n, _ in emails] if idempotency_key else None
+        ids = outbox.submit_many([(r.receiver, r.subject, r.body) for _, r in emails], lane="bulk",
+                                 idempotency_keys=keys)
+        for (n, _), message_id in zip(emails, ids):
+            results[n] = {"line": n, "status": "queued", "message_id": message_id} if message_id else \
+                {"line": n, "status": "rejected", "error": f"outbox is full ({outbox.maxsize} messages queued)"}
+    return [results[n] for n, _ in chunk]
+
+async def bulk_results(request):
+    chunk, invalid = [], []
+    idempotency_key = request.headers.get("idempotency-key")
+
+    async def flush():
+        # Results go out in input order: invalid lines wait for the valid
+        # records of the same chunk
+        results = await apply_chunk(chunk, idempotency_key) if chunk else []
+        merged = sorted(results + invalid, key=lambda r: r["line"])
+        for result in merged:
+            metrics.inc("bulk_records_total", status=result["status"])
+        chunk.clear()
+        invalid.clear()
+        return "".join(json.dumps(r, ensure_ascii=False) + "\n" for r in merged)
+
+    async for number, line in ndjson_lines(request):
+        if not line.strip():
+            continue
+        try:
+            chunk.append((number, payload_adapter.validate_json(line)))
+        except ValidationError as e:
+            invalid.append({"line": number, "status": "invalid",
+                            "error": e.errors(include_url=False, include_context=False, include_input=False)})
+        if len(chunk) + len(invalid) >= BULK_CHUNK_LINES:
+            yield await flush()
+    if chunk or invalid:
+        yield await flush()
+
+class BodyReadingStream(StreamingResponse):
+    # StreamingResponse also listens for the disconnect on `receive`, which
+    # would steal the body chunks bulk_results is still reading; a disconnect
+    # surfaces there instead (request.stream() raises ClientDisconnect)
+    async def __call__(self, scope, receive, send):
+        await self.stream_response(send)
+
+@app.post("/dispatcher_and_send_mail/bulk")
+async def dispatcher_bulk(request: Request):
+    return BodyReadingStream(bulk_results(request), media_type="application/x-ndjson")
+
+@app.get("/messages/{message_id}")
+def message_status(message_id: str):
+    status = outbox.status(message_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Unknown message id")
+    return {"message_id": message_id, **status}
+
+@app.get("/metrics/outbox")
+def outbox_metrics():
+    return outbox.metrics()
+
+# --- LoRA adapters (MULTI_ADAPTER) ---
+# Loaded and unloaded at runtime on the one shared base model; a load blocks
+# generation for as long as it takes to read the adapter (milliseconds)
+def check_adapter(name):
+    if name is None or name == ai_and_send_mail.DEFAULT_ADAPTER:
+        return
+    if not ai_and_send_mail.MULTI_ADAPTER:
+        raise HTTPException(status_code=400, detail="Named adapters need MULTI_ADAPTER=1")
+    # Unknown only once the pool exists; before that the first parse builds it
+    pool = ai_and_send_mail.adapter_pool
+    if pool is not None and name not in pool:
+        raise HTTPException(status_code=404, detail=f"Unknown adapter {name}")
+
+def require_pool():
+    if not ai_and_send_mail.MULTI_ADAPTER:
+        raise HTTPException(status_code=409, detail="Start the server with MULTI_ADAPTER=1 or ADAPTERS=... to manage adapters")
+    return ai_and_send_mail.get_adapter_pool()
+
+@app.get("/adapters")
+def list_adapters():
+    return require_pool().describe()
+
+@app.post("/adapters", status_code=201)
+def load_adapter(payload: AdapterLoad):
+    pool = require_pool()
+    try:
+        info = pool.load(payload.name, payload.path)
+    except (FileNotFoundError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    # A reload changes the adapter's fingerprint, so old parse cache entries stop matching
+    return {"name": payload.name, **info}
+
+@app.delete("/adapters/{name}")
+def unload_adapter(name: str):
+    pool = require_pool()
+    try:
+        pool.unload(name)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Unknown adapter {name}")
+    return {"name": name, "status": "unloaded"}
+
+# --- Natural-language endpoint with dynamic micro-batching ---
+# Concurrent requests share one batched generate() on the single model copy
+# Items are (text, adapter): one batch may mix adapters on the shared base model
+parse_batcher = MicroBatcher(
+    lambda items: parse_requests([t for t, _ in items], contacts, batch_size=len(items), use_fast_path=False,
+                                 adapters=[a for _, a in items]),
+    max_batch_size=PARSE_MAX_BATCH_SIZE,
+    max_wait_ms=PARSE_MAX_WAIT_MS
+)
+
+@app.on_event("startup")
+async def start_parse_batcher():
+    await parse_batcher.start()
+
+@app.on_event("shutdown")
+async def stop_parse_batcher():
+    await parse_batcher.stop()
+
+@app.post("/parse_and_dispatch")
+async def parse_and_dispatch(payload: ParseRequest, idempotency_key: Optional[str] = Header(None)):
+    # Templated phrasings skip both the batching window and the model
+    check_adapter(payload.adapter)
+    parsed = fast_parse(payload.text, contacts) if FAST_PATH else None
+    if parsed is None:
+        parsed = await parse_batcher.submit((payload.text, payload.adapter))
+    if parsed is None:
+        raise HTTPException(status_code=422, detail="Could not parse request into an email or contact update")
+    return await dispatch(parsed, idempotency_key, parsed=parsed.dict())
+
+# --- Same endpoint as server-sent events ---
+# Streams "delta" and "field" events while the model generates, then one
+# "result" (the dispatch outcome) or "error" event.
+def sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+async def parse_events(text, adapter=None):
+    cancel = threading.Event()
+    try:
+        async for event in iterate_in_threadpool(stream_parse_request(text, contacts, cancel=cancel, adapter=adapter)):
+            kind = event.pop("event")
+            if kind != "result":
+                yield sse(kind, event)
+                continue
+            # Dispatch on the event loop: the outbox queue is not thread-safe
+            parsed = event["parsed"]
+            try:
+                response = await dispatch(parsed, parsed=parsed.dict())
+            except HTTPException as e:
+                yield sse("error", {"status_code": e.status_code, "detail": e.detail})
+            else:
+                yield sse("result", {"status_code": response.status_code, **json.loads(response.body)})
+    finally:
+        # Client went away (or we finished): stop generating
+        cancel.set()
+
+@app.post("/parse_and_dispatch/stream")
+async def parse_and_dispatch_stream(payload: ParseRequest):
+    check_adapter(payload.adapter)
+    return StreamingResponse(parse_events(payload.text, payload.adapter), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache"})
+
+@app.get("/metrics/parse_batcher")
+def parse_batcher_metrics():
+    return parse_batcher.metrics()
+
+@app.get("/metrics/fast_path")
+def fast_path_metrics():
+    return fast_path.stats()
+
+@app.get("/metrics/parse_cache")
+def parse_cache_metrics():
+    return parse_cache.stats()
+
+# --- Prometheus scrape endpoint ---
+# Stage histograms and counters from metrics.py, plus the JSON stats above
+# as gauges. METRICS=0 leaves it empty apart from the gauges.
+metrics.registry.register_gauges("outbox", outbox.metrics)
+metrics.registry.register_gauges("parse_batcher", parse_batcher.metrics)
+metrics.registry.register_gauges("fast_path", fast_path.stats)
+metrics.registry.register_gauges("parse_cache", parse_cache.stats)
+metrics.registry.register_gauges(
+    "adapter_pool", lambda: ai_and_send_mail.adapter_pool.stats() if ai_and_send_mail.adapter_pool else {})
+
+@app.get("/metrics")
+def prometheus_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
@@ -0,0 +1,485 @@
+import asyncio, os, socket, sqlite3, threading, time, uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+
+class OutboxFull(Exception):
+    pass
+
+# --- Bounded async outbox ---
+# submit() returns a message id immediately; a pool of `concurrency` workers
+# drains the queue and runs the blocking send_fn on a dedicated thread pool,
+# so a slow Gmail round-trip never holds up the API's request handling.
+# With a bulk_send_fn, a worker that finds more messages waiting takes up to
+# max_bulk of them and sends them in one call (Gmail batch / pooled SMTP).
+class Outbox:
+    def __init__(self, send_fn, concurrency=4, maxsize=1000, max_tracked=10000, bulk_send_fn=None, max_bulk=50):
+        self.send_fn = send_fn
+        self.bulk_send_fn = bulk_send_fn   # [(receiver, subject, body)] -> [{"ok", "error", ...}]
+        self.max_bulk = max_bulk
+        self.concurrency = concurrency
+        self.maxsize = maxsize
+        self.max_tracked = max_tracked
+        self.queue = None
+        self.statuses = OrderedDict()
+        self._keys = OrderedDict()   # idempotency key -> message id, in memory only
+        self._workers = []
+        self._executor = None
+        self.sent = 0
+        self.failed = 0
+
+    async def start(self):
+        self.queue = asyncio.Queue(maxsize=self.maxsize)
+        self._executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="outbox")
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+
+    async def stop(self):
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        if self._executor:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def submit(self, receiver, subject, body, lane="interactive", idempotency_key=None):
+        # lane is accepted for DurableOutbox compatibility; one FIFO queue here
+        if idempotency_key is not None and idempotency_key in self._keys:
+            return self._keys[idempotency_key]
+        message_id = uuid.uuid4().hex
+        try:
+            self.queue.put_nowait((message_id, receiver, subject, body))
+        except asyncio.QueueFull:
+            raise OutboxFull(f"outbox is full ({self.maxsize} messages queued)")
+        self._track(message_id, {"state": "queued", "receiver": receiver, "subject": subject,
+                                 "queued_at": time.time(), "error": None})
+        if idempotency_key is not None:
+            self._keys[idempotency_key] = message_id
+            while len(self._keys) > self.max_tracked:
+                self._keys.popitem(last=False)
+        return message_id
+
+    def submit_many(self, messages, lane="bulk", idempotency_keys=None):
+        # -> one message id per (receiver, subject, body), None for each one
+        # that did not fit in the queue
+        ids = []
+        for i, (receiver, subject, body) in enumerate(messages):
+            try:
+                ids.append(self.submit(receiver, subject, body, lane,
+                                       idempotency_keys[i] if idempotency_keys else None))
+            except OutboxFull:
+                ids.append(None)
+        return ids
+
+    def status(self, message_id):
+        return self.statuses.get(message_id)
+
+    def _track(self, message_id, status):
+        self.statuses[message_id] = status
+        # Only the most recent statuses are kept so memory stays bounded
+        while len(self.statuses) > self.max_tracked:
+            self.statuses.popitem(last=False)
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            while self.bulk_send_fn and len(batch) < self.max_bulk and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            statuses = [self._start_sending(message_id) for message_id, _, _, _ in batch]
+            try:
+                if len(batch) == 1:
+                    message_id, receiver, subject, body = batch[0]
+                    try:
+                        await loop.run_in_executor(self._executor, self.send_fn, receiver, subject, body)
+                    except Exception as e:
+                        print(f"❌ Failed to send {message_id} to {receiver}: {e}")
+                        self._finish(statuses[0], str(e))
+                    else:
+                        self._finish(statuses[0])
+                    continue
+                try:
+                    results = await loop.run_in_executor(
+                        self._executor, self.bulk_send_fn, [(r, s, b) for _, r, s, b in batch])
+                except Exception as e:
+                    print(f"❌ Failed to send {len(batch)} messages: {e}")
+                    results = [{"ok": False, "error": str(e)}] * len(batch)
+                for status, result in zip(statuses, results):
+                    self._finish(status, None if result["ok"] else result["error"])
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def _start_sending(self, message_id):
+        status = self.statuses.get(message_id, {})
+        status["state"] = "sending"
+        if "queued_at" in status:
+            metrics.observe("outbox_wait", time.time() - status["queued_at"])
+        return status
+
+    def _finish(self, status, error=None):
+        if error is None:
+            status.update(state="sent", sent_at=time.time())
+            self.sent += 1
+        else:
+            status.update(state="failed", error=error)
+            self.failed += 1
+
+    def metrics(self):
+        return {
+            "queue_depth": self.queue.qsize() if self.queue else 0,
+            "maxsize": self.maxsize,
+            "concurrency": self.concurrency,
+            "sent": self.sent,
+            "failed": self.failed,
+        }
+
+# --- Token bucket ---
+# Sends are paced to `rate` per second on average, in bursts of up to `burst`.
+# When the server throttles anyway the rate is halved (down to rate/16) and
+# sending pauses for the backoff; every clean batch wins back 5% of the
+# configured rate. rate=0 means unlimited.
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def take(self, n):
+        # Waits for at least one token, then takes up to n -> how many were taken
+        while True:
+            pause = self.paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+                continue
+            if not self.rate:
+                return n
+            self._refill()
+            if self.tokens >= 1:
+                taken = min(n, int(self.tokens))
+                self.tokens -= taken
+                return taken
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def give_back(self, n):
+        if self.rate:
+            self.tokens = min(self.burst, self.tokens + n)
+
+    def throttled(self, pause):
+        self.paused_until = max(self.paused_until, time.monotonic() + pause)
+        if self.max_rate:
+            self._refill()
+            self.rate = max(self.max_rate / 16, self.rate / 2)
+            self.tokens = min(self.tokens, 0.0)
+
+    def succeeded(self):
+        if self.max_rate:
+            self._refill()
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+# --- Durable outbox ---
+# Same interface as Outbox, backed by SQLite (WAL). A message is committed
+# before submit() returns, so a crash or restart never loses it. One
+# scheduler task claims due messages, interactive lane first, paced by a
+# TokenBucket, and hands each claimed batch to bulk_send_fn on up to
+# `concurrency` threads. Retryable failures (429/5xx, dropped connections)
+# go back to the queue with exponential backoff; the rest fail for good.
+#
+# A claimed row is committed as "sending" before the transport sees it. If
+# the process dies before the outcome is recorded, nobody knows whether the
+# mail went out, so on the next start such rows become "unconfirmed" and
+# are not retried: a lost send is visible, a duplicate send is not.
+#
+# Claims, results and submit_many batches are one transaction each. Several
+# processes (serve.py workers) can share one database; each claim is atomic.
+# The rate limit applies per process.
+LANES = {"interactive": 0, "bulk": 1}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id              TEXT PRIMARY KEY,
+    idempotency_key TEXT UNIQUE,
+    lane            INTEGER NOT NULL,
+    receiver        TEXT NOT NULL,
+    subject         TEXT NOT NULL,
+    body            TEXT NOT NULL,
+    state           TEXT NOT NULL,
+    attempts        INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    queued_at       REAL NOT NULL,
+    sent_at         REAL,
+    transport_id    TEXT,
+    claimed_by      TEXT,
+    error           TEXT
+);
+CREATE INDEX IF NOT EXISTS outbox_due ON outbox(state, lane, next_attempt_at);
+"""
+
+class DurableOutbox:
+    def __init__(self, bulk_send_fn, path="outbox.db", concurrency=4, maxsize=100000, max_bulk=50,
+                 rate=0.0, burst=10, max_attempts=5, retention_s=7 * 86400, poll_s=1.0):
+        from mail_transport import backoff_delay
+        self.bulk_send_fn = bulk_send_fn   # [(receiver, subject, body)] -> [{"ok", "id", "error", "retryable", "retry_after", "throttled"}]
+        self.path = path
+        self.concurrency = concurrency
+        self.maxsize = maxsize
+        self.max_bulk = max_bulk
+        self.bucket = TokenBucket(rate, burst)
+        self.max_attempts = max_attempts
+        self.retention_s = retention_s
+        # Rows submitted by other processes are noticed within poll_s
+        self.poll_s = poll_s
+        self._backoff_delay = backoff_delay
+        self._owner = f"{socket.gethostname()}:{os.getpid()}"
+        self._conn = None
+        self._lock = threading.Lock()
+        self._wakeup = None
+        self._slots = None
+        self._executor = None
+        self._scheduler = None
+        self._inflight = set()
+        self._pruned_at = 0.0
+        self.throttled = 0
+
+    # --- Lifecycle ---
+    async def start(self):
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            # WAL + NORMAL: a commit survives a process crash; only a power
+            # loss can take back the last few, for a fraction of the fsyncs
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(SCHEMA)
+        self._owner = f"{socket.gethostname()}:{os.getpid()}"   # a forked worker has a new pid
+        self._recover()
+        self._prune()
+        self._wakeup = asyncio.Event()
+        self._slots = asyncio.Semaphore(self.concurrency)
+        self._executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="outbox")
+        self._scheduler = asyncio.create_task(self._schedule())
+
+    async def stop(self, timeout=30):
+        if self._scheduler:
+            self._scheduler.cancel()
+            await asyncio.gather(self._scheduler, return_exceptions=True)
+            self._scheduler = None
+        # Let batches already handed to the transport record their outcome
+        if self._inflight:
+            await asyncio.wait(self._inflight, timeout=timeout)
+        if self._executor:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        if self._conn:
+            with self._lock:
+                self._conn.close()
+            self._conn = None
+
+    def _recover(self):
+        # "sending" rows whose process is gone: outcome unknown, never re-send
+        host = socket.gethostname()
+        with self._lock, self._conn:
+            owners = [row[0] for row in self._conn.execute(
+                "SELECT DISTINCT claimed_by FROM outbox WHERE state = 'sending'")]
+            dead = [o for o in owners if not self._alive(o, host)]
+            stranded = sum(self._conn.execute(
+                "UPDATE outbox SET state = 'unconfirmed', error = ? WHERE state = 'sending' AND claimed_by IS ?",
+                ("interrupted while sending; not retried to avoid a duplicate", owner)).rowcount for owner in dead)
+        if stranded:
+            print(f"⚠️ {stranded} message(s) were mid-send when the outbox last stopped: marked unconfirmed, not re-sent")
+
+    def _alive(self, owner, host):
+        name, _, pid = (owner or "").rpartition(":")
+        if name != host:
+            return bool(owner)   # claimed on another machine: its own restart recovers it
+        if not pid.isdigit() or int(pid) == os.getpid():
+            return False   # our pid: a previous process that had it
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def _prune(self):
+        # Finished rows are kept retention_s for status lookups and idempotency
+        self._pruned_at = time.time()
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM outbox WHERE state IN ('sent', 'failed', 'unconfirmed') AND queued_at < ?",
+                               (self._pruned_at - self.retention_s,))
+
+    # --- Submitting ---
+    def _insert(self, receiver, subject, body, lane, idempotency_key, now):
+        message_id = uuid.uuid4().hex
+        cursor = self._conn.execute(
+            "INSERT INTO outbox(id, idempotency_key, lane, receiver, subject, body, state, next_attempt_at, queued_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, 'queued', ?, ?) ON CONFLICT(idempotency_key) DO NOTHING",
+            (message_id, idempotency_key, LANES[lane], receiver, subject, body, now, now))
+        if cursor.rowcount == 0:
+            # Seen this key before: the original message stands
+            return self._conn.execute("SELECT id FROM outbox WHERE idempotency_key = ?", (idempotency_key,)).fetchone()[0]
+        return message_id
+
+    def _queued(self):
+        return self._conn.execute("SELECT COUNT(*) FROM outbox WHERE state = 'queued'").fetchone()[0]
+
+    def submit(self, receiver, subject, body, lane="interactive", idempotency_key=None):
+        with self._lock, self._conn:
+            if self._queued() >= self.maxsize:
+                raise OutboxFull(f"outbox is full ({self.maxsize} messages queued)")
+            message_id = self._insert(receiver, subject, body, lane, idempotency_key, time.time())
+        self._wakeup.set()
+        return message_id
+
+    def submit_many(self, messages, lane="bulk", idempotency_keys=None):
+        # One transaction; -> one id per message, None where the outbox was full
+        ids = []
+        now = time.time()
+        with self._lock, self._conn:
+            room = self.maxsize - self._queued()
+            for i, (receiver, subject, body) in enumerate(messages):
+                if len(ids) - ids.count(None) >= room:
+                    ids.append(None)
+                    continue
+                ids.append(self._insert(receiver, subject, body, lane,
+                                        idempotency_keys[i] if idempotency_keys else None, now))
+        self._wakeup.set()
+        return ids
+
+    # --- Scheduling ---
+    def _next_due(self):
+        # Seconds until the earliest queued message may go, None if none is queued
+        with self._lock:
+            row = self._conn.execute("SELECT MIN(next_attempt_at) FROM outbox WHERE state = 'queued'").fetchone()
+        return None if row[0] is None else row[0] - time.time()
+
+    def _claim(self, n):
+        with self._lock, self._conn:
+            return self._conn.execute(
+                "UPDATE outbox SET state = 'sending', attempts = attempts + 1, claimed_by = ? WHERE id IN ("
+                "  SELECT id FROM outbox WHERE state = 'queued' AND next_attempt_at <= ?"
+                "  ORDER BY lane, next_attempt_at LIMIT ?) "
+                "RETURNING id, receiver, subject, body, attempts, queued_at",
+                (self._owner, time.time(), n)).fetchall()
+
+    async def _next_batch(self):
+        while True:
+            due = self._next_due()
+            if due is None or due > 0:
+                if time.time() - self._pruned_at > 3600:
+                    self._prune()
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), min(self.poll_s, due) if due else self.poll_s)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            n = await self.bucket.take(self.max_bulk)
+            rows = self._claim(n)
+            self.bucket.give_back(n - len(rows))
+            if rows:
+                return rows
+
+    async def _schedule(self):
+        while True:
+            await self._slots.acquire()
+            try:
+                rows = await self._next_batch()
+            except BaseException:
+                self._slots.release()
+                raise
+            task = asyncio.create_task(self._send(rows))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+
+    async def _send(self, rows):
+        loop = asyncio.get_running_loop()
+        try:
+            now = time.time()
+            for _, _, _, _, attempts, queued_at in rows:
+                if attempts == 1:
+                    metrics.observe("outbox_wait", now - queued_at)
+            try:
+                results = await loop.run_in_executor(
+                    self._executor, self.bulk_send_fn, [(r, s, b) for _, r, s, b, _, _ in rows])
+            except Exception as e:
+                # Raised before anything went out (e.g. credentials): try again later
+                print(f"❌ Failed to send {len(rows)} messages: {e}")
+                results = [{"ok": False, "error": str(e), "retryable": True, "retry_after": None}] * len(rows)
+            self._record(rows, results)
+        finally:
+            self._slots.release()
+
+    def _record(self, rows, results):
+        now = time.time()
+        sent, retry, failed = [], [], []
+        pause = None
+        for (message_id, _, _, _, attempts, _), result in zip(rows, results):
+            if result["ok"]:
+                sent.append((now, result.get("id"), message_id))
+            elif result.get("retryable") and attempts < self.max_attempts:
+                delay = self._backoff_delay(attempts, result.get("retry_after"))
+                retry.append((now + delay, result["error"], message_id))
+                # Only a 429 or an explicit Retry-After slows the whole outbox
+                # down; a 5xx or a lost connection just backs that message off
+                if result.get("throttled") or result.get("retry_after") is not None:
+                    pause = max(pause or 0.0, result.get("retry_after") or 0.0, self._backoff_delay(1))
+            else:
+                failed.append((result["error"], message_id))
+        with self._lock, self._conn:
+            self._conn.executemany("UPDATE outbox SET state = 'sent', sent_at = ?, transport_id = ?, error = NULL "
+                                   "WHERE id = ?", sent)
+            self._conn.executemany("UPDATE outbox SET state = 'queued', next_attempt_at = ?, error = ? "
+                                   "WHERE id = ?", retry)
+            self._conn.executemany("UPDATE outbox SET state = 'failed', error = ? WHERE id = ?", failed)
+        if pause is not None:
+            self.throttled += 1
+            self.bucket.throttled(pause)
+        elif sent:
+            self.bucket.succeeded()
+        if retry:
+            self._wakeup.set()
+
+    # --- Reading ---
+    def status(self, message_id):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT state, receiver, subject, lane, attempts, queued_at, sent_at, error FROM outbox WHERE id = ?",
+                (message_id,)).fetchone()
+        if row is None:
+            return None
+        state, receiver, subject, lane, attempts, queued_at, sent_at, error = row
+        status = {"state": state, "receiver": receiver, "subject": subject,
+                  "lane": next(k for k, v in LANES.items() if v == lane), "attempts": attempts,
+                  "queued_at": queued_at, "error": error}
+        if sent_at is not None:
+            status["sent_at"] = sent_at
+        return status
+
+    def metrics(self):
+        with self._lock:
+            counts = self._conn.execute("SELECT state, lane, COUNT(*) FROM outbox GROUP BY state, lane").fetchall()
+        totals = {}
+        for state, lane, n in counts:
+            totals[state] = totals.get(state, 0) + n
+        return {
+            "queue_depth": totals.get("queued", 0),
+            **{f"queued_{name}": sum(n for s, l, n in counts if s == "queued" and l == lane)
+               for name, lane in LANES.items()},
+            "sending": totals.get("sending", 0),
+            "maxsize": self.maxsize,
+            "concurrency": self.concurrency,
+            "sent": totals.get("sent", 0),
+            "failed": totals.get("failed", 0),
+            "unconfirmed": totals.get("unconfirmed", 0),
+            "rate_per_sec": self.bucket.rate,
+            "throttled_batches": self.throttled,
+        }
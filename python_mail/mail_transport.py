@@ -0,0 +1,454 @@
+import os, asyncio, base64, datetime, random, threading, time
+from email.mime.text import MIMEText
+from email.utils import make_msgid
+import metrics
+# The Google client libraries are imported where they are used: they cost
+# ~0.3s at import and nothing needs them until the first real send
+
+SCOPES = ['https://www.googleapis.com/auth/gmail.send']
+TOKEN_FILE = 'token.json'
+CREDENTIALS_FILE = 'credentials.json'
+# From: address for every backend (Gmail still sends as the authorised account)
+SENDER = os.environ.get("MAIL_SENDER", "stonetsai96@gmail.com")
+# Refresh the access token this many seconds before it actually expires
+REFRESH_MARGIN = 300
+# Gmail accepts up to 100 calls per batch request but starts rate limiting
+# well before that, so bulk sends go out in batches of 50
+GMAIL_BATCH_LIMIT = 50
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+MAX_SEND_ATTEMPTS = 5
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 64.0
+# MAIL_TRANSPORT picks the backend:
+#   gmail - Gmail REST API (OAuth token.json)
+#   smtp  - any SMTP server through a pool of persistent connections (needs aiosmtplib)
+#   fake  - a local fake of the Gmail API that only records messages
+MAIL_TRANSPORT = os.environ.get("MAIL_TRANSPORT", "gmail")
+# SMTP backend. For a local sink: python -m aiosmtpd -n -l localhost:8025
+SMTP_HOST = os.environ.get("SMTP_HOST", "localhost")
+SMTP_PORT = int(os.environ.get("SMTP_PORT", "587"))
+SMTP_USERNAME = os.environ.get("SMTP_USERNAME") or None
+SMTP_PASSWORD = os.environ.get("SMTP_PASSWORD") or None
+# starttls: upgrade a plain connection (port 587), ssl: implicit TLS (port 465), none: plain text
+SMTP_TLS = os.environ.get("SMTP_TLS", "starttls")
+SMTP_POOL_SIZE = int(os.environ.get("SMTP_POOL_SIZE", "4"))
+# Servers cap messages per session; reconnect before reaching the cap
+SMTP_MAX_MESSAGES_PER_CONNECTION = int(os.environ.get("SMTP_MAX_MESSAGES_PER_CONNECTION", "100"))
+SMTP_TIMEOUT = float(os.environ.get("SMTP_TIMEOUT", "30"))
+
+def build_mime(to_address, subject, body_text, sender=SENDER):
+    message = MIMEText(body_text)
+    message['to'] = to_address
+    message['from'] = sender
+    message['subject'] = subject
+    return message
+
+def build_message(to_address, subject, body_text, sender=SENDER):
+    # Gmail API body: the MIME message, base64url encoded
+    raw = base64.urlsafe_b64encode(build_mime(to_address, subject, body_text, sender).as_bytes()).decode()
+    return {'raw': raw}
+
+def classify_error(exc):
+    # -> (retryable, retry_after seconds or None) for a failed send
+    import httplib2
+    from googleapiclient.errors import HttpError
+    if isinstance(exc, HttpError):
+        retry_after = exc.resp.get('retry-after')
+        try:
+            retry_after = float(retry_after) if retry_after is not None else None
+        except ValueError:
+            retry_after = None
+        return exc.resp.status in RETRYABLE_STATUS, retry_after
+    # Connection resets, timeouts and other transport-level errors
+    return isinstance(exc, (OSError, httplib2.HttpLib2Error)), None
+
+def is_throttled(exc):
+    # A 429 means the server wants us to send slower, not just to retry later
+    from googleapiclient.errors import HttpError
+    return isinstance(exc, HttpError) and exc.resp.status == 429
+
+def backoff_delay(attempt, retry_after=None):
+    # Exponential backoff with full jitter, never sooner than Retry-After
+    delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (attempt - 1)))
+    return max(delay, retry_after or 0.0)
+
+def _utcnow():
+    # google-auth stores expiry as a naive UTC datetime
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+# --- Long-lived Gmail transport ---
+# Credentials are loaded once and refreshed proactively under a lock, so only
+# one refresh is ever in flight. googleapiclient services and httplib2.Http are
+# not thread-safe, so each thread keeps its own service and keep-alive
+# connection, built from a discovery document that is read once per process.
+class GmailTransport:
+    def __init__(self, token_file=TOKEN_FILE, credentials_file=CREDENTIALS_FILE, sender=SENDER,
+                 http_factory=None, refresh_margin=REFRESH_MARGIN, service=None):
+        self.token_file = token_file
+        self.credentials_file = credentials_file
+        self.sender = sender
+        self.http_factory = http_factory   # None: a fresh httplib2.Http per thread
+        self.refresh_margin = datetime.timedelta(seconds=refresh_margin)
+        self._service = service   # fixed service (e.g. a fake), skips OAuth entirely
+        self._creds = None
+        self._creds_lock = threading.Lock()
+        self._local = threading.local()
+        self._discovery_doc = None
+
+    def _needs_refresh(self, creds):
+        if not creds.valid:
+            return True
+        return creds.expiry is not None and creds.expiry - _utcnow() < self.refresh_margin
+
+    def _load_credentials(self):
+        from google.oauth2.credentials import Credentials
+        from google_auth_oauthlib.flow import InstalledAppFlow
+        creds = None
+        if os.path.exists(self.token_file):
+            creds = Credentials.from_authorized_user_file(self.token_file, SCOPES)
+        if not creds or not creds.refresh_token:
+            flow = InstalledAppFlow.from_client_secrets_file(self.credentials_file, SCOPES)
+            creds = flow.run_local_server(port=0)
+            self._save_credentials(creds)
+        return creds
+
+    def _save_credentials(self, creds):
+        with open(self.token_file, 'w') as token:
+            token.write(creds.to_json())
+
+    def credentials(self):
+        creds = self._creds
+        if creds is not None and not self._needs_refresh(creds):
+            return creds
+        with self._creds_lock:
+            # Re-check: another thread may have refreshed while we waited
+            if self._creds is None:
+                self._creds = self._load_credentials()
+            if self._needs_refresh(self._creds):
+                from google.auth.transport.requests import Request
+                # Refreshed in place, so every thread's AuthorizedHttp sees the new token
+                self._creds.refresh(Request())
+                self._save_credentials(self._creds)
+            return self._creds
+
+    def service(self):
+        if self._service is not None:
+            return self._service
+        service = getattr(self._local, "service", None)
+        if service is None:
+            import httplib2
+            from googleapiclient.discovery import build_from_document
+            from googleapiclient.discovery_cache import get_static_doc
+            from google_auth_httplib2 import AuthorizedHttp
+            if self._discovery_doc is None:
+                self._discovery_doc = get_static_doc('gmail', 'v1')
+            http = AuthorizedHttp(self.credentials(), http=(self.http_factory or httplib2.Http)())
+            service = build_from_document(self._discovery_doc, http=http)
+            self._local.service = service
+        return service
+
+    def send(self, to_address, subject, body_text):
+        with metrics.span("gmail_service"):
+            if self._service is None:
+                self.credentials()   # proactive refresh before the token runs out
+            service = self.service()
+        body = build_message(to_address, subject, body_text, sender=self.sender)
+        with metrics.span("gmail_send"):
+            return service.users().messages().send(userId="me", body=body).execute()
+
+    def send_bulk(self, messages, max_attempts=MAX_SEND_ATTEMPTS, sleep=time.sleep):
+        # messages: list of (to_address, subject, body_text). Sends them as Gmail
+        # batch requests of up to GMAIL_BATCH_LIMIT calls per HTTP round-trip and
+        # retries rate-limited / 5xx items with backoff. Returns one result dict
+        # per message, in input order; failed ones also say whether a later
+        # retry could succeed (retryable, retry_after) and whether the server
+        # asked us to slow down (throttled).
+        messages = list(messages)
+        results = [{"to": to_address, "ok": False, "id": None, "error": None, "attempts": 0}
+                   for to_address, _, _ in messages]
+        bodies = [build_message(to_address, subject, body_text, sender=self.sender)
+                  for to_address, subject, body_text in messages]
+        pending = list(range(len(messages)))
+        attempt = 0
+
+        while pending:
+            attempt += 1
+            if self._service is None:
+                self.credentials()
+            service = self.service()
+            retry, retry_after = [], None
+
+            for start in range(0, len(pending), GMAIL_BATCH_LIMIT):
+                chunk = pending[start:start + GMAIL_BATCH_LIMIT]
+                failures = {}
+
+                def callback(request_id, response, exception):
+                    index = int(request_id)
+                    results[index]["attempts"] = attempt
+                    if exception is None:
+                        results[index].update(ok=True, id=response.get("id"), error=None)
+                    else:
+                        failures[index] = exception
+
+                batch = service.new_batch_http_request(callback=callback)
+                for index in chunk:
+                    batch.add(service.users().messages().send(userId="me", body=bodies[index]),
+                              request_id=str(index))
+                try:
+                    with metrics.span("gmail_send_batch"):
+                        batch.execute()
+                except Exception as e:
+                    # The whole round-trip failed (e.g. the batch itself got a 429)
+                    for index in chunk:
+                        if not results[index]["ok"]:
+                            results[index]["attempts"] = attempt
+                            failures[index] = e
+
+                for index, exception in failures.items():
+                    retryable, after = classify_error(exception)
+                    results[index].update(error=str(exception), retryable=retryable, retry_after=after,
+                                          throttled=is_throttled(exception))
+                    if retryable and attempt < max_attempts:
+                        retry.append(index)
+                        if after is not None:
+                            retry_after = max(retry_after or 0.0, after)
+
+            pending = sorted(retry)
+            if pending:
+                delay = backoff_delay(attempt, retry_after)
+                print(f"⏳ Retrying {len(pending)} message(s) in {delay:.1f}s (attempt {attempt + 1}/{max_attempts})")
+                sleep(delay)
+        return results
+
+# --- Pooled SMTP transport ---
+# Same interface as GmailTransport (send / send_bulk), over plain SMTP.
+# Connections are opened lazily, authenticated once and reused for up to
+# max_messages_per_connection messages each; up to pool_size of them send
+# concurrently. The I/O is asyncio (aiosmtplib) on one background event loop
+# thread, and the sync methods hand their work to it, so the outbox's worker
+# threads and send_bulk all share the same pool.
+class _SmtpConnection:
+    __slots__ = ("smtp", "sent")
+
+    def __init__(self, smtp):
+        self.smtp = smtp
+        self.sent = 0
+
+def classify_smtp_error(exc):
+    # -> (retryable, retry_after) like classify_error; SMTP 4xx replies are
+    # transient by definition, 5xx permanent, lost connections worth a retry
+    import aiosmtplib
+    if isinstance(exc, aiosmtplib.SMTPRecipientsRefused):
+        return all(400 <= e.code < 500 for e in exc.recipients), None
+    if isinstance(exc, aiosmtplib.SMTPResponseException):
+        return 400 <= exc.code < 500, None
+    return isinstance(exc, (aiosmtplib.SMTPServerDisconnected, aiosmtplib.SMTPConnectError,
+                            aiosmtplib.SMTPTimeoutError, OSError)), None
+
+class SmtpTransport:
+    def __init__(self, host=SMTP_HOST, port=SMTP_PORT, username=SMTP_USERNAME, password=SMTP_PASSWORD,
+                 tls=SMTP_TLS, sender=SENDER, pool_size=SMTP_POOL_SIZE,
+                 max_messages_per_connection=SMTP_MAX_MESSAGES_PER_CONNECTION, timeout=SMTP_TIMEOUT):
+        if tls not in ("starttls", "ssl", "none"):
+            raise ValueError(f"SMTP_TLS must be starttls, ssl or none, not {tls!r}")
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.tls = tls
+        self.sender = sender
+        self.pool_size = pool_size
+        self.max_messages_per_connection = max_messages_per_connection
+        self.timeout = timeout
+        self.connects = 0
+        self._loop = None
+        self._loop_lock = threading.Lock()
+        # Owned by the event loop thread only
+        self._idle = None
+        self._open = 0
+        self._slots = None
+
+    # --- Event loop thread ---
+    def _run(self, coro):
+        if self._loop is None:
+            with self._loop_lock:
+                if self._loop is None:
+                    loop = asyncio.new_event_loop()
+                    threading.Thread(target=loop.run_forever, name="smtp-transport", daemon=True).start()
+                    self._loop = loop
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    # --- Connection pool ---
+    async def _connect(self):
+        import aiosmtplib
+        smtp = aiosmtplib.SMTP(hostname=self.host, port=self.port, timeout=self.timeout,
+                               use_tls=self.tls == "ssl", start_tls=True if self.tls == "starttls" else False,
+                               username=self.username, password=self.password)
+        with metrics.span("smtp_connect"):
+            await smtp.connect()   # also logs in when username/password are set
+        self.connects += 1
+        return _SmtpConnection(smtp)
+
+    async def _acquire(self):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.pool_size)
+            self._idle = []
+        await self._slots.acquire()
+        while self._idle:
+            conn = self._idle.pop()
+            if conn.smtp.is_connected:
+                return conn
+            self._open -= 1
+        try:
+            conn = await self._connect()
+        except BaseException:
+            self._slots.release()
+            raise
+        self._open += 1
+        return conn
+
+    async def _release(self, conn, healthy):
+        if healthy and conn.sent < self.max_messages_per_connection:
+            self._idle.append(conn)
+        else:
+            self._open -= 1
+            await self._quit(conn)
+        self._slots.release()
+
+    async def _quit(self, conn):
+        try:
+            if conn.smtp.is_connected:
+                await conn.smtp.quit()
+        except Exception:
+            conn.smtp.close()
+
+    async def _send(self, message):
+        import aiosmtplib
+        # A pooled connection may have been dropped by the server while idle:
+        # that one failure gets a fresh connection straight away
+        for retry_stale in (True, False):
+            conn = await self._acquire()
+            reused = conn.sent > 0
+            try:
+                with metrics.span("smtp_send"):
+                    response = await conn.smtp.send_message(message)
+            except aiosmtplib.SMTPServerDisconnected:
+                await self._release(conn, healthy=False)
+                if reused and retry_stale:
+                    continue
+                raise
+            except aiosmtplib.SMTPResponseException:
+                # The server refused this message; reset and keep the session
+                try:
+                    await conn.smtp.rset()
+                    healthy = True
+                except Exception:
+                    healthy = False
+                await self._release(conn, healthy)
+                raise
+            except BaseException:
+                await self._release(conn, healthy=False)
+                raise
+            conn.sent += 1
+            await self._release(conn, healthy=True)
+            return response
+
+    async def _send_all(self, messages):
+        return await asyncio.gather(*(self._send(m) for m in messages), return_exceptions=True)
+
+    async def _close_all(self):
+        idle, self._idle = self._idle or [], []
+        for conn in idle:
+            self._open -= 1
+            await self._quit(conn)
+
+    def _mime(self, to_address, subject, body_text):
+        message = build_mime(to_address, subject, body_text, sender=self.sender)
+        # Gmail assigns ids itself; over SMTP the Message-ID is the message's id
+        message['Message-ID'] = make_msgid(domain=self.sender.rpartition("@")[2] or None)
+        return message
+
+    # --- Public API (thread-safe, blocking) ---
+    def send(self, to_address, subject, body_text):
+        message = self._mime(to_address, subject, body_text)
+        self._run(self._send(message))
+        return {"id": message['Message-ID']}
+
+    def send_bulk(self, messages, max_attempts=MAX_SEND_ATTEMPTS, sleep=time.sleep):
+        # Every pending message is in flight at once, spread over the pool;
+        # transient failures are retried with backoff like the Gmail batch path
+        messages = list(messages)
+        results = [{"to": to_address, "ok": False, "id": None, "error": None, "attempts": 0}
+                   for to_address, _, _ in messages]
+        mimes = [self._mime(to_address, subject, body_text) for to_address, subject, body_text in messages]
+        pending = list(range(len(messages)))
+        attempt = 0
+        while pending:
+            attempt += 1
+            outcomes = self._run(self._send_all([mimes[i] for i in pending]))
+            retry = []
+            for index, outcome in zip(pending, outcomes):
+                results[index]["attempts"] = attempt
+                if not isinstance(outcome, BaseException):
+                    results[index].update(ok=True, id=mimes[index]['Message-ID'], error=None)
+                    continue
+                retryable, after = classify_smtp_error(outcome)
+                results[index].update(error=str(outcome), retryable=retryable, retry_after=after)
+                if retryable and attempt < max_attempts:
+                    retry.append(index)
+            pending = retry
+            if pending:
+                delay = backoff_delay(attempt)
+                print(f"⏳ Retrying {len(pending)} message(s) in {delay:.1f}s (attempt {attempt + 1}/{max_attempts})")
+                sleep(delay)
+        return results
+
+    def stats(self):
+        return {"open_connections": self._open, "idle_connections": len(self._idle or ()), "connects": self.connects}
+
+    def close(self):
+        if self._loop is not None:
+            self._run(self._close_all())
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._loop = None
+
+_transport = None
+_transport_lock = threading.Lock()
+
+def get_transport():
+    global _transport
+    if _transport is None:
+        with _transport_lock:
+            if _transport is None:
+                if MAIL_TRANSPORT == "fake":
+                    from fake_gmail import FakeGmailService
+                    _transport = GmailTransport(service=FakeGmailService())
+                elif MAIL_TRANSPORT == "smtp":
+                    _transport = SmtpTransport()
+                elif MAIL_TRANSPORT == "gmail":
+                    _transport = GmailTransport()
+                else:
+                    raise ValueError(f"Unknown MAIL_TRANSPORT {MAIL_TRANSPORT!r}, expected gmail, smtp or fake")
+    return _transport
+
+# --- Sending through the configured transport ---
+def send_email(to_address, subject, body_text):
+    print(f"to_address: {to_address}, subject: {subject}, body_text: {body_text}")
+    try:
+        get_transport().send(to_address, subject, body_text)
+    except Exception:
+        metrics.inc("email_send_failures_total")
+        raise
+    metrics.inc("emails_sent_total")
+    print(f"✅ Email sent to {to_address}")
+
+def send_emails_bulk(messages, max_attempts=MAX_SEND_ATTEMPTS):
+    results = get_transport().send_bulk(messages, max_attempts=max_attempts)
+    sent = sum(1 for r in results if r["ok"])
+    metrics.inc("emails_sent_total", sent)
+    metrics.inc("email_send_failures_total", len(results) - sent)
+    print(f"✅ Bulk send: {sent}/{len(results)} delivered")
+    for r in results:
+        if not r["ok"]:
+            print(f"❌ Failed to send to {r['to']}: {r['error']}")
+    return results
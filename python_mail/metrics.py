@@ -0,0 +1,145 @@
+import os, bisect, threading, time
+from contextlib import nullcontext
+
+# METRICS=0 turns every span and counter into a no-op, e.g. for benchmarks
+METRICS = os.environ.get("METRICS", "1") == "1"
+# Upper bounds (seconds) of the latency histogram buckets
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+STAGE_HISTOGRAM = "stage_duration_seconds"
+
+HELP = {
+    STAGE_HISTOGRAM: "Time spent in each stage of parsing and sending",
+    "http_request_duration_seconds": "Time to the response start, per route",
+    "parse_requests_total": "Parsed requests by where the answer came from",
+    "parse_failures_total": "Requests that did not parse into an email or contact update",
+    "tokens_in_total": "Prompt tokens fed to the model",
+    "tokens_out_total": "Tokens generated by the model",
+    "emails_sent_total": "Emails handed to the mail transport successfully",
+    "email_send_failures_total": "Emails the mail transport failed to send",
+    "bulk_records_total": "NDJSON records received by the bulk endpoint, by result",
+}
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)   # last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+def _labels(labels):
+    def escape(v):
+        return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in labels) + "}" if labels else ""
+
+# --- Process-wide registry ---
+# Series are keyed by (name, sorted label pairs). One lock: every update is a
+# few integer additions, far below the cost of anything being measured.
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self._gauges = []   # (prefix, fn returning a dict of numbers)
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = Histogram()
+            hist.observe(value)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def register_gauges(self, prefix, fn):
+        # fn() is called at scrape time; its numeric values become gauges
+        self._gauges.append((prefix, fn))
+
+    def reset(self):
+        with self._lock:
+            self.histograms.clear()
+            self.counters.clear()
+
+    def render(self):
+        # Prometheus text exposition format 0.0.4
+        lines = []
+        with self._lock:
+            histograms = sorted((k, (list(h.counts), h.sum, h.count)) for k, h in self.histograms.items())
+            counters = sorted(self.counters.items())
+        typed = set()
+
+        def header(name, kind):
+            if name not in typed:
+                typed.add(name)
+                if name in HELP:
+                    lines.append(f"# HELP {name} {HELP[name]}")
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), (counts, total, count) in histograms:
+            header(name, "histogram")
+            cumulative = 0
+            for bound, n in zip((*BUCKETS, "+Inf"), counts):
+                cumulative += n
+                lines.append(f"{name}_bucket{_labels((*labels, ('le', bound)))} {cumulative}")
+            lines.append(f"{name}_sum{_labels(labels)} {total}")
+            lines.append(f"{name}_count{_labels(labels)} {count}")
+        for (name, labels), value in counters:
+            header(name, "counter")
+            lines.append(f"{name}{_labels(labels)} {value}")
+        for prefix, fn in self._gauges:
+            try:
+                values = fn()
+            except Exception:
+                continue
+            for key, value in sorted(values.items()):
+                if isinstance(value, (int, float)):
+                    header(f"{prefix}_{key}", "gauge")
+                    lines.append(f"{prefix}_{key} {float(value)}")
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+_NULL_SPAN = nullcontext()
+
+class Span:
+    __slots__ = ("stage", "start")
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        registry.observe(STAGE_HISTOGRAM, time.perf_counter() - self.start, stage=self.stage)
+        return False
+
+# --- Module-level API used by the instrumented code ---
+def enabled():
+    return METRICS
+
+def set_enabled(flag):
+    global METRICS
+    METRICS = bool(flag)
+
+def span(stage):
+    # with metrics.span("validate"): ...  (a shared no-op when disabled)
+    return Span(stage) if METRICS else _NULL_SPAN
+
+def observe(stage, seconds):
+    if METRICS:
+        registry.observe(STAGE_HISTOGRAM, seconds, stage=stage)
+
+def inc(name, value=1, **labels):
+    if METRICS:
+        registry.inc(name, value, **labels)
+
+def render():
+    return registry.render()
@@ -0,0 +1,94 @@
+import asyncio, time
+
+# --- Dynamic micro-batching ---
+# Concurrent callers submit one item each; a single background task collects
+# them for up to max_wait_ms or max_batch_size items, runs batch_fn once on the
+# whole batch in a worker thread, and resolves every caller's future.
+class MicroBatcher:
+    def __init__(self, batch_fn, max_batch_size=8, max_wait_ms=20):
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.queue = None
+        self._task = None
+        self.batches = 0
+        self.items = 0
+        self.last_batch_size = 0
+        self.total_wait_s = 0.0
+        self.max_wait_s = 0.0
+        self.total_batch_s = 0.0
+
+    async def start(self):
+        self.queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def submit(self, item):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((item, future, time.perf_counter()))
+        return await future
+
+    async def _collect(self):
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.max_wait_ms / 1000
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            started = time.perf_counter()
+            items = [item for item, _, _ in batch]
+            try:
+                results = await loop.run_in_executor(None, self.batch_fn, items)
+            except Exception as e:
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            else:
+                for (_, future, _), result in zip(batch, results):
+                    if not future.done():
+                        future.set_result(result)
+            self._record(batch, started)
+
+    def _record(self, batch, started):
+        finished = time.perf_counter()
+        self.batches += 1
+        self.items += len(batch)
+        self.last_batch_size = len(batch)
+        self.total_batch_s += finished - started
+        for _, _, enqueued in batch:
+            waited = started - enqueued
+            self.total_wait_s += waited
+            self.max_wait_s = max(self.max_wait_s, waited)
+
+    def metrics(self):
+        return {
+            "queue_depth": self.queue.qsize() if self.queue else 0,
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait_ms,
+            "batches": self.batches,
+            "items": self.items,
+            "last_batch_size": self.last_batch_size,
+            "avg_batch_size": self.items / self.batches if self.batches else 0.0,
+            "avg_wait_ms": 1000 * self.total_wait_s / self.items if self.items else 0.0,
+            "max_observed_wait_ms": 1000 * self.max_wait_s,
+            "avg_batch_ms": 1000 * self.total_batch_s / self.batches if self.batches else 0.0,
+        }
@@ -0,0 +1,202 @@
+import os, shutil, threading, hashlib, time
+# torch / transformers / peft are imported on first load, so callers that only
+# touch contacts or structured JSON never pay for them
+
+BASE_MODEL = "Qwen/Qwen3-0.6B"
+ADAPTER_DIR = "./qwen-lora-json"
+# Set QWEN_MERGE_LORA=1 to fold the adapter into the base weights at load time
+MERGE_LORA = os.environ.get("QWEN_MERGE_LORA", "0") == "1"
+# QWEN_BACKEND picks how the weights run on CPU:
+#   eager   - fp32 PyTorch (the original behaviour)
+#   bf16    - bfloat16 weights, half the memory of fp32
+#   int8    - LoRA merged, then torch dynamic int8 quantization of every Linear
+#   compile - LoRA merged, fp32 with torch.compile on the forward pass
+#   onnx    - LoRA merged and exported to an ONNX Runtime session (needs optimum[onnxruntime])
+BACKENDS = ("eager", "bf16", "int8", "compile", "onnx")
+BACKEND = os.environ.get("QWEN_BACKEND", "eager")
+# Exported ONNX models are kept here, one directory per model fingerprint
+ONNX_DIR = os.environ.get("QWEN_ONNX_DIR", "./onnx-export")
+# QWEN_SNAPSHOT_DIR=<dir> keeps a merged safetensors copy of base + adapter
+# there and loads merged models from it (mmap) instead of re-merging
+SNAPSHOT_DIR = os.environ.get("QWEN_SNAPSHOT_DIR", "")
+
+# --- Process-wide model cache ---
+# key: (base model, adapter dir, dtype, device, merged) -> (tokenizer, model)
+_models = {}
+_lock = threading.Lock()
+
+def _dtype_name(dtype):
+    if dtype is None:
+        return "float32"
+    # torch.bfloat16 -> "bfloat16"; plain strings pass through
+    return str(dtype).replace("torch.", "")
+
+def _cache_key(base_model, adapter_dir, dtype, device, merge, backend):
+    adapter = os.path.abspath(adapter_dir) if adapter_dir else None
+    return (base_model, adapter, _dtype_name(dtype), str(device), bool(merge) and adapter is not None, backend)
+
+def _load(base_model, adapter_dir, dtype, device, merge):
+    if merge and adapter_dir and SNAPSHOT_DIR:
+        return _load_snapshot(base_model, adapter_dir, dtype, device)
+    return _load_pretrained(base_model, adapter_dir, dtype, device, merge)
+
+def _load_pretrained(base_model, adapter_dir, dtype, device, merge):
+    import torch
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+    from peft import PeftModel
+    tokenizer = AutoTokenizer.from_pretrained(base_model, use_fast=True)
+    model = AutoModelForCausalLM.from_pretrained(
+        base_model, dtype=getattr(torch, _dtype_name(dtype))
+    )
+    if adapter_dir:
+        model = PeftModel.from_pretrained(model, adapter_dir)
+        if merge:
+            # Fold the LoRA deltas into the base weights so generation runs
+            # on a plain transformers model with no PEFT wrapper per layer
+            model = model.merge_and_unload()
+    model.to(device)
+    model.eval()
+    return tokenizer, model
+
+# --- Merged safetensors snapshot ---
+# Merging the adapter on every start means loading base + adapter and folding
+# the deltas. The merged weights are written once as safetensors; later starts
+# memory-map that file directly (no PEFT, no merge).
+def _load_snapshot(base_model, adapter_dir, dtype, device):
+    import torch
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+    snapshot = os.path.join(SNAPSHOT_DIR, f"{model_fingerprint(base_model, adapter_dir)}-{_dtype_name(dtype)}")
+    if not os.path.exists(os.path.join(snapshot, "config.json")):
+        print(f"📦 Writing merged snapshot to {snapshot}")
+        tokenizer, model = _load_pretrained(base_model, adapter_dir, dtype, "cpu", merge=True)
+        tmp = snapshot + ".tmp"
+        model.save_pretrained(tmp, safe_serialization=True)
+        tokenizer.save_pretrained(tmp)
+        # Rename last, so a half-written snapshot is never picked up
+        os.replace(tmp, snapshot)
+    tokenizer = AutoTokenizer.from_pretrained(snapshot, use_fast=True)
+    model = AutoModelForCausalLM.from_pretrained(snapshot, dtype=getattr(torch, _dtype_name(dtype)))
+    model.to(device)
+    model.eval()
+    return tokenizer, model
+
+# --- CPU backends ---
+def _quantize_int8(model):
+    # Weights stored as int8, activations quantized on the fly per batch;
+    # only nn.Linear is converted, so the LoRA must already be merged
+    import torch
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+def _compile(model):
+    # dynamic=True: prompt and cache lengths change every step of generate()
+    import torch
+    model.forward = torch.compile(model.forward, dynamic=True)
+    return model
+
+def _load_onnx(base_model, adapter_dir, dtype, device):
+    try:
+        from optimum.onnxruntime import ORTModelForCausalLM
+    except ImportError as e:
+        raise ImportError("QWEN_BACKEND=onnx needs `pip install optimum[onnxruntime]`") from e
+    from transformers import AutoTokenizer
+    export_dir = os.path.join(ONNX_DIR, model_fingerprint(base_model, adapter_dir))
+    if not os.path.exists(os.path.join(export_dir, "model.onnx")):
+        # One-off: merge in PyTorch, export, and keep only the ONNX graph
+        print(f"📦 Exporting merged model to ONNX in {export_dir}")
+        tokenizer, model = _load(base_model, adapter_dir, dtype, device, merge=True)
+        merged_dir = export_dir + "-merged"
+        model.save_pretrained(merged_dir)
+        tokenizer.save_pretrained(merged_dir)
+        del model
+        ORTModelForCausalLM.from_pretrained(merged_dir, export=True, use_cache=True).save_pretrained(export_dir)
+        tokenizer.save_pretrained(export_dir)
+        shutil.rmtree(merged_dir, ignore_errors=True)
+    tokenizer = AutoTokenizer.from_pretrained(export_dir, use_fast=True)
+    return tokenizer, ORTModelForCausalLM.from_pretrained(export_dir, use_cache=True)
+
+def _load_backend(base_model, adapter_dir, dtype, device, merge, backend):
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend {backend!r}, expected one of {BACKENDS}")
+    if backend == "onnx":
+        return _load_onnx(base_model, adapter_dir, dtype, device)
+    tokenizer, model = _load(base_model, adapter_dir, dtype, device, merge)
+    if backend == "int8":
+        model = _quantize_int8(model)
+    elif backend == "compile":
+        model = _compile(model)
+    return tokenizer, model
+
+def get_model(base_model=BASE_MODEL, adapter_dir=ADAPTER_DIR, dtype=None, device="cpu", merge=None, backend=None):
+    if merge is None:
+        merge = MERGE_LORA or bool(SNAPSHOT_DIR)
+    if backend is None:
+        backend = BACKEND
+    if backend in ("int8", "compile"):
+        # Quantization rewrites nn.Linear, so the PEFT wrappers must be gone;
+        # and PeftModel.generate calls the base model directly, so a compiled
+        # PeftModel.forward would never run
+        merge = True
+    if backend == "bf16" and dtype is None:
+        dtype = "bfloat16"
+    key = _cache_key(base_model, adapter_dir, dtype, device, merge, backend)
+    entry = _models.get(key)
+    if entry is not None:
+        return entry
+    with _lock:
+        # Another thread may have finished loading while we waited
+        entry = _models.get(key)
+        if entry is None:
+            print(f"⏳ Loading {base_model} (adapter={adapter_dir}, backend={backend}, dtype={key[2]}, "
+                  f"device={device}, merged={bool(merge)})")
+            entry = _load_backend(base_model, adapter_dir, dtype, device, merge, backend)
+            _models[key] = entry
+    return entry
+
+def model_fingerprint(base_model=BASE_MODEL, adapter_dir=ADAPTER_DIR):
+    # Identifies which weights produced a parse, without loading them:
+    # retraining the adapter (new file sizes/mtimes) yields a new fingerprint
+    parts = [base_model]
+    if adapter_dir and os.path.isdir(adapter_dir):
+        parts.append(os.path.abspath(adapter_dir))
+        for entry in sorted(os.scandir(adapter_dir), key=lambda e: e.name):
+            if entry.is_file():
+                stat = entry.stat()
+                parts.append(f"{entry.name}:{stat.st_size}:{stat.st_mtime_ns}")
+    return hashlib.sha1("|".join(parts).encode()).hexdigest()[:16]
+
+def supports_kv_reuse(model):
+    # PrefixCache drives the PyTorch forward with a DynamicCache directly;
+    # an ONNX Runtime session only runs through generate()
+    import torch
+    return isinstance(model, torch.nn.Module)
+
+# --- Background warm-up ---
+# The API starts serving contact and structured-JSON requests immediately
+# while the model loads on a side thread; /readyz reports this status.
+_warmup = {"state": "idle", "error": None, "load_s": None}
+
+def load_in_background(*args, loader=None, **kwargs):
+    # loader: what to call instead of get_model (e.g. building an adapter pool)
+    def run():
+        _warmup.update(state="loading", error=None)
+        start = time.perf_counter()
+        try:
+            (loader or get_model)(*args, **kwargs)
+        except Exception as e:
+            print(f"❌ Model load failed: {e}")
+            _warmup.update(state="failed", error=str(e))
+        else:
+            _warmup.update(state="ready", load_s=time.perf_counter() - start)
+    thread = threading.Thread(target=run, name="model-warmup", daemon=True)
+    thread.start()
+    return thread
+
+def model_status():
+    return dict(_warmup)
+
+def loaded_models():
+    return list(_models.keys())
+
+def clear_models():
+    with _lock:
+        _models.clear()
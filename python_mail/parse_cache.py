@@ -0,0 +1,157 @@
+import os, sys, time, json, sqlite3, threading, unicodedata, hashlib
+from collections import OrderedDict
+
+# PARSE_CACHE=0 turns the cache off entirely
+PARSE_CACHE = os.environ.get("PARSE_CACHE", "1") == "1"
+PARSE_CACHE_SIZE = int(os.environ.get("PARSE_CACHE_SIZE", "1024"))
+# Seconds an entry stays valid; 0 means no expiry
+PARSE_CACHE_TTL = float(os.environ.get("PARSE_CACHE_TTL", "86400"))
+# Path of the on-disk tier; empty keeps the cache in memory only
+PARSE_CACHE_DB = os.environ.get("PARSE_CACHE_DB", "")
+
+def normalize(text: str):
+    # Width-normalised, whitespace-collapsed; case is kept because it is
+    # part of the names and email bodies the parse produces
+    return " ".join(unicodedata.normalize("NFKC", text).split())
+
+def contacts_version(contacts):
+    # ContactStore counts its writes; a plain dict is hashed by content
+    if contacts is None:
+        return 0
+    version = getattr(contacts, "version", None)
+    if version is not None:
+        return version
+    digest = hashlib.sha1(json.dumps(sorted(contacts.items())).encode()).hexdigest()
+    return int(digest[:12], 16)
+
+# --- Two-tier cache of validated parse results ---
+# key: (normalized instruction, model fingerprint) and the entry must also
+# carry the current contacts version, since receivers are resolved against
+# the address book. Results are stored as JSON and rebuilt into the pydantic
+# model they came from, so a hit never touches the tokenizer or the model.
+class ParseCache:
+    def __init__(self, models, max_entries=PARSE_CACHE_SIZE, ttl=PARSE_CACHE_TTL, path=PARSE_CACHE_DB):
+        self.models = {m.__name__: m for m in models}
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._memory = OrderedDict()    # key -> (version, kind, payload, expires)
+        self._lock = threading.Lock()
+        self.path = path
+        self._conn = None
+        if path:
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            with self._conn:
+                if path != ":memory:":
+                    self._conn.execute("PRAGMA journal_mode=WAL")
+                self._conn.execute("""
+                    CREATE TABLE IF NOT EXISTS parse_cache (
+                        key     TEXT PRIMARY KEY,
+                        version INTEGER NOT NULL,
+                        kind    TEXT NOT NULL,
+                        payload TEXT NOT NULL,
+                        expires REAL NOT NULL
+                    )""")
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.purged = 0
+
+    @staticmethod
+    def key(instruction: str, fingerprint: str):
+        return hashlib.sha1(f"{fingerprint}\0{normalize(instruction)}".encode()).hexdigest()
+
+    def _expires(self):
+        return time.time() + self.ttl if self.ttl else float("inf")
+
+    def get(self, key, version):
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and entry[0] == version and entry[3] > now:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return self.models[entry[1]].parse_raw(entry[2])
+            if entry is not None:
+                del self._memory[key]
+            if self._conn is not None:
+                row = self._conn.execute(
+                    "SELECT kind, payload, expires FROM parse_cache WHERE key = ? AND version = ? AND expires > ?",
+                    (key, version, now)).fetchone()
+                if row is not None:
+                    self._remember(key, (version, *row))
+                    self.hits += 1
+                    self.disk_hits += 1
+                    return self.models[row[0]].parse_raw(row[1])
+            self.misses += 1
+            return None
+
+    def put(self, key, version, result):
+        if result is None:
+            # Failed parses are retried rather than remembered
+            return
+        entry = (version, type(result).__name__, result.json(), self._expires())
+        with self._lock:
+            self._remember(key, entry)
+            if self._conn is not None:
+                with self._conn:
+                    self._conn.execute("INSERT OR REPLACE INTO parse_cache VALUES (?, ?, ?, ?, ?)", (key, *entry))
+
+    def _remember(self, key, entry):
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+            self.evictions += 1
+
+    def purge_stale(self, version):
+        # Called after the address book changes: entries resolved against any
+        # other contacts version can never be hit again
+        with self._lock:
+            stale = [k for k, e in self._memory.items() if e[0] != version]
+            for k in stale:
+                del self._memory[k]
+            self.purged += len(stale)
+            if self._conn is not None:
+                with self._conn:
+                    self.purged += self._conn.execute(
+                        "DELETE FROM parse_cache WHERE version != ? OR expires <= ?",
+                        (version, time.time())).rowcount
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            if self._conn is not None:
+                with self._conn:
+                    self._conn.execute("DELETE FROM parse_cache")
+
+    def reopen(self):
+        # A forked worker (serve.py) must not share its parent's connection:
+        # SQLite locks and file offsets are per process
+        if self._conn is None or self.path == ":memory:":
+            return
+        with self._lock:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+
+    def memory_bytes(self):
+        # Keys and JSON payloads dominate; the tuple overhead is counted too
+        with self._lock:
+            return sum(sys.getsizeof(k) + sys.getsizeof(e) + sys.getsizeof(e[2])
+                       for k, e in self._memory.items())
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        stats = {
+            "entries": len(self._memory),
+            "memory_bytes": self.memory_bytes(),
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "purged": self.purged,
+        }
+        if self._conn is not None:
+            with self._lock:
+                stats["disk_entries"] = self._conn.execute("SELECT COUNT(*) FROM parse_cache").fetchone()[0]
+        return stats
@@ -0,0 +1,168 @@
+import argparse, gc, os, signal, socket, sys, time
+
+# --- Pre-fork API server ---
+# `uvicorn --workers N` starts N fresh interpreters and each one loads its own
+# copy of the weights. Here the parent loads the model once, then forks the
+# workers: they all read the same physical weight pages (copy-on-write, and
+# nothing ever writes to the weights), so N workers cost about one model plus
+# N small Python heaps. All workers accept on one shared listening socket.
+#
+# Per-worker state stays per worker: each has its own micro-batcher and caches.
+# Contacts and the durable outbox live in SQLite (WAL) and are shared by all
+# of them (with MAIL_OUTBOX=memory, GET /messages/{id} only knows messages its
+# own worker queued). MAIL_RATE applies per worker.
+SERVE_HOST = os.environ.get("SERVE_HOST", "127.0.0.1")
+SERVE_PORT = int(os.environ.get("SERVE_PORT", "8000"))
+SERVE_WORKERS = int(os.environ.get("SERVE_WORKERS", "2"))
+# Torch intra-op threads per worker; 0 = split the available cores evenly
+SERVE_THREADS = int(os.environ.get("SERVE_THREADS", "0"))
+
+def available_cores():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+def threads_per_worker(workers, threads=0):
+    # N workers each running a full-size thread pool oversubscribe the cores
+    # and every matmul slows down; give each worker its share instead
+    return threads or max(1, available_cores() // workers)
+
+def configure_threads(threads):
+    # Read by OpenMP/MKL when torch first loads, so set before any import of it
+    for var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS"):
+        os.environ[var] = str(threads)
+    # The Rust tokenizers pool does not survive fork(); tokenization is tiny anyway
+    os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+
+def set_torch_threads(threads):
+    import torch
+    torch.set_num_threads(threads)
+    try:
+        # One inter-op thread: each worker already runs one request batch at a time
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass   # already set, or inter-op work has started
+
+def bind_socket(host, port):
+    sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+def load_shared_model(merge):
+    # Everything the workers should share is loaded here, before the fork
+    import local_dispatcher
+    import model_registry
+    if merge and not local_dispatcher.ai_and_send_mail.MULTI_ADAPTER:
+        # Plain weights: no PEFT wrappers in every worker, and faster generation
+        model_registry.MERGE_LORA = True
+    start = time.perf_counter()
+    local_dispatcher.start_model_load().join()
+    status = model_registry.model_status()
+    if status["state"] != "ready":
+        raise SystemExit(f"❌ Model load failed: {status['error']}")
+    print(f"✅ Model loaded in {time.perf_counter() - start:.1f}s, shared by every worker")
+
+def use_model(base_model=None, adapter_dir=None):
+    # Overrides ai_and_send_mail's model before anything loads it
+    import ai_and_send_mail
+    if base_model:
+        ai_and_send_mail.model_name = base_model
+    if adapter_dir is not None:
+        ai_and_send_mail.adapter_dir = adapter_dir or None
+
+def run_worker(sock, threads, log_level):
+    import uvicorn
+    import local_dispatcher
+    # SQLite connections opened before the fork belong to the parent
+    local_dispatcher.contacts.reopen()
+    local_dispatcher.parse_cache.reopen()
+    set_torch_threads(threads)
+    config = uvicorn.Config(local_dispatcher.app, log_level=log_level, lifespan="on")
+    uvicorn.Server(config).run(sockets=[sock])
+
+def spawn(sock, threads, log_level):
+    pid = os.fork()
+    if pid == 0:
+        code = 0
+        try:
+            run_worker(sock, threads, log_level)
+        except BaseException:
+            import traceback
+            traceback.print_exc()
+            code = 1
+        finally:
+            # Never return into the parent's supervisor loop or run its atexit hooks
+            os._exit(code)
+    return pid
+
+def serve(host=SERVE_HOST, port=SERVE_PORT, workers=SERVE_WORKERS, threads=SERVE_THREADS,
+          load="parent", merge=True, log_level="warning", base_model=None, adapter_dir=None):
+    # load="parent": pre-fork, one shared copy of the weights;
+    # load="worker": every worker loads its own (what `uvicorn --workers` does)
+    if not hasattr(os, "fork"):
+        raise SystemExit("❌ serve.py needs os.fork (Linux/macOS); use `uvicorn local_dispatcher:app` instead")
+    threads = threads_per_worker(workers, threads)
+    configure_threads(threads)
+    if load == "worker" and merge:
+        # model_registry is not imported yet: it reads this on import
+        os.environ["QWEN_MERGE_LORA"] = "1"
+    use_model(base_model, adapter_dir)
+    if load == "parent":
+        set_torch_threads(threads)
+        load_shared_model(merge)
+    sock = bind_socket(host, port)
+    # Move every object that exists now out of the garbage collector's sight:
+    # a collection in a worker would otherwise write to (and so copy) every
+    # page holding one of the parent's objects
+    gc.collect()
+    gc.freeze()
+    print(f"🚀 Serving on http://{host}:{port} with {workers} worker(s) x {threads} torch thread(s) "
+          f"(model loaded in {'the parent' if load == 'parent' else 'each worker'})")
+
+    children = {spawn(sock, threads, log_level) for _ in range(workers)}
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    # Supervise: restart a worker that dies, until asked to stop
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        children.discard(pid)
+        if not stopping:
+            print(f"⚠️ Worker {pid} exited with status {status}, restarting")
+            children.add(spawn(sock, threads, log_level))
+    sock.close()
+    print("👋 All workers stopped")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pre-fork local_dispatcher workers that share one copy of the model")
+    parser.add_argument("--host", default=SERVE_HOST)
+    parser.add_argument("--port", type=int, default=SERVE_PORT)
+    parser.add_argument("--workers", type=int, default=SERVE_WORKERS)
+    parser.add_argument("--threads", type=int, default=SERVE_THREADS, help="torch threads per worker, 0 = cores / workers")
+    parser.add_argument("--load", choices=["parent", "worker"], default="parent",
+                        help="parent: load before forking and share the weights; worker: one copy per worker")
+    parser.add_argument("--no-merge", dest="merge", action="store_false",
+                        help="keep the LoRA adapter unmerged (always the case with MULTI_ADAPTER)")
+    parser.add_argument("--log-level", default="warning")
+    parser.add_argument("--base-model", default=None, help="default: ai_and_send_mail.model_name")
+    parser.add_argument("--adapter-dir", default=None, help="empty string for the base model only")
+    args = parser.parse_args()
+    sys.exit(serve(args.host, args.port, args.workers, args.threads, args.load, args.merge, args.log_level,
+                   args.base_model, args.adapter_dir))
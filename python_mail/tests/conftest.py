@@ -0,0 +1,15 @@
+import atexit, os, shutil, sys, tempfile
+
+# The app reads its configuration at import time: point it at the local fake
+# Gmail and throwaway databases, and never load the model
+_tmp = tempfile.mkdtemp(prefix="python_mail_tests_")
+atexit.register(shutil.rmtree, _tmp, ignore_errors=True)
+os.environ.update({
+    "MAIL_TRANSPORT": "fake",
+    "MODEL_PRELOAD": "0",
+    "PARSE_CACHE_DB": "",
+    "CONTACTS_DB": os.path.join(_tmp, "contacts.db"),
+    "OUTBOX_DB": os.path.join(_tmp, "outbox.db"),
+})
+# The modules are flat scripts in python_mail/
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,38 @@
+import pytest
+from contact_store import ContactStore
+from ai_and_send_mail import validate_json
+
+SEED = {"bob": "bob@example.com", "alice": "alice@example.com", "me": "me@example.com", "王小明": "ming@example.com"}
+
+@pytest.fixture
+def contacts():
+    store = ContactStore(":memory:", seed=SEED)
+    yield store
+    store.close()
+
+def test_exact_and_folded_names_resolve(contacts):
+    assert contacts.resolve("alice") == ("alice", "alice@example.com")
+    assert contacts.resolve("  ALICE ") == ("alice", "alice@example.com")
+    assert contacts.resolve("王小明") == ("王小明", "ming@example.com")
+
+@pytest.mark.parametrize("name", ["alex", "rob", "bobby", "elise", "mei", "王小"])
+def test_near_misses_are_never_resolved(contacts, name):
+    assert contacts.resolve(name) is None
+    email = {"type": "email", "receiver": name, "subject": "s", "body": "b"}
+    assert validate_json(email, contacts, quiet=True) is None
+
+def test_near_misses_are_suggested(contacts):
+    assert contacts.suggest("alicee")[0] == ("alice", "alice@example.com")
+    assert contacts.suggest("zzzz") == []
+
+def test_keyed_edits_are_applied_once(contacts):
+    edits = [("delete", "bob", None), ("add", "carol", "carol@example.com")]
+    assert contacts.apply_updates(edits, keys=["k:1", "k:2"]) == [None, None]
+    version = contacts.version
+    contacts["bob"] = "bob@new.example.com"
+    # The retry replays the first results: bob is not deleted again
+    assert contacts.apply_updates(edits, keys=["k:1", "k:2"]) == [None, None]
+    assert contacts["bob"] == "bob@new.example.com"
+    assert contacts.version == version + 1
+    assert contacts.apply_updates([("delete", "dave", None)], keys=["k:3"]) == ["dave not found"]
+    assert contacts.apply_updates([("delete", "dave", None)], keys=["k:3"]) == ["dave not found"]
@@ -0,0 +1,98 @@
+import json, threading, time, uuid
+import pytest
+from fastapi.testclient import TestClient
+import local_dispatcher
+import mail_transport
+from mail_outbox import Outbox, DurableOutbox
+
+EMAIL = {"type": "email", "receiver": "alice@example.com", "subject": "hello", "body": "hi"}
+
+@pytest.fixture(params=["durable", "memory"])
+def client(request, tmp_path, monkeypatch):
+    # A small outbox with one send worker, so tests can fill it
+    if request.param == "durable":
+        outbox = DurableOutbox(lambda messages: mail_transport.send_emails_bulk(messages, max_attempts=1),
+                               path=str(tmp_path / "outbox.db"), concurrency=1, maxsize=2)
+    else:
+        outbox = Outbox(mail_transport.send_email, concurrency=1, maxsize=2,
+                        bulk_send_fn=mail_transport.send_emails_bulk)
+    monkeypatch.setattr(local_dispatcher, "outbox", outbox)
+    with TestClient(local_dispatcher.app) as client:
+        yield client
+
+@pytest.fixture
+def fake_gmail():
+    return mail_transport.get_transport()._service
+
+@pytest.fixture
+def gate(fake_gmail, monkeypatch):
+    # Holds every fake Gmail send until the test sets the event
+    opened = threading.Event()
+    deliver = fake_gmail._deliver
+
+    def held(body):
+        opened.wait(10)
+        return deliver(body)
+    monkeypatch.setattr(fake_gmail, "_deliver", held)
+    yield opened
+    opened.set()
+
+def wait_for_state(client, message_id, state, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        status = client.get(f"/messages/{message_id}").json()
+        if status["state"] == state:
+            return status
+        time.sleep(0.01)
+    raise AssertionError(f"message {message_id} never reached {state!r}, last seen {status}")
+
+def test_email_is_accepted_with_a_message_id(client):
+    response = client.post("/dispatcher_and_send_mail", json=EMAIL)
+    assert response.status_code == 202
+    assert response.json()["status"] == "queued"
+    assert client.get(f"/messages/{response.json()['message_id']}").status_code == 200
+
+def test_parse_and_dispatch_accepts_fast_path_email(client):
+    response = client.post("/parse_and_dispatch", json={"text": "Send bob@example.com an email saying see you at noon"})
+    assert response.status_code == 202
+    assert response.json()["parsed"]["receiver"] == "bob@example.com"
+    assert response.json()["message_id"]
+
+def test_message_status_moves_from_queued_to_sent(client, gate, fake_gmail):
+    message_id = client.post("/dispatcher_and_send_mail", json=EMAIL).json()["message_id"]
+    wait_for_state(client, message_id, "sending")
+    gate.set()
+    status = wait_for_state(client, message_id, "sent")
+    assert status["receiver"] == "alice@example.com"
+    assert status["sent_at"] >= status["queued_at"]
+    assert any(m["to"] == "alice@example.com" and m["subject"] == "hello" for m in fake_gmail.sent)
+
+def test_unknown_message_id_is_404(client):
+    assert client.get("/messages/does-not-exist").status_code == 404
+
+def test_full_outbox_returns_503(client, gate):
+    codes = [client.post("/dispatcher_and_send_mail", json=EMAIL).status_code for _ in range(5)]
+    assert codes[0] == 202
+    assert codes[-1] == 503
+    assert set(codes) == {202, 503}
+
+def test_contact_update_is_applied(client):
+    update = {"type": "update", "action": "add", "name": "Dana", "email": "dana@example.com"}
+    response = client.post("/dispatcher_and_send_mail", json=update)
+    assert response.status_code == 200
+    assert response.json()["status"] == "done"
+    assert local_dispatcher.contacts.resolve("dana") == ("Dana", "dana@example.com")
+
+def test_retried_bulk_upload_replays_contact_updates(client):
+    lines = [{"type": "update", "action": "add", "name": "Erin", "email": "erin@example.com"},
+             {"type": "update", "action": "delete", "name": "Erin", "email": "erin@example.com"},
+             EMAIL]
+    body = "\n".join(json.dumps(line) for line in lines)
+    headers = {"Idempotency-Key": str(uuid.uuid4())}   # the contacts DB outlives the outbox fixture
+    first = [json.loads(l) for l in client.post("/dispatcher_and_send_mail/bulk", content=body, headers=headers).text.splitlines()]
+    local_dispatcher.contacts["Erin"] = "erin@new.example.com"
+    again = [json.loads(l) for l in client.post("/dispatcher_and_send_mail/bulk", content=body, headers=headers).text.splitlines()]
+    assert [r["status"] for r in first] == ["done", "done", "queued"]
+    assert again == first
+    # The delete was not applied a second time
+    assert local_dispatcher.contacts["Erin"] == "erin@new.example.com"
@@ -0,0 +1,26 @@
+import random
+from generate_dataset import make_example, receiver_name
+from eval_parser import address_book, score
+
+def test_generated_emails_carry_the_contact_name():
+    rng = random.Random(0)
+    emails = [ex for ex in (make_example(rng) for _ in range(200)) if ex["output"]["type"] == "email"]
+    assert emails
+    for ex in emails:
+        assert ex["receiver_name"] in ex["instruction"]
+        assert "receiver_name" not in ex["output"]
+
+def test_receivers_are_scored_against_the_contact_name():
+    example = {"instruction": "寄信給王士豪，內容是謝謝你的幫忙！", "receiver_name": "王士豪",
+               "output": {"type": "email", "receiver": "u12345@gmail.com", "subject": "Thanks", "body": "謝謝你的幫忙！"}}
+    assert address_book(example) == {"王士豪": "u12345@gmail.com"}
+    # A name answer (basic / LoRA prompts) and a resolved address both count
+    assert score({**example["output"], "receiver": "王士豪"}, example)["receiver"]
+    assert score(example["output"], example)["receiver"]
+    assert not score({**example["output"], "receiver": "u12345"}, example)["receiver"]
+
+def test_older_corpora_fall_back_to_the_local_part():
+    example = {"instruction": "Send bob an email saying hi",
+               "output": {"type": "email", "receiver": "bob@example.com", "subject": "s", "body": "hi"}}
+    assert receiver_name(example) == "bob"
+    assert address_book(example) == {"bob": "bob@example.com"}
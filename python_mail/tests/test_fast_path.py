@@ -0,0 +1,22 @@
+import pytest
+from contact_store import ContactStore
+from ai_and_send_mail import fast_parse
+
+@pytest.fixture
+def contacts():
+    store = ContactStore(":memory:", seed={"bob": "bob@example.com", "alice": "alice@example.com"})
+    yield store
+    store.close()
+
+def test_known_contact_is_resolved(contacts):
+    parsed = fast_parse("Send Alice an email saying the build is green", contacts)
+    assert parsed.receiver == "alice@example.com"
+    assert parsed.body == "the build is green"
+
+def test_literal_address_is_used_as_is(contacts):
+    assert fast_parse("Email carol@example.com: lunch at noon?", contacts).receiver == "carol@example.com"
+
+@pytest.mark.parametrize("text", ["Send alex an email saying hi", "Send bobby an email saying hi",
+                                  "Write an email to elise saying hi"])
+def test_unknown_receiver_falls_through(contacts, text):
+    assert fast_parse(text, contacts) is None
@@ -0,0 +1,36 @@
+import json
+import pytest
+from ai_and_send_mail import extract_json
+from json_constraints import JsonObjectValidator, FirstClosingBrace
+
+OUTPUTS = [
+    '{"type":"email","receiver":"bob","subject":"hi","body":"see you"}',
+    '{\n    "type": "email",\n    "receiver": "bob",\n    "subject": "hi",\n    "body": "see you"\n}',
+    'Sure! Here is the JSON object you asked for, based on the request above:\n\n'
+    '{"type": "update", "action": "add", "name": "Jim", "email": "jim@example.com"}',
+    '{"type": "email", "receiver": "bob", "subject": "hi", "body": "x", "priority": 1, "urgent": true}',
+    '{"type": "email", "type": "email", "receiver": "bob", "subject": "hi", "body": "x"}',
+]
+
+@pytest.mark.parametrize("text", OUTPUTS)
+def test_validator_accepts_what_extract_json_accepts(text):
+    validator = JsonObjectValidator()
+    assert validator.feed(text.encode())
+    assert validator.complete
+    assert validator.fields == extract_json(text)
+
+@pytest.mark.parametrize("text", OUTPUTS)
+def test_early_stop_keeps_the_extract_json_result(text):
+    # Fed in small chunks, as tokens would be; generation ends after the first "}"
+    stop, generated = FirstClosingBrace(), ""
+    for i in range(0, len(text), 3):
+        generated += text[i:i + 3]
+        stop.feed(text[i:i + 3].encode())
+        if stop.complete:
+            break
+    assert extract_json(generated + " trailing chatter {}") == extract_json(text)
+
+def test_validator_rejects_output_that_cannot_be_an_object():
+    assert not JsonObjectValidator().feed(b'} {"type": "email"}')
+    assert not JsonObjectValidator().feed(b'{"type": "email" "receiver"')
+    assert not JsonObjectValidator().feed(b'{"n": 1x2}')
@@ -0,0 +1,29 @@
+import asyncio
+import pytest
+from mail_outbox import DurableOutbox
+
+SERVER_ERROR = {"ok": False, "id": None, "error": "503 Backend Error", "retryable": True, "retry_after": None}
+RATE_LIMITED = {**SERVER_ERROR, "error": "429 Rate Limit Exceeded", "throttled": True}
+RETRY_AFTER = {**SERVER_ERROR, "retry_after": 2.0}
+
+async def first_failure(tmp_path, result):
+    # Sends one message whose first attempt fails with `result`
+    outbox = DurableOutbox(lambda messages: [dict(result) for _ in messages],
+                           path=str(tmp_path / "outbox.db"), concurrency=1, rate=10, burst=10)
+    await outbox.start()
+    try:
+        message_id = outbox.submit("alice@example.com", "hello", "hi")
+        for _ in range(500):
+            status = outbox.status(message_id)
+            if status["state"] == "queued" and status["attempts"] == 1:
+                return outbox
+            await asyncio.sleep(0.01)
+        raise AssertionError(f"message never came back for a retry, last seen {status}")
+    finally:
+        await outbox.stop()
+
+@pytest.mark.parametrize("result, throttled", [(SERVER_ERROR, False), (RATE_LIMITED, True), (RETRY_AFTER, True)])
+def test_only_rate_limits_slow_the_outbox_down(tmp_path, result, throttled):
+    outbox = asyncio.run(first_failure(tmp_path, result))
+    assert outbox.throttled == int(throttled)
+    assert outbox.bucket.rate == (5 if throttled else 10)
@@ -1,36 +1,296 @@
-import json
-from datasets import load_dataset
+import argparse, hashlib, json, os, time
+from datasets import load_dataset, load_from_disk, Dataset
 from transformers import (
     AutoTokenizer,
     AutoModelForCausalLM,
     Trainer,
     TrainingArguments,
+    TrainerCallback,
     DataCollatorForLanguageModeling
 )
+from transformers.trainer_utils import get_last_checkpoint
 from peft import LoraConfig, get_peft_model
+from generate_dataset import open_input
 
 BASE_MODEL = "Qwen/Qwen3-0.6B"
 DATA_FILE = "dataset.jsonl"
 OUTPUT_DIR = "./qwen-lora-json"
+# Pre-tokenized datasets live here, one directory per (tokenizer, format, data file)
+TOKEN_CACHE_DIR = os.environ.get("TOKEN_CACHE_DIR", "./token-cache")
+# Bump whenever format_prompt / tokenize_examples change what gets stored
+FORMAT_VERSION = 1
+MAX_LENGTH = 512
+
+# --- Training profiles ---
+# Defaults per hardware; every field can be overridden on the command line.
+# Effective batch size is batch_size * grad_accum = 8 in both.
+PROFILES = {
+    "gpu": {"precision": "fp16", "batch_size": 8, "grad_accum": 1, "gradient_checkpointing": False},
+    # fp16 autocast needs CUDA; bf16 only pays off on CPUs with native
+    # bf16 (AVX512-BF16 / AMX), so fp32 is the safe default
+    "cpu": {"precision": "fp32", "batch_size": 4, "grad_accum": 2, "gradient_checkpointing": True},
+}
+# 0 leaves torch's default (one thread per physical core)
+TRAIN_THREADS = int(os.environ.get("TRAIN_THREADS", "0"))
 
 def format_example(instruction, output_obj):
     # Serialize output as compact JSON string
     return f"Instruction: {instruction}\nOutput: {json.dumps(output_obj, ensure_ascii=False)}"
 
-def main():
-    tokenizer = AutoTokenizer.from_pretrained(BASE_MODEL, use_fast=True)
-    model = AutoModelForCausalLM.from_pretrained(BASE_MODEL)
+def format_prompt(instruction):
+    # Same prompt infer_qwen_loar.build_prompt feeds the model at inference
+    return f"Instruction: {instruction}\nOutput: "
+
+# --- Pre-tokenized cache ---
+def tokenize_examples(tokenizer, examples):
+    # Prompt and completion are tokenized separately so the model is trained
+    # on exactly the token boundary it sees at inference, and so the loss can
+    # be restricted to the completion (the JSON plus EOS)
+    prompts = tokenizer([format_prompt(ex["instruction"]) for ex in examples])["input_ids"]
+    completions = tokenizer([json.dumps(ex["output"], ensure_ascii=False) for ex in examples],
+                            add_special_tokens=False)["input_ids"]
+    for prompt, completion in zip(prompts, completions):
+        ids = (prompt + completion + [tokenizer.eos_token_id])[:MAX_LENGTH]
+        yield {"input_ids": ids, "prompt_len": len(prompt), "length": len(ids)}
+
+def read_examples(path, batch_size=1000):
+    # Raw JSON lines, so every output keeps its own keys and key order
+    batch = []
+    with open_input(path) as f:
+        for line in f:
+            if line.strip():
+                batch.append(json.loads(line))
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+def token_cache_path(tokenizer, data_file):
+    stat = os.stat(data_file)
+    vocab = hashlib.sha1(tokenizer.backend_tokenizer.to_str().encode()).hexdigest()
+    key = "|".join([tokenizer.name_or_path, vocab, str(FORMAT_VERSION), str(MAX_LENGTH),
+                    os.path.abspath(data_file), str(stat.st_size), str(stat.st_mtime_ns)])
+    return os.path.join(TOKEN_CACHE_DIR, hashlib.sha1(key.encode()).hexdigest()[:16])
+
+def load_token_cache(tokenizer, data_file=DATA_FILE):
+    # Tokenizes once and saves Arrow files; later runs memory-map them, so
+    # neither formatting nor tokenization is repeated and RAM stays flat
+    path = token_cache_path(tokenizer, data_file)
+    if not os.path.exists(os.path.join(path, "dataset_info.json")):
+        print(f"⏳ Tokenizing {data_file} into {path}")
+        start = time.perf_counter()
+
+        def rows():
+            for batch in read_examples(data_file):
+                yield from tokenize_examples(tokenizer, batch)
+
+        ds = Dataset.from_generator(rows, cache_dir=os.path.join(TOKEN_CACHE_DIR, "build"))
+        ds.save_to_disk(path)
+        print(f"✅ Tokenized {len(ds)} examples in {time.perf_counter() - start:.1f}s")
+    return load_from_disk(path)
+
+class CompletionCollator:
+    # Pads each batch only to its own longest row (batches are length-grouped,
+    # so that is close to no padding) and masks the prompt and padding out of
+    # the loss. Counts real and padded tokens for the throughput callback.
+    def __init__(self, tokenizer):
+        self.pad_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+        self.tokens = 0
+        self.padded_tokens = 0
+        self.samples = 0
+
+    def __call__(self, features):
+        import torch
+        width = max(f["length"] for f in features)
+        input_ids, labels, attention = [], [], []
+        for f in features:
+            ids, pad = list(f["input_ids"]), width - f["length"]
+            input_ids.append(ids + [self.pad_id] * pad)
+            labels.append([-100] * f["prompt_len"] + ids[f["prompt_len"]:] + [-100] * pad)
+            attention.append([1] * len(ids) + [0] * pad)
+            self.tokens += len(ids)
+        self.padded_tokens += width * len(features)
+        self.samples += len(features)
+        return {"input_ids": torch.tensor(input_ids), "labels": torch.tensor(labels),
+                "attention_mask": torch.tensor(attention)}
 
-    # Load dataset
-    ds = load_dataset("json", data_files=DATA_FILE)["train"]
+class LegacyCountingCollator(DataCollatorForLanguageModeling):
+    # The original collator, counting tokens the same way for comparison
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.tokens = 0
+        self.padded_tokens = 0
+        self.samples = 0
 
-    # Map to text field
+    def __call__(self, features, return_tensors=None):
+        batch = super().__call__(features, return_tensors)
+        self.tokens += int(batch["attention_mask"].sum())
+        self.padded_tokens += batch["input_ids"].numel()
+        self.samples += len(features)
+        return batch
+
+def legacy_dataset(tokenizer, data_file=DATA_FILE):
+    # Original pipeline: format and tokenize every run, full text as target
+    ds = load_dataset("json", data_files=data_file)["train"]
     ds = ds.map(lambda ex: {"text": format_example(ex["instruction"], ex["output"])}, remove_columns=ds.column_names)
 
-    # Tokenize
     def tok_fn(ex):
-        return tokenizer(ex["text"], truncation=True, max_length=512)
-    ds_tokenized = ds.map(tok_fn, batched=True, remove_columns=ds.column_names)
+        return tokenizer(ex["text"], truncation=True, max_length=MAX_LENGTH)
+    return ds.map(tok_fn, batched=True, remove_columns=ds.column_names)
+
+# --- Throughput ---
+def peak_rss_mb():
+    # None where there is no `resource` module (Windows): the report skips it
+    try:
+        import resource
+    except ImportError:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+class ThroughputCallback(TrainerCallback):
+    # Rates cover training steps only: evaluation runs through the same
+    # collator, so its counts and time are taken back out in on_evaluate
+    def __init__(self, collator):
+        self.collator = collator
+        self.excluded = 0.0
+
+    def _counters(self):
+        c = self.collator
+        return c.tokens, c.padded_tokens, c.samples
+
+    def _elapsed(self):
+        return time.perf_counter() - self.start - self.excluded
+
+    def on_train_begin(self, args, state, control, **kwargs):
+        self.start = self.epoch_start = time.perf_counter()
+        self.mark = (self.start, *self._counters())
+
+    def on_epoch_begin(self, args, state, control, **kwargs):
+        self.epoch_start = time.perf_counter()
+
+    def on_step_end(self, args, state, control, **kwargs):
+        self.mark = (time.perf_counter(), *self._counters())
+
+    def on_evaluate(self, args, state, control, **kwargs):
+        c = self.collator
+        self.excluded += time.perf_counter() - self.mark[0]
+        c.tokens, c.padded_tokens, c.samples = self.mark[1:]
+
+    def stats(self):
+        elapsed = self._elapsed()
+        tokens, padded_tokens, samples = self._counters()
+        stats = {
+            "seconds": round(elapsed, 2),
+            "samples": samples,
+            "tokens": tokens,
+            "samples_per_sec": round(samples / elapsed, 2) if elapsed > 0 else 0.0,
+            "tokens_per_sec": round(tokens / elapsed, 1) if elapsed > 0 else 0.0,
+            "padding_ratio": round(1 - tokens / padded_tokens, 3) if padded_tokens else 0.0,
+        }
+        rss = peak_rss_mb()
+        if rss is not None:
+            stats["peak_rss_mb"] = round(rss, 1)
+        return stats
+
+    def on_log(self, args, state, control, logs=None, **kwargs):
+        if logs is not None and self.collator.padded_tokens:
+            stats = self.stats()
+            logs.update({k: stats[k] for k in ("samples_per_sec", "tokens_per_sec", "padding_ratio", "peak_rss_mb")
+                         if k in stats})
+
+    def on_epoch_end(self, args, state, control, **kwargs):
+        print(f"⏱️ Epoch {state.epoch:.2f} took {time.perf_counter() - self.epoch_start:.1f}s")
+
+    def on_train_end(self, args, state, control, **kwargs):
+        stats = self.stats()
+        print(f"📊 {stats['samples']} samples / {stats['tokens']} tokens in {stats['seconds']:.1f}s: "
+              f"{stats['samples_per_sec']:.2f} samples/sec, {stats['tokens_per_sec']:.1f} tokens/sec, "
+              f"padding {stats['padding_ratio']:.1%}"
+              + (f", peak RSS {stats['peak_rss_mb']:.0f} MB" if "peak_rss_mb" in stats else ""))
+
+# --- Held-out evaluation ---
+def split_eval(ds, fraction):
+    # The tail of the file is held out, so both pipelines and every resumed
+    # run see the same split; generated data is already in random order
+    n_eval = int(len(ds) * fraction)
+    if n_eval == 0:
+        return ds, None
+    n_train = len(ds) - n_eval
+    return ds.select(range(n_train)), ds.select(range(n_train, len(ds)))
+
+def held_out_examples(data_file, n_train, limit):
+    examples = []
+    seen = 0
+    for batch in read_examples(data_file):
+        if seen + len(batch) > n_train:
+            examples.extend(batch[max(0, n_train - seen):])
+            if len(examples) >= limit:
+                break
+        seen += len(batch)
+    return examples[:limit]
+
+def score_outputs(outputs, expected):
+    # validity: parseable JSON object; field accuracy: share of expected
+    # fields reproduced exactly; exact: whole object equal
+    valid = exact = fields = total_fields = 0
+    for out, exp in zip(outputs, expected):
+        total_fields += len(exp)
+        if not isinstance(out, dict):
+            continue
+        valid += 1
+        exact += out == exp
+        fields += sum(out.get(k) == v for k, v in exp.items())
+    n = max(1, len(expected))
+    return {"json_valid": valid / n, "exact_match": exact / n, "field_accuracy": fields / max(1, total_fields)}
+
+def evaluate_json(tokenizer, model, examples, batch_size=8, max_new_tokens=128):
+    from inference import generate_batch
+    from ai_and_send_mail import extract_json
+    model.eval()
+    start = time.perf_counter()
+    generations = generate_batch(tokenizer, model, [format_prompt(ex["instruction"]) for ex in examples],
+                                 max_new_tokens=max_new_tokens, batch_size=batch_size)
+    metrics = score_outputs([extract_json(g.text) for g in generations], [ex["output"] for ex in examples])
+    metrics["samples"] = len(examples)
+    metrics["seconds"] = round(time.perf_counter() - start, 2)
+    return metrics
+
+def training_options(args):
+    # Profile defaults, then whatever was given explicitly
+    import torch
+    profile = args.profile if args.profile != "auto" else ("gpu" if torch.cuda.is_available() else "cpu")
+    opts = dict(PROFILES[profile])
+    for key in opts:
+        if getattr(args, key) is not None:
+            opts[key] = getattr(args, key)
+    if opts["precision"] == "fp16" and not torch.cuda.is_available():
+        raise SystemExit("❌ fp16 training needs a CUDA device; use --precision bf16 or fp32")
+    return profile, opts
+
+def main(args):
+    import torch
+    profile, opts = training_options(args)
+    threads = args.threads or TRAIN_THREADS
+    if threads:
+        torch.set_num_threads(threads)
+    print(f"⚙️ Profile {profile}: {opts}, {torch.get_num_threads()} threads")
+
+    tokenizer = AutoTokenizer.from_pretrained(args.base_model, use_fast=True)
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+
+    if args.pipeline == "cached":
+        ds_tokenized = load_token_cache(tokenizer, args.data)
+        data_collator = CompletionCollator(tokenizer)
+    else:
+        ds_tokenized = legacy_dataset(tokenizer, args.data)
+        data_collator = LegacyCountingCollator(tokenizer=tokenizer, mlm=False)
+    if args.prepare_only:
+        return
+    train_ds, eval_ds = split_eval(ds_tokenized, args.eval_fraction)
+
+    model = AutoModelForCausalLM.from_pretrained(args.base_model)
 
     # LoRA config
     lora_config = LoraConfig(
@@ -43,31 +303,89 @@ def main():
     )
     model = get_peft_model(model, lora_config)
 
-    data_collator = DataCollatorForLanguageModeling(tokenizer=tokenizer, mlm=False)
-
-    args = TrainingArguments(
-        output_dir=OUTPUT_DIR,
-        per_device_train_batch_size=8,
-        num_train_epochs=3,
+    training_args = TrainingArguments(
+        output_dir=args.output_dir,
+        per_device_train_batch_size=opts["batch_size"],
+        per_device_eval_batch_size=opts["batch_size"],
+        gradient_accumulation_steps=opts["grad_accum"],
+        # Recompute activations in backward: less memory, ~30% more compute
+        gradient_checkpointing=opts["gradient_checkpointing"],
+        gradient_checkpointing_kwargs={"use_reentrant": False},
+        num_train_epochs=args.epochs,
+        max_steps=args.max_steps,
         learning_rate=2e-4,
         logging_steps=20,
-        save_steps=500,
+        # Checkpoints keep optimizer, scheduler and RNG state for --resume;
+        # with the "steps" strategy the final step is saved as well
+        save_strategy="steps",
+        save_steps=args.save_steps,
         save_total_limit=2,
-        fp16=True
-        # Removed evaluation_strategy for compatibility
+        eval_strategy="steps" if eval_ds is not None else "no",
+        eval_steps=args.save_steps,
+        fp16=opts["precision"] == "fp16",
+        bf16=opts["precision"] == "bf16",
+        use_cpu=not torch.cuda.is_available(),
+        # Batches of similar length: padding all but disappears (cached pipeline)
+        group_by_length=args.pipeline == "cached",
+        length_column_name="length",
+        remove_unused_columns=False
     )
 
+    throughput = ThroughputCallback(data_collator)
+
     trainer = Trainer(
         model=model,
-        args=args,
-        train_dataset=ds_tokenized,
-        data_collator=data_collator
+        args=training_args,
+        train_dataset=train_ds,
+        eval_dataset=eval_ds,
+        data_collator=data_collator,
+        callbacks=[throughput]
     )
 
-    trainer.train()
-    trainer.save_model(OUTPUT_DIR)
-    tokenizer.save_pretrained(OUTPUT_DIR)
-    print("✅ Training complete. Saved to", OUTPUT_DIR)
+    resume = None
+    if args.resume:
+        resume = get_last_checkpoint(args.output_dir) if args.resume == "latest" else args.resume
+        print(f"🔁 Resuming from {resume}" if resume else "⚠️ No checkpoint to resume from, starting fresh")
+    trainer.train(resume_from_checkpoint=resume)
+    trainer.save_model(args.output_dir)
+    tokenizer.save_pretrained(args.output_dir)
+    print("✅ Training complete. Saved to", args.output_dir)
+
+    results = {"profile": profile, **opts, "threads": torch.get_num_threads(), "pipeline": args.pipeline,
+               **throughput.stats()}
+    if eval_ds is not None and args.eval_samples:
+        examples = held_out_examples(args.data, len(train_ds), args.eval_samples)
+        metrics = evaluate_json(tokenizer, model, examples, batch_size=opts["batch_size"])
+        print(f"🧪 Held-out ({metrics['samples']}): JSON valid {metrics['json_valid']:.1%}, "
+              f"field accuracy {metrics['field_accuracy']:.1%}, exact {metrics['exact_match']:.1%}")
+        trainer.save_metrics("eval", metrics)
+        results.update({f"eval_{k}": v for k, v in metrics.items()})
+    # One machine-readable line for bench_train.py
+    print("TRAIN_STATS " + json.dumps(results), flush=True)
+    return results
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="LoRA fine-tuning of Qwen on instruction -> JSON pairs")
+    parser.add_argument("--base-model", default=BASE_MODEL)
+    parser.add_argument("--data", default=DATA_FILE, help=".jsonl, .jsonl.gz or .jsonl.zst")
+    parser.add_argument("--output-dir", default=OUTPUT_DIR)
+    parser.add_argument("--pipeline", choices=["cached", "legacy"], default="cached",
+                        help="legacy: re-tokenize every run, pad per batch, loss on the whole text")
+    parser.add_argument("--profile", choices=["auto", *PROFILES], default="auto", help="auto: gpu if CUDA is available")
+    parser.add_argument("--precision", choices=["fp16", "bf16", "fp32"], default=None)
+    parser.add_argument("--batch-size", type=int, default=None)
+    parser.add_argument("--grad-accum", type=int, default=None)
+    parser.add_argument("--gradient-checkpointing", action=argparse.BooleanOptionalAction, default=None)
+    parser.add_argument("--threads", type=int, default=0, help="torch intra-op threads (or TRAIN_THREADS)")
+    parser.add_argument("--epochs", type=float, default=3)
+    parser.add_argument("--max-steps", type=int, default=-1, help="stop early, e.g. for throughput comparisons")
+    parser.add_argument("--save-steps", type=int, default=100)
+    parser.add_argument("--resume", nargs="?", const="latest", default=None,
+                        help="resume from the latest checkpoint-* in --output-dir, or from the given path")
+    parser.add_argument("--eval-fraction", type=float, default=0.05, help="held-out tail of the data; 0 disables")
+    parser.add_argument("--eval-samples", type=int, default=64, help="held-out examples scored for JSON accuracy")
+    parser.add_argument("--prepare-only", action="store_true", help="build the token cache and exit")
+    return parser.parse_args(argv)
 
 if __name__ == "__main__":
-    main()
+    main(parse_args())